@@ -1,5 +1,6 @@
 from pathlib import Path
 import os
+import tempfile
 import dj_database_url  # pip install dj-database-url
 
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -37,6 +38,7 @@ INSTALLED_APPS = [
 # Middleware
 # --------------------------------------------------
 MIDDLEWARE = [
+    'inventory.metrics.MetricsMiddleware',  # outermost, so it times the whole stack
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',  # ✅ Serve static files on Render
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -60,6 +62,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'inventory.notifications.navigation',
             ],
         },
     },
@@ -70,6 +73,28 @@ WSGI_APPLICATION = 'config.wsgi.application'
 # --------------------------------------------------
 # Database (SQLite for local, Postgres for Render)
 # --------------------------------------------------
+# Connection PRAGMAs for running SQLite under several gunicorn workers.
+# WAL lets readers run alongside the single writer, busy_timeout (ms) makes
+# writers wait for the lock instead of failing with "database is locked".
+# Set any of these to an empty string to leave SQLite's default in place.
+SQLITE_PRAGMAS = {
+    'journal_mode': os.getenv('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'busy_timeout': os.getenv('SQLITE_BUSY_TIMEOUT', '5000'),
+    'cache_size': os.getenv('SQLITE_CACHE_SIZE', '-20000'),  # negative = KiB
+    'mmap_size': os.getenv('SQLITE_MMAP_SIZE', '134217728'),
+    'temp_store': os.getenv('SQLITE_TEMP_STORE', 'MEMORY'),
+}
+SQLITE_OPTIONS = {
+    'init_command': ';'.join(
+        f'PRAGMA {name}={value}' for name, value in SQLITE_PRAGMAS.items() if value
+    ),
+    # How atomic blocks open: unset for SQLite's default (DEFERRED), or
+    # IMMEDIATE / EXCLUSIVE. IMMEDIATE takes the write lock up front so
+    # concurrent writers wait on busy_timeout instead of failing to upgrade.
+    'transaction_mode': os.getenv('SQLITE_TRANSACTION_MODE') or None,
+}
+
 if os.getenv("DATABASE_URL"):
     DATABASES = {
         'default': dj_database_url.config(
@@ -80,11 +105,35 @@ if os.getenv("DATABASE_URL"):
 else:
     DATABASES = {
         'default': {
-            'ENGINE': 'django.db.backends.sqlite3',
+            'ENGINE': 'inventory.backends.sqlite3',
             'NAME': BASE_DIR / 'db.sqlite3',
+            'OPTIONS': SQLITE_OPTIONS,
         }
     }
 
+# Optional read replica for dashboard, list and API read traffic, routed by
+# inventory.routers. To try it locally, copy db.sqlite3 and point at the copy:
+#   DATABASE_REPLICA_URL=sqlite:////absolute/path/to/replica.sqlite3
+if os.getenv("DATABASE_REPLICA_URL"):
+    replica_url = os.environ["DATABASE_REPLICA_URL"]
+    if replica_url.startswith('sqlite:'):
+        replica = dj_database_url.parse(replica_url, engine='inventory.backends.sqlite3')
+        replica['OPTIONS'] = SQLITE_OPTIONS
+    else:
+        replica = dj_database_url.parse(replica_url, conn_max_age=600, ssl_require=True)
+    # Tests read and write through the same database
+    replica['TEST'] = {'MIRROR': 'default'}
+    DATABASES['replica'] = replica
+    DATABASE_ROUTERS = ['inventory.routers.PrimaryReplicaRouter']
+    MIDDLEWARE.append('inventory.routers.ReplicaRoutingMiddleware')
+
+# Seconds a client keeps reading from the primary after it writes, to cover replica lag
+REPLICA_PIN_SECONDS = int(os.getenv('REPLICA_PIN_SECONDS', '5'))
+
+# Worker threads the ASGI dashboard (/dashboard/live/) runs its queries on at
+# once, each with its own database connection; 1 runs them one after another
+DASHBOARD_QUERY_THREADS = int(os.getenv('DASHBOARD_QUERY_THREADS', '8'))
+
 # --------------------------------------------------
 # Passwords
 # --------------------------------------------------
@@ -135,3 +184,126 @@ REST_FRAMEWORK = {
         'rest_framework.authentication.BasicAuthentication',
     ],
 }
+
+# --------------------------------------------------
+# Cache
+# --------------------------------------------------
+# Set REDIS_URL to share the cache between gunicorn workers; the default
+# in-process cache is only shared between threads of one worker.
+if os.getenv("REDIS_URL"):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ["REDIS_URL"],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'karmawala',
+        }
+    }
+
+# Catalog cache (inventory/catalog.py): entries kept per process, and seconds
+# an entry lives in either tier; without REDIS_URL this is how long other
+# workers can serve categories and products changed elsewhere
+CATALOG_CACHE_LOCAL_SIZE = int(os.getenv('CATALOG_CACHE_LOCAL_SIZE', '16'))
+CATALOG_CACHE_TIMEOUT = int(os.getenv('CATALOG_CACHE_TIMEOUT', '3600'))
+# SKUs each process keeps for POS scan lookups, and seconds before one is
+# re-read; without a shared cache (REDIS_URL) this is how long a price
+# changed in one worker can still be charged by another
+SCAN_CACHE_SIZE = int(os.getenv('SCAN_CACHE_SIZE', '100000'))
+SCAN_CACHE_TIMEOUT = int(os.getenv('SCAN_CACHE_TIMEOUT', '30'))
+# Seconds before the cached unread notification count (inventory/notifications.py)
+# is recounted from the table
+UNREAD_RECOUNT_SECONDS = int(os.getenv('UNREAD_RECOUNT_SECONDS', '300'))
+
+# --------------------------------------------------
+# Metrics (/metrics, Prometheus text format)
+# --------------------------------------------------
+# Each worker writes its own file here; clear the directory on deploy
+METRICS_DIR = os.getenv('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'karmawala-metrics'))
+# Scrapers send "Authorization: Bearer <token>"; without a token only staff
+# sessions can read /metrics
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# --------------------------------------------------
+# Idempotency keys (inventory/idempotency.py)
+# --------------------------------------------------
+# Seconds a stored response is replayed for; expire old keys with
+# `manage.py expire_idempotency_keys`
+IDEMPOTENCY_KEY_TTL = int(os.getenv('IDEMPOTENCY_KEY_TTL', str(24 * 3600)))
+# Seconds a running request holds its key before a retry may take it over;
+# keep it above the server's request timeout (gunicorn's default is 30)
+IDEMPOTENCY_LOCK_TIMEOUT = int(os.getenv('IDEMPOTENCY_LOCK_TIMEOUT', '60'))
+
+# --------------------------------------------------
+# Rate limits and admission control (inventory/throttling.py)
+# --------------------------------------------------
+# Per user and endpoint: (burst, per_seconds) -- up to `burst` requests at
+# once, refilled evenly over `per_seconds`
+RATE_LIMITS = {
+    'create-order': (30, 60),
+    'create-category': (10, 60),
+    'sell': (60, 60),
+    'order-transition': (10, 60),
+    'scan-sell': (120, 60),
+    'repricing': (5, 60),
+    'stock-transfer': (30, 60),
+}
+# Write requests allowed in flight across all workers; 0 disables the cap
+WRITE_CONCURRENCY_LIMIT = int(os.getenv('WRITE_CONCURRENCY_LIMIT', '16'))
+
+# --------------------------------------------------
+# Outbound webhooks (inventory/webhooks.py)
+# --------------------------------------------------
+# Sent by `manage.py deliver_webhooks`. A failed delivery is retried after
+# WEBHOOK_RETRY_BASE seconds, doubling up to WEBHOOK_RETRY_MAX, and left
+# dead after WEBHOOK_MAX_ATTEMPTS tries
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', '10'))
+WEBHOOK_RETRY_BASE = int(os.getenv('WEBHOOK_RETRY_BASE', '30'))
+WEBHOOK_RETRY_MAX = int(os.getenv('WEBHOOK_RETRY_MAX', str(6 * 3600)))
+# Seconds to connect to, and to wait on, a receiver
+WEBHOOK_TIMEOUT = float(os.getenv('WEBHOOK_TIMEOUT', '10'))
+
+# --------------------------------------------------
+# Admin changelists on large tables (inventory/admin.py)
+# --------------------------------------------------
+# Result counts at or above this are estimated (PostgreSQL planner) or
+# cached for ADMIN_COUNT_CACHE_TIMEOUT seconds instead of counted per page
+ADMIN_EXACT_COUNT_LIMIT = int(os.getenv('ADMIN_EXACT_COUNT_LIMIT', '10000'))
+ADMIN_COUNT_CACHE_TIMEOUT = int(os.getenv('ADMIN_COUNT_CACHE_TIMEOUT', '300'))
+
+# --------------------------------------------------
+# Slow-query log (inventory/slow_queries.py)
+# --------------------------------------------------
+# Off unless SLOW_QUERY_LOG names a file; summarize with `manage.py slow_queries`
+SLOW_QUERY_LOG = os.getenv('SLOW_QUERY_LOG', '')
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv('SLOW_QUERY_THRESHOLD_MS', '200'))
+
+if SLOW_QUERY_LOG:
+    MIDDLEWARE.insert(1, 'inventory.slow_queries.SlowQueryMiddleware')
+    LOGGING = {
+        'version': 1,
+        'disable_existing_loggers': False,
+        'formatters': {
+            'raw': {'format': '%(message)s'},
+        },
+        'handlers': {
+            'slow_queries': {
+                'class': 'logging.handlers.RotatingFileHandler',
+                'filename': SLOW_QUERY_LOG,
+                'maxBytes': 10 * 1024 * 1024,
+                'backupCount': 5,
+                'formatter': 'raw',
+            },
+        },
+        'loggers': {
+            'inventory.slow_queries': {
+                'handlers': ['slow_queries'],
+                'level': 'INFO',
+                'propagate': False,
+            },
+        },
+    }
@@ -2,12 +2,18 @@ from django.contrib import admin
 from django.urls import path, include
 from django.contrib.auth import views as auth_views
 from rest_framework.routers import DefaultRouter
-from inventory.api import CategoryViewSet, ProductViewSet
-from inventory.views import dashboard
+from inventory.api import (
+    CategoryViewSet, LocationViewSet, ProductViewSet, ProductFamilyViewSet, order_status_transition, margin_report,
+    scan_lookup, scan_sell, repricing_preview, repricing_apply, customer_lookup, stock_transfer,
+)
+from inventory.views import dashboard, dashboard_live
+from inventory.metrics import metrics_view
 
 router = DefaultRouter()
 router.register(r'categories', CategoryViewSet, basename='api-categories')
 router.register(r'products', ProductViewSet, basename='api-products')
+router.register(r'families', ProductFamilyViewSet, basename='api-families')
+router.register(r'locations', LocationViewSet, basename='api-locations')
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -15,7 +21,18 @@ urlpatterns = [
     path('logout/', auth_views.LogoutView.as_view(), name='logout'),
 
     path('', dashboard, name='dashboard'),
+    path('dashboard/live/', dashboard_live, name='dashboard-live'),
     path('products/', include('inventory.urls')),
 
+    path('metrics', metrics_view, name='metrics'),
+
+    path('api/orders/transition/', order_status_transition, name='api-order-transition'),
+    path('api/reports/margins/', margin_report, name='api-margin-report'),
+    path('api/sales/scan/', scan_sell, name='api-scan-sell'),
+    path('api/scan/<str:sku>/', scan_lookup, name='api-scan-lookup'),
+    path('api/stock/transfers/', stock_transfer, name='api-stock-transfer'),
+    path('api/repricing/preview/', repricing_preview, name='api-repricing-preview'),
+    path('api/repricing/', repricing_apply, name='api-repricing'),
+    path('api/customers/<str:phone>/', customer_lookup, name='api-customer-lookup'),
     path('api/', include(router.urls)),
 ]
\ No newline at end of file
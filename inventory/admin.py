@@ -1,26 +1,320 @@
+"""
+Admin registrations.
+
+The order, sale, notification, product, stock movement and webhook event
+changelists use ``LargeTableAdminMixin`` so they stay fast on tables with
+millions of rows:
+
+* ``EstimatedCountPaginator`` counts small results exactly. A result of
+  ``ADMIN_EXACT_COUNT_LIMIT`` rows or more is estimated from the PostgreSQL
+  planner's statistics (``EXPLAIN``). Other databases count it once and
+  cache the count for ``ADMIN_COUNT_CACHE_TIMEOUT`` seconds.
+* ``show_full_result_count`` is off, which saves a second unfiltered
+  ``COUNT(*)`` on every filtered page.
+* Admins with a ``date_hierarchy`` open on the last ``list_window_days``
+  days, a range the ``created_at`` index can serve. The "period" filter
+  widens it. Drilling into the date hierarchy, or using the date filter,
+  replaces the window. The hierarchy's year/month/day links come from index
+  probes (``DateProbeMixin``) rather than a DISTINCT over every row.
+
+Columns that would be per-row queries are joins (``list_select_related``) or
+annotations instead.
+
+The product changelist's "Reprice selected products" action previews a
+``repricing`` rule against the selection and then applies it.
+
+Dead webhook events can be sent again from the webhook event changelist.
+
+Product and order edits go through ``VersionedAdminMixin``: a change form
+opened before someone else saved the row is sent back with an error, and
+saves write only the changed fields (``concurrency.save_changes()``).
+"""
+from datetime import datetime, timedelta
+from functools import lru_cache
+import hashlib
+import json
+
+from django import forms
+from django.conf import settings
 from django.contrib import admin
-from .models import Category, Product, Order, OrderItem, Notification, Sale
+from django.contrib.admin import helpers
+from django.contrib.admin.views.main import SEARCH_VAR, ChangeList
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.template.response import TemplateResponse
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+from . import ledger
+from .concurrency import VersionConflict, save_changes
+from .forms import VersionedModelForm
+from .models import (
+    Category, Customer, Location, Product, ProductFamily, ProductLocationStock, Order, OrderItem, Notification,
+    Repricing, Sale, StockMovement, WebhookEndpoint, WebhookEvent,
+)
+from .notifications import mark_read, recount_unread
+from .repricing import RepricingRule, apply_repricing, check_rule, preview
+from .services import transition_orders
+from .webhooks import EVENT_TYPES, requeue
 
 # Admin branding
 admin.site.site_header = "KarmaWala Administration"
 admin.site.site_title = "KarmaWala Admin"
 admin.site.index_title = "KarmaWala Admin"
 
+def estimated_count(queryset):
+    """Exact count for small results; an estimate or cached count for large ones"""
+    connection = connections[queryset.db]
+    sql, params = queryset.order_by().query.get_compiler(queryset.db).as_sql()
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        estimate = int(plan[0]['Plan']['Plan Rows'])
+        if estimate >= settings.ADMIN_EXACT_COUNT_LIMIT:
+            return estimate
+        return queryset.count()
+
+    key = 'admin:count:' + hashlib.sha1(f'{queryset.db}:{sql}:{params!r}'.encode('utf-8')).hexdigest()
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        if count >= settings.ADMIN_EXACT_COUNT_LIMIT:
+            cache.set(key, count, settings.ADMIN_COUNT_CACHE_TIMEOUT)
+    return count
+
+class EstimatedCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        return estimated_count(self.object_list)
+
+class RecentWindowFilter(admin.SimpleListFilter):
+    """Limits a changelist to recent rows unless a date is chosen some other way or it is searched"""
+    title = 'period'
+    parameter_name = 'period'
+
+    def __init__(self, request, params, model, model_admin):
+        self.field = model_admin.date_hierarchy
+        self.days = model_admin.list_window_days
+        super().__init__(request, params, model, model_admin)
+
+    def lookups(self, request, model_admin):
+        return [('365', 'Last 365 days'), ('all', 'All time')]
+
+    def choices(self, changelist):
+        yield {
+            'selected': self.value() is None,
+            'query_string': changelist.get_query_string(remove=[self.parameter_name]),
+            'display': f'Last {self.days} days',
+        }
+        for lookup, title in self.lookup_choices:
+            yield {
+                'selected': self.value() == lookup,
+                'query_string': changelist.get_query_string({self.parameter_name: lookup}),
+                'display': title,
+            }
+
+    def queryset(self, request, queryset):
+        if self.value() == 'all':
+            return queryset
+        # The date hierarchy and the date filter pick their own range
+        if any(param.startswith(f'{self.field}__') for param in request.GET):
+            return queryset
+        # A search looks up a known order number or SKU, however old
+        if request.GET.get(SEARCH_VAR):
+            return queryset
+        days = 365 if self.value() == '365' else self.days
+        return queryset.filter(**{f'{self.field}__gte': timezone.now() - timedelta(days=days)})
+
+def _truncate(value, kind):
+    return value.replace(
+        month=1 if kind == 'year' else value.month,
+        day=1 if kind in ('year', 'month') else value.day,
+        hour=0, minute=0, second=0, microsecond=0,
+    )
+
+def _next_bucket(start, kind):
+    if kind == 'year':
+        return start.replace(year=start.year + 1)
+    if kind == 'month':
+        return start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+    return datetime.combine(start.date() + timedelta(days=1), start.time(), start.tzinfo)
+
+class DateProbeMixin:
+    """Answers the date hierarchy's ``datetimes()`` without scanning every row.
+
+    Django truncates each matching row's date and takes the DISTINCT values.
+    This reads the first and last dates off the index, then keeps each year,
+    month or day between them that an indexed EXISTS finds a row in, so the
+    cost follows the calendar rather than the row count.
+    """
+
+    def datetimes(self, field_name, kind, order='ASC', tzinfo=None, is_dst=timezone.NOT_PASSED):
+        if kind not in ('year', 'month', 'day'):
+            return super().datetimes(field_name, kind, order, tzinfo, is_dst)
+        base = self.order_by()
+        first = base.order_by(field_name).values_list(field_name, flat=True).first()
+        if first is None:
+            return []
+        last = base.order_by(f'-{field_name}').values_list(field_name, flat=True).first()
+        if settings.USE_TZ:
+            tzinfo = tzinfo or timezone.get_current_timezone()
+            first, last = first.astimezone(tzinfo), last.astimezone(tzinfo)
+
+        buckets = []
+        start = _truncate(first, kind)
+        while start <= last:
+            end = _next_bucket(start, kind)
+            if base.filter(**{f'{field_name}__gte': start, f'{field_name}__lt': end}).exists():
+                buckets.append(start)
+            start = end
+        return buckets if order == 'ASC' else buckets[::-1]
+
+@lru_cache(maxsize=None)
+def _probing(queryset_class):
+    return type(f'Probing{queryset_class.__name__}', (DateProbeMixin, queryset_class), {})
+
+class LargeTableChangeList(ChangeList):
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        queryset.__class__ = _probing(queryset.__class__)
+        return queryset
+
+class LargeTableAdminMixin:
+    """Changelist settings for tables too big to count or scan on every page"""
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    # Days shown by default on admins with a date_hierarchy; None shows everything
+    list_window_days = 30
+
+    def get_changelist(self, request, **kwargs):
+        return LargeTableChangeList
+
+    def get_list_filter(self, request):
+        list_filter = super().get_list_filter(request)
+        if self.date_hierarchy and self.list_window_days:
+            return (RecentWindowFilter, *list_filter)
+        return list_filter
+
+class VersionedAdminForm(VersionedModelForm):
+    def clean(self):
+        cleaned_data = super().clean()
+        instance = self.instance
+        if instance.pk and 'version' in cleaned_data:
+            current = type(instance)._default_manager.filter(pk=instance.pk, version=cleaned_data['version'])
+            if not current.exists():
+                raise ValidationError(str(VersionConflict(instance)))
+        return cleaned_data
+
+class ProductAdminForm(VersionedAdminForm):
+    guarded_fields = ('stock',)
+
+class VersionedAdminMixin:
+    form = VersionedAdminForm
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            return super().save_model(request, obj, form, change)
+        # Still conditional: a save landing between clean() and here raises
+        save_changes(obj, form.changed_data, expect=form.loaded_values())
+
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
     search_fields = ('name',)
     list_display = ('name', 'description')
 
+@admin.register(ProductFamily)
+class ProductFamilyAdmin(admin.ModelAdmin):
+    list_display = ('name', 'sku_prefix', 'category')
+    list_filter = ('category',)
+    search_fields = ('name', 'sku_prefix')
+    autocomplete_fields = ('category',)
+
+class RepricingActionForm(forms.Form):
+    mode = forms.ChoiceField(choices=[('percent', 'Percent'), ('amount', 'Amount (₨)')])
+    value = forms.DecimalField(max_digits=10, decimal_places=2, help_text='Negative to lower prices, e.g. -20')
+    rounding = forms.ChoiceField(choices=[
+        ('paisa', 'To the paisa'), ('rupee', 'To the rupee'), ('x9', 'Ending in 9'), ('x99', 'Ending in 99'),
+    ])
+    min_margin = forms.DecimalField(
+        max_digits=5, decimal_places=2, required=False, label='Minimum margin %',
+        help_text='Never price below cost plus this gross margin',
+    )
+    note = forms.CharField(max_length=200, required=False)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if not self.errors:
+            try:
+                check_rule(self.rule())
+            except ValueError as e:
+                raise ValidationError(str(e))
+        return cleaned_data
+
+    def rule(self):
+        data = self.cleaned_data
+        return RepricingRule(
+            mode=data['mode'], value=data['value'], rounding=data['rounding'], min_margin=data['min_margin'],
+        )
+
 @admin.register(Product)
-class ProductAdmin(admin.ModelAdmin):
+class ProductAdmin(VersionedAdminMixin, LargeTableAdminMixin, admin.ModelAdmin):
+    form = ProductAdminForm
     list_display = ('name', 'sku', 'category', 'size', 'color', 'price', 'stock', 'reorder_threshold', 'is_active')
+    list_select_related = ('category',)
     list_filter = ('category', 'is_active')
     search_fields = ('name', 'sku', 'color')
-    autocomplete_fields = ('category',)
+    autocomplete_fields = ('category', 'family')
+    readonly_fields = ('located_stock',)
+    actions = ['reprice']
+
+    def save_model(self, request, obj, form, change):
+        ledger.tag(obj, user=request.user)
+        super().save_model(request, obj, form, change)
+
+    def reprice(self, request, queryset):
+        # Rendered in place of the changelist until the rule is applied; the
+        # selection rides along in the action's own hidden fields
+        form = RepricingActionForm(request.POST if 'mode' in request.POST else None)
+        result = None
+        if form.is_valid():
+            if 'apply' in request.POST:
+                repricing = apply_repricing(
+                    [form.rule()], user=request.user, note=form.cleaned_data['note'], queryset=queryset
+                )
+                self.message_user(request, f'{repricing.change_count} prices changed (repricing {repricing.pk}).')
+                return None
+            result = preview(form.rule(), queryset)
+        return TemplateResponse(request, 'admin/inventory/product/reprice.html', {
+            **self.admin_site.each_context(request),
+            'title': 'Reprice products',
+            'opts': self.model._meta,
+            'form': form,
+            'preview': result,
+            'selected': request.POST.getlist(helpers.ACTION_CHECKBOX_NAME),
+            'select_across': request.POST.get('select_across', '0'),
+        })
+    reprice.short_description = "Reprice selected products"
+
+@admin.register(Repricing)
+class RepricingAdmin(admin.ModelAdmin):
+    list_display = ('pk', 'note', 'change_count', 'created_at', 'created_by')
+    list_select_related = ('created_by',)
+    readonly_fields = ('note', 'rules', 'change_count', 'created_at', 'created_by')
+
+    def has_add_permission(self, request):
+        return False
 
 class OrderItemInline(admin.TabularInline):
     model = OrderItem
     extra = 0
+    autocomplete_fields = ('product',)
     readonly_fields = ('get_subtotal',)
     
     def get_subtotal(self, obj):
@@ -29,20 +323,43 @@ class OrderItemInline(admin.TabularInline):
         return "₨0"
     get_subtotal.short_description = "Subtotal"
 
+def transition_action(status, label):
+    def action(modeladmin, request, queryset):
+        result = transition_orders(queryset.values_list('pk', flat=True), status, user=request.user)
+        modeladmin.message_user(request, f'{len(result.updated)} orders marked as {label.lower()}.')
+        if result.skipped:
+            modeladmin.message_user(
+                request,
+                f'{len(result.skipped)} orders skipped: they cannot move to {label.lower()} from their current status.',
+                level='warning',
+            )
+    action.__name__ = f'mark_{status}'
+    action.short_description = f"Mark selected orders as {label.lower()}"
+    return action
+
+@admin.register(Customer)
+class CustomerAdmin(admin.ModelAdmin):
+    list_display = ('name', 'phone', 'order_count', 'total_spent', 'last_order_at')
+    search_fields = ('=phone', 'name')
+    readonly_fields = ('order_count', 'total_spent', 'last_order_at', 'created_at')
+
 @admin.register(Order)
-class OrderAdmin(admin.ModelAdmin):
-    list_display = ('order_number', 'customer_name', 'customer_phone', 'status', 'total_amount', 'item_count', 'created_at')
+class OrderAdmin(VersionedAdminMixin, LargeTableAdminMixin, admin.ModelAdmin):
+    list_display = ('order_number', 'customer_name', 'customer_phone', 'status', 'total_amount', 'get_item_count', 'created_at')
     list_filter = ('status', 'created_at')
+    date_hierarchy = 'created_at'
     search_fields = ('order_number', 'customer_name', 'customer_phone', 'customer_email')
     readonly_fields = ('order_number', 'total_amount', 'created_at', 'updated_at')
+    autocomplete_fields = ('customer',)
     inlines = [OrderItemInline]
+    actions = [transition_action(status, label) for status, label in Order.STATUS_CHOICES if status != 'pending']
     
     fieldsets = (
         ('Order Information', {
-            'fields': ('order_number', 'status', 'total_amount', 'created_at', 'updated_at')
+            'fields': ('order_number', 'status', 'total_amount', 'created_at', 'updated_at', 'version')
         }),
         ('Customer Details', {
-            'fields': ('customer_name', 'customer_email', 'customer_phone', 'customer_address')
+            'fields': ('customer', 'customer_name', 'customer_email', 'customer_phone', 'customer_address')
         }),
         ('Notes', {
             'fields': ('notes',),
@@ -50,10 +367,34 @@ class OrderAdmin(admin.ModelAdmin):
         }),
     )
 
+    def get_queryset(self, request):
+        # A correlated subquery is evaluated only for the rows on the page,
+        # where a join and GROUP BY would aggregate every matching order
+        units = (
+            OrderItem.objects.filter(order=OuterRef('pk')).order_by()
+            .values('order').annotate(units=Sum('quantity')).values('units')
+        )
+        return super().get_queryset(request).annotate(units=Coalesce(Subquery(units), 0))
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if change:
+            # Conditional saves skip Order.save(), which records the spend
+            obj.record_spend()
+
+    def get_item_count(self, obj):
+        return obj.units
+    get_item_count.short_description = "Items"
+    get_item_count.admin_order_field = 'units'
+
 @admin.register(OrderItem)
-class OrderItemAdmin(admin.ModelAdmin):
+class OrderItemAdmin(LargeTableAdminMixin, admin.ModelAdmin):
     list_display = ('order', 'product', 'quantity', 'unit_price', 'get_subtotal')
     list_filter = ('created_at',)
+    list_select_related = ('order', 'product')
+    autocomplete_fields = ('order', 'product')
+    date_hierarchy = 'created_at'
+    ordering = ('-created_at',)
     search_fields = ('order__order_number', 'product__name', 'product__sku')
     
     def get_subtotal(self, obj):
@@ -61,27 +402,114 @@ class OrderItemAdmin(admin.ModelAdmin):
     get_subtotal.short_description = "Subtotal"
 
 @admin.register(Notification)
-class NotificationAdmin(admin.ModelAdmin):
+class NotificationAdmin(LargeTableAdminMixin, admin.ModelAdmin):
     list_display = ('type', 'title', 'is_read', 'created_at')
     list_filter = ('type', 'is_read', 'created_at')
+    date_hierarchy = 'created_at'
     search_fields = ('title', 'message')
     readonly_fields = ('created_at',)
     
     actions = ['mark_as_read', 'mark_as_unread']
     
     def mark_as_read(self, request, queryset):
-        queryset.update(is_read=True)
-        self.message_user(request, f'{queryset.count()} notifications marked as read.')
+        updated = mark_read(queryset)
+        self.message_user(request, f'{updated} notifications marked as read.')
     mark_as_read.short_description = "Mark selected notifications as read"
     
     def mark_as_unread(self, request, queryset):
-        queryset.update(is_read=False)
-        self.message_user(request, f'{queryset.count()} notifications marked as unread.')
+        updated = mark_read(queryset, is_read=False)
+        self.message_user(request, f'{updated} notifications marked as unread.')
     mark_as_unread.short_description = "Mark selected notifications as unread"
 
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        recount_unread()
+
+    def delete_queryset(self, request, queryset):
+        super().delete_queryset(request, queryset)
+        recount_unread()
+
 @admin.register(Sale)
-class SaleAdmin(admin.ModelAdmin):
+class SaleAdmin(LargeTableAdminMixin, admin.ModelAdmin):
     list_display = ('product', 'quantity', 'unit_price', 'total_amount', 'created_at', 'created_by')
     list_filter = ('created_at', 'created_by')
+    list_select_related = ('product', 'created_by')
+    date_hierarchy = 'created_at'
     search_fields = ('product__name', 'product__sku')
-    autocomplete_fields = ('product',)
\ No newline at end of file
+    autocomplete_fields = ('product',)
+
+class WebhookEndpointForm(forms.ModelForm):
+    events = forms.MultipleChoiceField(
+        choices=[(event_type, event_type) for event_type in EVENT_TYPES],
+        required=False,
+        widget=forms.CheckboxSelectMultiple,
+        help_text='Leave empty to send every event type',
+    )
+
+    class Meta:
+        model = WebhookEndpoint
+        fields = ('url', 'secret', 'events', 'is_active')
+
+@admin.register(StockMovement)
+class StockMovementAdmin(LargeTableAdminMixin, admin.ModelAdmin):
+    list_display = ('created_at', 'product', 'quantity', 'reason', 'location_id', 'order_id', 'sale_id', 'user_id')
+    list_filter = ('reason',)
+    list_select_related = ('product',)
+    date_hierarchy = 'created_at'
+    search_fields = ('=product__sku',)
+    readonly_fields = [field.name for field in StockMovement._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+@admin.register(Location)
+class LocationAdmin(admin.ModelAdmin):
+    list_display = ('name', 'code', 'kind', 'is_default', 'is_active')
+    list_filter = ('kind', 'is_active')
+    search_fields = ('name', 'code')
+
+@admin.register(ProductLocationStock)
+class ProductLocationStockAdmin(admin.ModelAdmin):
+    # Moved only by sales and transfers, so both rollups on the product stay right
+    list_display = ('product', 'location', 'stock', 'updated_at')
+    list_filter = ('location',)
+    list_select_related = ('product', 'location')
+    search_fields = ('=product__sku',)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+@admin.register(WebhookEndpoint)
+class WebhookEndpointAdmin(admin.ModelAdmin):
+    form = WebhookEndpointForm
+    list_display = ('url', 'events', 'is_active', 'created_at')
+    list_filter = ('is_active',)
+
+@admin.register(WebhookEvent)
+class WebhookEventAdmin(LargeTableAdminMixin, admin.ModelAdmin):
+    list_display = ('pk', 'type', 'object_id', 'endpoint', 'status', 'attempts', 'next_attempt_at', 'last_error')
+    list_filter = ('status', 'type', 'endpoint')
+    list_select_related = ('endpoint',)
+    date_hierarchy = 'created_at'
+    readonly_fields = [field.name for field in WebhookEvent._meta.fields]
+    actions = ['requeue_dead']
+
+    def has_add_permission(self, request):
+        return False
+
+    def requeue_dead(self, request, queryset):
+        requeued = requeue(queryset)
+        self.message_user(request, f'{requeued} dead webhook events queued to send again.')
+    requeue_dead.short_description = "Send selected dead events again"
@@ -0,0 +1,201 @@
+"""
+Revenue, cost of goods and gross margin, grouped in SQL.
+
+Two sources count as revenue: till sales (``Sale``) and lines of delivered
+orders (``OrderItem``). Each row carries the product cost snapshotted when it
+was created; rows from before the snapshot existed fall back to the current
+``Product.cost``.
+
+Days up to the last one rolled up by ``manage.py rollup_margins`` are read
+from ``MarginRollup`` (one row per product per day per source); later days
+are aggregated from the raw tables. Either way each source is one grouped
+query, so the work done in Python is proportional to the number of groups.
+
+Rows moved out by ``manage.py archive_history`` count as well: rollups are
+built from the live and archive tables together, and reports read both
+unless ``include_archive=False`` restricts them to the live tables.
+"""
+from collections import namedtuple
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import DateField, DecimalField, ExpressionWrapper, F, Max, Sum
+from django.db.models.functions import Coalesce, Trunc, TruncDate
+from django.utils import timezone
+
+from .models import ArchivedOrderItem, ArchivedSale, MarginRollup, OrderItem, Sale
+
+GROUPINGS = {
+    'category': 'product__category__name',
+    'size': 'product__size',
+    'color': 'product__color',
+    'product': 'product__name',
+}
+PERIODS = ('day', 'week', 'month', 'year')
+
+MarginRow = namedtuple('MarginRow', 'group period quantity revenue cost margin margin_percent')
+
+_MONEY = DecimalField(max_digits=14, decimal_places=2)
+
+
+def _sources(include_archive=True):
+    """(source, queryset, revenue expression, cost expression) for the raw tables"""
+    sales = [Sale.objects.all()]
+    order_items = [OrderItem.objects.filter(order__status='delivered')]
+    if include_archive:
+        sales.append(ArchivedSale.objects.all())
+        order_items.append(ArchivedOrderItem.objects.filter(order__status='delivered'))
+    cost = F('quantity') * Coalesce('unit_cost', 'product__cost')
+    return (
+        [('sale', queryset, F('total_amount'), cost) for queryset in sales]
+        + [('order', queryset, F('quantity') * F('unit_price'), cost) for queryset in order_items]
+    )
+
+
+def _day_start(day):
+    """Midnight local time as an aware datetime, so date bounds can use the created_at index"""
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def rolled_through():
+    """Last day covered by MarginRollup, or None"""
+    return MarginRollup.objects.aggregate(day=Max('day'))['day']
+
+
+def _grouped(queryset, group_field, period, day_expression, quantity, revenue, cost):
+    fields = {}
+    if group_field:
+        fields['group'] = F(group_field)
+    if period:
+        fields['period'] = Trunc(day_expression, period, output_field=DateField())
+    return (
+        queryset.annotate(**fields)
+        .values(*fields)
+        .annotate(
+            units=Sum(quantity),
+            revenue_total=Sum(ExpressionWrapper(revenue, output_field=_MONEY)),
+            cost_total=Sum(ExpressionWrapper(cost, output_field=_MONEY)),
+        )
+        .order_by()
+    )
+
+
+def margin_report(group_by='category', period=None, start=None, end=None, sources=('sale', 'order'),
+                  include_archive=True):
+    """Margin rows grouped by ``group_by`` (a GROUPINGS key or None) and ``period``.
+
+    ``start`` and ``end`` are inclusive local dates. Rows are sorted by period,
+    then by revenue, highest first. Rollups mix live and archived rows, so a
+    live-only report (``include_archive=False``) reads the raw tables for
+    every day.
+    """
+    if group_by is not None and group_by not in GROUPINGS:
+        raise ValueError(f'Unknown grouping: {group_by}')
+    if period is not None and period not in PERIODS:
+        raise ValueError(f'Unknown period: {period}')
+    group_field = GROUPINGS.get(group_by)
+    rollup_end = rolled_through() if include_archive else None
+
+    totals = {}
+
+    def add(rows):
+        for row in rows:
+            key = (row.get('group'), row.get('period'))
+            total = totals.setdefault(key, [0, Decimal('0.00'), Decimal('0.00')])
+            total[0] += row['units'] or 0
+            total[1] += row['revenue_total'] or 0
+            total[2] += row['cost_total'] or 0
+
+    if rollup_end and (start is None or start <= rollup_end):
+        for source in sources:
+            rollups = MarginRollup.objects.filter(source=source, day__lte=rollup_end)
+            if start:
+                rollups = rollups.filter(day__gte=start)
+            if end:
+                rollups = rollups.filter(day__lte=end)
+            add(_grouped(rollups, group_field, period, 'day', F('quantity'), F('revenue'), F('cost')))
+
+    for source, queryset, revenue, cost in _sources(include_archive):
+        if source not in sources or (rollup_end and end and end <= rollup_end):
+            continue
+        raw = queryset
+        if rollup_end:
+            raw = raw.filter(created_at__gte=_day_start(rollup_end + timedelta(days=1)))
+        if start:
+            raw = raw.filter(created_at__gte=_day_start(start))
+        if end:
+            raw = raw.filter(created_at__lt=_day_start(end + timedelta(days=1)))
+        add(_grouped(raw, group_field, period, 'created_at', F('quantity'), revenue, cost))
+
+    rows = []
+    for (group, row_period), (quantity, revenue, cost) in totals.items():
+        margin = revenue - cost
+        rows.append(MarginRow(
+            group=group,
+            period=row_period,
+            quantity=quantity,
+            revenue=revenue,
+            cost=cost,
+            margin=margin,
+            margin_percent=(margin / revenue * 100).quantize(Decimal('0.1')) if revenue else None,
+        ))
+    rows.sort(key=lambda row: -row.revenue)
+    if period:
+        rows.sort(key=lambda row: row.period)
+    return rows
+
+
+def rollup_margins(days=35, through=None):
+    """Rebuild MarginRollup for the ``days`` days ending ``through`` (default yesterday).
+
+    Orders count once delivered, which can be days after the line was
+    created, so each run rebuilds a trailing window rather than only the
+    newest day. The window also reaches back to the day after the last
+    rollup (or to the first sale, on the first run) so reports never skip
+    days between the rollup and the raw tables. Returns the number of
+    rollup rows written.
+    """
+    through = through or timezone.localdate() - timedelta(days=1)
+    start = through - timedelta(days=days - 1)
+    last = rolled_through()
+    if last is None:
+        first = [
+            queryset.order_by('created_at').values_list('created_at', flat=True).first()
+            for _, queryset, _, _ in _sources()
+        ]
+        first = [timezone.localdate(value) for value in first if value]
+        if first:
+            start = min(start, *first)
+    else:
+        start = min(start, last + timedelta(days=1))
+    rollups = {}
+    for source, queryset, revenue, cost in _sources():
+        rows = (
+            queryset.filter(created_at__gte=_day_start(start), created_at__lt=_day_start(through + timedelta(days=1)))
+            .annotate(day=TruncDate('created_at'))
+            .values('day', 'product_id')
+            .annotate(
+                units=Sum('quantity'),
+                revenue_total=Sum(ExpressionWrapper(revenue, output_field=_MONEY)),
+                cost_total=Sum(ExpressionWrapper(cost, output_field=_MONEY)),
+            )
+            .order_by()
+        )
+        for row in rows:
+            # A day split by the archive cutoff has rows in both tables
+            key = (row['day'], source, row['product_id'])
+            rollup = rollups.get(key)
+            if rollup is None:
+                rollups[key] = MarginRollup(
+                    day=row['day'], source=source, product_id=row['product_id'], quantity=row['units'],
+                    revenue=row['revenue_total'] or 0, cost=row['cost_total'] or 0,
+                )
+            else:
+                rollup.quantity += row['units']
+                rollup.revenue += row['revenue_total'] or 0
+                rollup.cost += row['cost_total'] or 0
+    with transaction.atomic():
+        MarginRollup.objects.filter(day__gte=start, day__lte=through).delete()
+        MarginRollup.objects.bulk_create(rollups.values(), batch_size=2000)
+    return len(rollups)
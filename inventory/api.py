@@ -1,20 +1,243 @@
-from rest_framework import viewsets, filters
+from django.db.models import Count, Q
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework import viewsets, filters, serializers
+from rest_framework.decorators import action, api_view
+from rest_framework.exceptions import NotFound
 from rest_framework.permissions import IsAuthenticated
-from .models import Category, Product
-from .serializers import CategorySerializer, ProductSerializer
+from rest_framework import status
+from rest_framework.response import Response
+from . import catalog, ledger, locations
+from .families import VariantMatrix, family_summaries, variant_matrix
+from .models import Category, Customer, Location, Product, ProductFamily
+from .concurrency import VersionConflict
+from .analytics import margin_report as build_margin_report, rolled_through
+from .repricing import apply_repricing, preview
+from .routers import replica_reads
+from .serializers import (
+    CategorySerializer, ProductSerializer, OrderStatusTransitionSerializer, MarginReportQuerySerializer,
+    MarginRowSerializer, ProductFamilySerializer, VariantCellSerializer, ScanSellSerializer,
+    RepricingSerializer, RulePreviewSerializer, CustomerSerializer, LocationSerializer, StockTransferSerializer,
+    resolve_location,
+)
+from .idempotency import idempotent
+from .services import InsufficientStock, sell_scanned, transfer_stock, transition_orders
+from .throttling import throttled
 
 class CategoryViewSet(viewsets.ModelViewSet):
-    queryset = Category.objects.all().order_by('name')
+    queryset = Category.objects.annotate(
+        active_product_count=Count('products', filter=Q(products__is_active=True))
+    ).order_by('name')
     serializer_class = CategorySerializer
     permission_classes = [IsAuthenticated]
     filter_backends = [filters.SearchFilter, filters.OrderingFilter]
     search_fields = ['name', 'description']
     ordering_fields = ['name', 'id']
+    replica_reads = True
 
 class ProductViewSet(viewsets.ModelViewSet):
-    queryset = Product.objects.select_related('category').all().order_by('name')
+    queryset = Product.objects.all().order_by('name')
     serializer_class = ProductSerializer
     permission_classes = [IsAuthenticated]
     filter_backends = [filters.SearchFilter, filters.OrderingFilter]
     search_fields = ['name', 'sku', 'color']
     ordering_fields = ['name', 'price', 'stock', 'created_at']
+    replica_reads = True
+
+    def get_queryset(self):
+        # ?location=<code> lists the products held there, with their units there as location_stock
+        queryset = super().get_queryset()
+        if self.action == 'list' and 'location' in self.request.query_params:
+            try:
+                location = resolve_location(self.request.query_params['location'])
+            except serializers.ValidationError as exc:
+                raise NotFound(exc.detail[0])
+            if location is not None:
+                queryset = locations.at_location(queryset, location)
+        return queryset
+
+    def update(self, request, *args, **kwargs):
+        try:
+            return super().update(request, *args, **kwargs)
+        except VersionConflict as exc:
+            return Response({'detail': str(exc)}, status=status.HTTP_409_CONFLICT)
+
+    @action(detail=True, methods=['get'], url_path='stock-at')
+    def stock_at(self, request, pk=None):
+        """Stock as it was at ``?at=<ISO 8601 datetime>``, from the ledger"""
+        try:
+            at = parse_datetime(request.query_params.get('at', ''))
+        except ValueError:
+            at = None
+        if at is None:
+            return Response({'at': ['Enter an ISO 8601 date and time.']}, status=status.HTTP_400_BAD_REQUEST)
+        if timezone.is_naive(at):
+            at = timezone.make_aware(at)
+        product = self.get_object()
+        return Response({'id': product.pk, 'sku': product.sku, 'at': at, 'stock': ledger.stock_at(product.pk, at)})
+
+class LocationViewSet(viewsets.ReadOnlyModelViewSet):
+    queryset = Location.objects.filter(is_active=True).order_by('name')
+    serializer_class = LocationSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = None
+
+class ProductFamilyViewSet(viewsets.ReadOnlyModelViewSet):
+    """Families with aggregated stock and price range; detail returns the size x color matrix"""
+    queryset = family_summaries().order_by('name')
+    serializer_class = ProductFamilySerializer
+    permission_classes = [IsAuthenticated]
+    filter_backends = [filters.SearchFilter, filters.OrderingFilter]
+    search_fields = ['name', 'sku_prefix']
+    ordering_fields = ['name', 'total_stock', 'min_price']
+    replica_reads = True
+
+    def retrieve(self, request, *args, **kwargs):
+        matrix = variant_matrix(kwargs['pk'])
+        if matrix is None:
+            family = get_object_or_404(ProductFamily.objects.select_related('category'), pk=kwargs['pk'])
+            matrix = VariantMatrix(family=family, sizes=[], colors=[], rows=[])
+        family = matrix.family
+        return Response({
+            'id': family.pk,
+            'name': family.name,
+            'sku_prefix': family.sku_prefix,
+            'category': family.category_id,
+            'category_name': family.category.name,
+            'sizes': matrix.sizes,
+            'colors': matrix.colors,
+            'matrix': [
+                {
+                    'size': size,
+                    'cells': [VariantCellSerializer(cell).data if cell else None for cell in cells],
+                }
+                for size, cells in matrix.rows
+            ],
+        })
+
+@api_view(['POST'])
+@throttled('order-transition')
+def order_status_transition(request):
+    """Move a batch of orders to one status; orders that may not move are skipped"""
+    serializer = OrderStatusTransitionSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    result = transition_orders(
+        serializer.validated_data['order_ids'], serializer.validated_data['status'], user=request.user,
+    )
+    return Response({'status': serializer.validated_data['status'], **result._asdict()})
+
+def _scan_payload(sku, entry):
+    return {'id': entry.id, 'sku': sku, 'name': entry.name, 'price': str(entry.price)}
+
+@api_view(['GET'])
+def scan_lookup(request, sku):
+    """Exact SKU lookup for POS scanners; answered from the in-process scan map when warm"""
+    entry = catalog.scan_entry(sku)
+    if entry is None:
+        return Response({'detail': f'No active product with SKU {sku}.'}, status=status.HTTP_404_NOT_FOUND)
+    return Response(_scan_payload(sku, entry))
+
+@api_view(['GET'])
+def customer_lookup(request, phone):
+    """A returning customer by phone number, to autofill the order form; one unique-index lookup"""
+    normalized = Customer.normalize_phone(phone)
+    customer = Customer.objects.filter(phone=normalized).first() if normalized else None
+    if customer is None:
+        return Response({'detail': f'No customer with phone {phone}.'}, status=status.HTTP_404_NOT_FOUND)
+    return Response(CustomerSerializer(customer).data)
+
+@api_view(['POST'])
+@throttled('scan-sell')
+@idempotent('scan-sell')
+def scan_sell(request):
+    """Resolve a scanned SKU, take it out of stock and record the sale in one call"""
+    serializer = ScanSellSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    sku = serializer.validated_data['sku']
+    quantity = serializer.validated_data['quantity']
+    entry = catalog.scan_entry(sku)
+    if entry is None:
+        return Response({'detail': f'No active product with SKU {sku}.'}, status=status.HTTP_404_NOT_FOUND)
+    try:
+        result = sell_scanned(entry, quantity, user=request.user, location=serializer.validated_data['location'])
+    except InsufficientStock as exc:
+        return Response(
+            {'detail': str(exc), 'available': exc.available, **_scan_payload(sku, entry)},
+            status=status.HTTP_409_CONFLICT,
+        )
+    return Response({
+        **_scan_payload(sku, entry),
+        'sale': result.sale.pk,
+        'quantity': quantity,
+        'total_amount': str(result.sale.total_amount),
+        'stock': result.stock,
+    }, status=status.HTTP_201_CREATED)
+
+@api_view(['POST'])
+@throttled('stock-transfer')
+@idempotent('stock-transfer')
+def stock_transfer(request):
+    """Move units of a product from one location to another; the product's total stays the same"""
+    serializer = StockTransferSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    data = serializer.validated_data
+    try:
+        result = transfer_stock(data['product'], data['source'], data['destination'], data['quantity'], user=request.user)
+    except InsufficientStock as exc:
+        return Response({'detail': str(exc), 'available': exc.available}, status=status.HTTP_409_CONFLICT)
+    return Response({
+        'product': data['product'].pk,
+        'quantity': data['quantity'],
+        'source': {'code': (data['source'] or locations.default_location()).code, 'stock': result.source_stock},
+        'destination': {
+            'code': (data['destination'] or locations.default_location()).code, 'stock': result.destination_stock,
+        },
+    }, status=status.HTTP_201_CREATED)
+
+@replica_reads
+@api_view(['GET'])
+def margin_report(request):
+    """Revenue, cost of goods and gross margin grouped by category, size, color or product"""
+    query = MarginReportQuerySerializer(data=request.query_params)
+    query.is_valid(raise_exception=True)
+    params = query.validated_data
+    rows = build_margin_report(
+        group_by=params['group_by'],
+        period=params['period'] or None,
+        start=params['start'],
+        end=params['end'],
+        sources=(params['source'],) if params['source'] else ('sale', 'order'),
+        include_archive=params['include_archive'],
+    )
+    return Response({
+        'group_by': params['group_by'],
+        'period': params['period'] or None,
+        'rolled_through': rolled_through(),
+        'results': MarginRowSerializer(rows, many=True).data,
+    })
+
+@api_view(['POST'])
+def repricing_preview(request):
+    """What each rule would change, against current prices; changes nothing"""
+    serializer = RepricingSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    previews = [preview(rule) for rule in serializer.validated_data['rules']]
+    return Response({'rules': RulePreviewSerializer(previews, many=True).data})
+
+@api_view(['POST'])
+@throttled('repricing')
+@idempotent('repricing')
+def repricing_apply(request):
+    """Apply the rules in order, in one transaction, and return the run"""
+    serializer = RepricingSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    repricing = apply_repricing(
+        serializer.validated_data['rules'], user=request.user, note=serializer.validated_data['note']
+    )
+    return Response({
+        'id': repricing.pk,
+        'note': repricing.note,
+        'change_count': repricing.change_count,
+        'rules': repricing.rules,
+    }, status=status.HTTP_201_CREATED)
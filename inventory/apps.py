@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class InventoryConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'inventory'
+
+    def ready(self):
+        # Connect the catalog cache invalidation, metrics, unread counter, stock ledger and webhook signals
+        from . import catalog, ledger, metrics, notifications, webhooks  # noqa: F401
@@ -0,0 +1,86 @@
+"""
+Move old sales and finished orders out of the live tables.
+
+Rows older than a cutoff are copied into ``ArchivedSale``, ``ArchivedOrder``
+and ``ArchivedOrderItem`` (keeping their ids) and deleted from the live
+tables, one bounded batch per transaction. A run can stop after any batch,
+or be interrupted, and the next run carries on from what is left; nothing is
+ever half-moved. Only delivered and cancelled orders are archived, and
+notifications about an archived order are deleted with it.
+
+Margin rollups and reports read the archive tables alongside the live ones,
+so moving rows does not change any figure.
+"""
+from django.db import transaction
+from django.utils import timezone
+
+from . import notifications
+from .models import ArchivedOrder, ArchivedOrderItem, ArchivedSale, Order, OrderItem, Sale
+
+ARCHIVABLE_ORDER_STATUSES = ('delivered', 'cancelled')
+
+ORDER_FIELDS = [
+    'id', 'order_number', 'customer_id', 'customer_name', 'customer_email', 'customer_phone', 'customer_address',
+    'status', 'total_amount', 'created_at', 'updated_at', 'notes',
+]
+ORDER_ITEM_FIELDS = ['id', 'order_id', 'product_id', 'quantity', 'unit_price', 'unit_cost', 'created_at']
+SALE_FIELDS = [
+    'id', 'product_id', 'quantity', 'unit_price', 'total_amount', 'unit_cost', 'location_id', 'created_at',
+    'created_by_id',
+]
+
+
+def archivable_orders(cutoff):
+    return Order.objects.filter(created_at__lt=cutoff, status__in=ARCHIVABLE_ORDER_STATUSES)
+
+
+def archivable_sales(cutoff):
+    return Sale.objects.filter(created_at__lt=cutoff)
+
+
+def _batches(queryset, batch_size, max_batches, move):
+    moved = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        with transaction.atomic():
+            pks = list(queryset.order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            move(pks)
+        moved += len(pks)
+        batches += 1
+    return moved
+
+
+def _move_orders(pks):
+    now = timezone.now()
+    ArchivedOrder.objects.bulk_create([
+        ArchivedOrder(archived_at=now, **row)
+        for row in Order.objects.filter(pk__in=pks).values(*ORDER_FIELDS)
+    ])
+    ArchivedOrderItem.objects.bulk_create([
+        ArchivedOrderItem(**row)
+        for row in OrderItem.objects.filter(order_id__in=pks).values(*ORDER_ITEM_FIELDS)
+    ])
+    # Deleting the orders cascades to their items and notifications
+    Order.objects.filter(pk__in=pks).delete()
+    notifications.recount_unread()
+
+
+def _move_sales(pks):
+    now = timezone.now()
+    ArchivedSale.objects.bulk_create([
+        ArchivedSale(archived_at=now, **row)
+        for row in Sale.objects.filter(pk__in=pks).values(*SALE_FIELDS)
+    ])
+    Sale.objects.filter(pk__in=pks).delete()
+
+
+def archive_orders(cutoff, batch_size=500, max_batches=None):
+    """Archive delivered and cancelled orders created before ``cutoff``; returns the count"""
+    return _batches(archivable_orders(cutoff), batch_size, max_batches, _move_orders)
+
+
+def archive_sales(cutoff, batch_size=500, max_batches=None):
+    """Archive sales recorded before ``cutoff``; returns the count"""
+    return _batches(archivable_sales(cutoff), batch_size, max_batches, _move_sales)
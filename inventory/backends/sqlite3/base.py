@@ -0,0 +1,49 @@
+"""
+SQLite backend with per-connection PRAGMAs and configurable transaction mode.
+
+Backports the ``init_command`` and ``transaction_mode`` OPTIONS that Django 5.1
+added to its SQLite backend, so the settings stay valid after an upgrade.
+"""
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.sqlite3 import base
+
+TRANSACTION_MODES = ('DEFERRED', 'IMMEDIATE', 'EXCLUSIVE')
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        # These are handled here and must not reach sqlite3.connect()
+        self.init_command = kwargs.pop('init_command', '') or ''
+        transaction_mode = kwargs.pop('transaction_mode', None)
+        if transaction_mode is not None:
+            transaction_mode = transaction_mode.upper()
+            if transaction_mode not in TRANSACTION_MODES:
+                raise ImproperlyConfigured(
+                    "settings.DATABASES is improperly configured. "
+                    f"transaction_mode must be one of {', '.join(TRANSACTION_MODES)}."
+                )
+        self.transaction_mode = transaction_mode
+        return kwargs
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for statement in self.init_command.split(';'):
+            statement = statement.strip()
+            if statement:
+                conn.execute(statement)
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        """Open atomic blocks with BEGIN IMMEDIATE/EXCLUSIVE when configured.
+
+        A deferred transaction that reads and then writes has to upgrade its
+        lock, and SQLite fails that upgrade with "database is locked" without
+        waiting on busy_timeout. Taking the write lock up front makes writers
+        queue on the busy handler instead.
+        """
+        if self.transaction_mode:
+            self.cursor().execute(f'BEGIN {self.transaction_mode}')
+        else:
+            super()._start_transaction_under_autocommit()
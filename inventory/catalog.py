@@ -0,0 +1,228 @@
+"""
+Two-tier cache for near-static catalog data (categories, locations, active products, SKUs).
+
+Lookups check a small per-process LRU first, then the shared Django cache, and
+only then the database. Every key embeds the catalog generation, a counter in
+the Django cache that any Product, Category or Location save/delete bumps, so
+a write invalidates both tiers without having to find old keys. Only a cache
+shared by the workers (Redis, with REDIS_URL set) carries that to all of
+them: with the default LocMemCache the counter is per process too, and other
+workers keep serving what they hold until it is ``CATALOG_CACHE_TIMEOUT``
+seconds old, in either tier.
+
+Nothing here holds stock, so stock movements leave the generation alone:
+saves of ``STOCK_FIELDS`` only skip the bump, and the bulk stock paths in
+``services`` and ``stocktake`` do not call it. Code that changes anything
+else with ``QuerySet.update()`` or bulk operations skips the model signals
+and must call ``bump_generation()`` itself.
+
+POS scans resolve one SKU at a time through ``scan_entry()``, a per-process
+map of SKU -> (id, name, price, ...) filled one indexed lookup at a time. It
+has its own generation, bumped only by writes that can change what a SKU
+resolves to, so stock movements from every sale do not empty it. Bulk code
+that changes SKUs, prices, costs, reorder thresholds or ``is_active`` must
+call ``bump_sku_generation()`` as well as ``bump_generation()``.
+
+A scanned SKU is also re-read once it is ``SCAN_CACHE_TIMEOUT`` seconds old.
+Generations only reach other workers through a shared cache; with the
+per-process LocMemCache the timeout is what bounds how long another worker
+sells at a price changed elsewhere.
+"""
+from collections import OrderedDict, namedtuple
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Category, Location, Product
+
+GENERATION_KEY = 'catalog:generation'
+SKU_GENERATION_KEY = 'catalog:sku_generation'
+# Fields a stock movement saves; such saves leave every cached entry valid
+STOCK_FIELDS = frozenset({'stock', 'located_stock', 'updated_at', 'version'})
+
+CachedCategory = namedtuple('CachedCategory', 'id name')
+CachedLocation = namedtuple('CachedLocation', 'id code name is_default')
+CachedProduct = namedtuple('CachedProduct', 'name sku price')
+ScanEntry = namedtuple('ScanEntry', 'id name price cost reorder_threshold')
+
+_local = OrderedDict()
+_lock = threading.Lock()
+_stats = {'local_hits': 0, 'shared_hits': 0, 'misses': 0, 'scan_hits': 0, 'scan_misses': 0}
+
+_scan = OrderedDict()
+_scan_generation = None
+
+
+def _generation(key=GENERATION_KEY):
+    generation = cache.get(key)
+    if generation is None:
+        # Start from the clock rather than 1 so an evicted counter never
+        # comes back at a value older keys were stored under
+        cache.add(key, int(time.time() * 1000), timeout=None)
+        generation = cache.get(key)
+    return generation
+
+
+def bump_generation(key=GENERATION_KEY):
+    """Invalidate every cached catalog entry"""
+    _bump_generation(key)
+    if transaction.get_connection().in_atomic_block:
+        # Another worker may rebuild from pre-commit rows in the meantime
+        transaction.on_commit(lambda: _bump_generation(key))
+
+
+def bump_sku_generation():
+    """Invalidate every process's SKU scan map"""
+    bump_generation(SKU_GENERATION_KEY)
+
+
+def _bump_generation(key=GENERATION_KEY):
+    try:
+        cache.incr(key)
+    except ValueError:
+        _generation(key)
+
+
+def _cached(name, build):
+    key = f'catalog:{_generation()}:{name}'
+    with _lock:
+        if key in _local and _local[key][1] > time.monotonic():
+            _local.move_to_end(key)
+            _stats['local_hits'] += 1
+            return _local[key][0]
+
+    value = cache.get(key)
+    if value is None:
+        value = build()
+        cache.set(key, value, settings.CATALOG_CACHE_TIMEOUT)
+        counter = 'misses'
+    else:
+        counter = 'shared_hits'
+
+    with _lock:
+        _stats[counter] += 1
+        _local[key] = (value, time.monotonic() + settings.CATALOG_CACHE_TIMEOUT)
+        _local.move_to_end(key)
+        while len(_local) > settings.CATALOG_CACHE_LOCAL_SIZE:
+            _local.popitem(last=False)
+    return value
+
+
+def categories():
+    """All categories as (id, name) tuples, ordered by name"""
+    return _cached('categories', lambda: [
+        CachedCategory(*row) for row in Category.objects.order_by('name').values_list('id', 'name')
+    ])
+
+
+def category_names():
+    """Map of category id -> name"""
+    return _cached('category_names', lambda: dict(
+        Category.objects.values_list('id', 'name')
+    ))
+
+
+def locations():
+    """Active locations as CachedLocation tuples, ordered by name"""
+    return _cached('locations', lambda: [
+        CachedLocation(*row) for row in Location.objects.filter(is_active=True).order_by('name')
+        .values_list('id', 'code', 'name', 'is_default')
+    ])
+
+
+def location(code):
+    """The active location with this code, or None"""
+    return next((location for location in locations() if location.code == code), None)
+
+
+def product_map():
+    """Map of active product id -> (name, sku, price), in name order"""
+    return _cached('products', lambda: {
+        pk: CachedProduct(name, sku, price)
+        for pk, name, sku, price in Product.objects.filter(is_active=True)
+        .order_by('name')
+        .values_list('id', 'name', 'sku', 'price')
+    })
+
+
+def sku_to_id(sku):
+    """Resolve an exact SKU of an active product to its id, or None"""
+    skus = _cached('skus', lambda: dict(
+        Product.objects.filter(is_active=True).values_list('sku', 'id')
+    ))
+    return skus.get(sku)
+
+
+def scan_entry(sku):
+    """The active product with exactly this SKU as a ScanEntry, or None.
+
+    Hits are served from this process without touching the database; a miss,
+    or an entry older than ``SCAN_CACHE_TIMEOUT``, is one lookup on the
+    unique SKU index. Unknown SKUs are remembered too,
+    so a misread barcode scanned repeatedly stays cheap.
+    """
+    global _scan_generation
+    generation = _generation(SKU_GENERATION_KEY)
+    with _lock:
+        if generation != _scan_generation:
+            _scan.clear()
+            _scan_generation = generation
+        if sku in _scan:
+            entry, expires = _scan[sku]
+            if expires > time.monotonic():
+                _scan.move_to_end(sku)
+                _stats['scan_hits'] += 1
+                return entry
+
+    row = next(iter(
+        Product.objects.filter(sku=sku, is_active=True).order_by()
+        .values_list('id', 'name', 'price', 'cost', 'reorder_threshold')[:1]
+    ), None)
+    entry = ScanEntry(*row) if row else None
+
+    with _lock:
+        _stats['scan_misses'] += 1
+        # Skip storing if a write moved the generation on while we queried
+        if generation == _scan_generation:
+            _scan[sku] = (entry, time.monotonic() + settings.SCAN_CACHE_TIMEOUT)
+            _scan.move_to_end(sku)
+            while len(_scan) > settings.SCAN_CACHE_SIZE:
+                _scan.popitem(last=False)
+    return entry
+
+
+def stats():
+    """Hit/miss counters for this process, for sizing the local tier"""
+    with _lock:
+        return {
+            **_stats,
+            'local_entries': len(_local),
+            'local_size': settings.CATALOG_CACHE_LOCAL_SIZE,
+            'scan_entries': len(_scan),
+        }
+
+
+def clear_local():
+    with _lock:
+        _local.clear()
+        _scan.clear()
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Location)
+@receiver(post_delete, sender=Location)
+def invalidate_catalog(sender, **kwargs):
+    update_fields = kwargs.get('update_fields')
+    if sender is Product and update_fields and update_fields <= STOCK_FIELDS:
+        return
+    bump_generation()
+    if sender is Product:
+        bump_sku_generation()
@@ -0,0 +1,67 @@
+"""
+Optimistic concurrency for products and orders.
+
+Both carry a ``version`` that every edit moves forward. An edit form or API
+request carries the version it was loaded at, and ``save_changes()`` writes
+only the fields it changed with ``UPDATE ... WHERE id = %s AND version = %s``.
+No row updated means someone else saved the row in between, and
+``VersionConflict`` is raised for the caller to show as a form error or a
+409 instead of silently writing over their change. Nothing is locked between
+loading a form and submitting it.
+
+Stock movements (sales, order lines, stock takes, and
+``Product.reduce_stock()`` behind the sell page and order lines) stay
+``F()`` deltas guarded by a stock condition and do not move the version, so
+the sell path is unchanged and a sale made while a product is open for
+editing is neither lost nor reported as a conflict: an edit that leaves
+stock alone never writes it. Bulk writes to edited fields,
+such as order status transitions, move the version with ``F('version') + 1``.
+"""
+from django.db import router
+from django.db.models import F
+from django.db.models.signals import post_save
+from django.utils import timezone
+
+
+class VersionConflict(Exception):
+    def __init__(self, instance):
+        self.instance = instance
+        super().__init__(
+            f'This {instance._meta.verbose_name} was changed by someone else since you opened it. '
+            f'Reload it and apply your changes again.'
+        )
+
+
+def save_changes(instance, fields, expect=None):
+    """Write ``fields`` of ``instance`` if its row is still at ``instance.version``.
+
+    ``expect`` adds ``{field: value}`` the row must still hold, for fields
+    that change without moving the version. Raises ``VersionConflict`` if the
+    row has moved on; otherwise bumps ``instance.version`` and sends
+    ``post_save`` with ``update_fields`` so cache invalidation still runs.
+    Returns False without a query when nothing changed.
+    """
+    model = type(instance)
+    opts = instance._meta
+    changed = {opts.get_field(name) for name in fields if name != 'version'}
+    if not changed:
+        return False
+    now = timezone.now()
+    for field in opts.concrete_fields:
+        if getattr(field, 'auto_now', False):
+            setattr(instance, field.attname, now)
+            changed.add(field)
+
+    values = {field.attname: getattr(instance, field.attname) for field in changed}
+    updated = model._default_manager.filter(pk=instance.pk, version=instance.version, **(expect or {})).update(
+        version=F('version') + 1, **values
+    )
+    if not updated:
+        raise VersionConflict(instance)
+    instance.version += 1
+    post_save.send(
+        sender=model, instance=instance, created=False, raw=False,
+        using=router.db_for_write(model, instance=instance),
+        update_fields=frozenset(field.name for field in changed) | {'version'},
+    )
+    return True
@@ -0,0 +1,55 @@
+"""
+Product families: one row per garment instead of one per size/color variant.
+
+``family_summaries()`` annotates families with their variants' stock, price
+range and low-stock count in one grouped query. ``variant_matrix()`` loads a
+family's variants, with the family and its category, in one query and lays
+them out as a size x color grid.
+"""
+from collections import namedtuple
+
+from django.db.models import Count, F, Max, Min, Q, Sum
+from django.db.models.functions import Coalesce
+
+from .models import Product, ProductFamily
+
+_SIZE_ORDER = {code: i for i, (code, _) in enumerate(Product.SIZES)}
+
+VariantMatrix = namedtuple('VariantMatrix', 'family sizes colors rows')
+
+
+def family_summaries(queryset=None):
+    """Families annotated with variant_count, total_stock, min/max price and low_stock_count"""
+    active = Q(variants__is_active=True)
+    queryset = queryset if queryset is not None else ProductFamily.objects.all()
+    return queryset.select_related('category').annotate(
+        variant_count=Count('variants', filter=active),
+        total_stock=Coalesce(Sum('variants__stock', filter=active), 0),
+        min_price=Min('variants__price', filter=active),
+        max_price=Max('variants__price', filter=active),
+        low_stock_count=Count(
+            'variants',
+            filter=active & Q(variants__reorder_threshold__gt=0, variants__stock__lte=F('variants__reorder_threshold')),
+        ),
+    )
+
+
+def _size_key(size):
+    return (_SIZE_ORDER.get(size, len(_SIZE_ORDER)), size)
+
+
+def variant_matrix(family_id):
+    """The family's variants as rows of sizes by columns of colors, or None if it has none.
+
+    Each cell is the variant Product for that size and color, or None.
+    """
+    variants = list(
+        Product.objects.filter(family_id=family_id).select_related('family__category').order_by('pk')
+    )
+    if not variants:
+        return None
+    sizes = sorted({variant.size for variant in variants}, key=_size_key)
+    colors = sorted({variant.color for variant in variants}, key=str.lower)
+    cells = {(variant.size, variant.color): variant for variant in variants}
+    rows = [(size, [cells.get((size, color)) for color in colors]) for size in sizes]
+    return VariantMatrix(family=variants[0].family, sizes=sizes, colors=colors, rows=rows)
@@ -0,0 +1,169 @@
+"""
+The dashboard's figures, each from one query that reads nothing from another.
+
+``queries(location)`` maps every name the dashboard template reads to a
+function running the query behind it. Since none depends on another, they
+can run in any order or all at once:
+
+* ``views.dashboard`` runs them one after another with ``evaluate()`` and
+  renders the page when the last returns, so it takes the sum of them all.
+* ``views.dashboard_live``, for ASGI servers, sends the page shell first and
+  starts them together with ``stream()``. Each page section (``SECTIONS``) is
+  sent as soon as the figures it shows are in, with a line of script that
+  puts it in place of its placeholder. The page takes as long as its slowest
+  query, and the stock cards do not wait on the sales aggregates.
+
+``stream()`` runs each query on a pool of ``DASHBOARD_QUERY_THREADS`` worker
+threads. Every worker holds a database connection of its own, opened and
+closed around each query under the ``CONN_MAX_AGE`` rules a request follows,
+so the pool size caps the connections the dashboard adds. With one thread
+the queries run one after another: the shell still comes first, but the
+page takes as long as the sync one.
+Router state such as ``replica_reads`` is copied to the workers with the
+request's context.
+
+Under WSGI the page still works, but Django reads the whole stream before
+sending any of it, so nothing arrives early.
+"""
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+import asyncio
+import contextvars
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections
+from django.db.models import F, Sum
+from django.template.loader import render_to_string
+
+from . import locations
+from .models import Product, Sale
+
+# A page section, rendered from dashboard/<name>.html once its figures are in
+Section = namedtuple('Section', 'name figures')
+
+SECTIONS = (
+    Section('cards', ('total_products', 'total_stock', 'inventory_value', 'low_stock_count')),
+    Section('low_stock', ('low_stock_count', 'low_stock_items')),
+    Section('sales', ('total_sales_count', 'total_sales_amount', 'recent_sales')),
+    Section('recent_items', ('recent_items',)),
+    Section('overview', ('total_products', 'low_stock_count')),
+)
+
+# Where dashboard.html, rendered as a shell, takes the streamed sections
+STREAM_MARKER = '<!-- dashboard sections -->'
+
+_pools = {}
+
+
+def _unless_missing(query, default):
+    """``query``, reading as ``default`` while the sales table is not migrated yet"""
+    def run():
+        try:
+            return query()
+        except DatabaseError:
+            return default
+    return run
+
+
+def queries(location=None):
+    """``{name: query}`` for the dashboard at ``location``, or across locations for None"""
+    # With a location, stock figures are its units and sales are the ones made there
+    products = Product.objects.all()
+    sales = Sale.objects.all()
+    stock = 'stock'
+    if location:
+        products = locations.at_location(products, location)
+        sales = locations.sales_at(sales, location)
+        stock = 'location_stock'
+    low_stock = products.filter(reorder_threshold__gt=0, **{f'{stock}__lte': F('reorder_threshold')})
+
+    return {
+        'total_products': products.filter(is_active=True).count,
+        'total_stock': lambda: products.aggregate(s=Sum(stock))['s'] or 0,
+        'inventory_value': lambda: products.aggregate(v=Sum(F('price') * F(stock)))['v'] or Decimal('0.00'),
+        'low_stock_count': low_stock.count,
+        'low_stock_items': lambda: list(low_stock.select_related('category').order_by(stock)[:10]),
+        'recent_items': lambda: list(products.select_related('category').order_by('-created_at')[:10]),
+        'total_sales_count': _unless_missing(sales.count, 0),
+        'total_sales_amount': _unless_missing(
+            lambda: sales.aggregate(v=Sum('total_amount'))['v'] or Decimal('0.00'), Decimal('0.00'),
+        ),
+        'recent_sales': _unless_missing(
+            lambda: list(sales.select_related('product').order_by('-created_at')[:5]), [],
+        ),
+    }
+
+
+def evaluate(location=None):
+    """Every figure, one query after another"""
+    return {name: query() for name, query in queries(location).items()}
+
+
+def _pool():
+    threads = max(settings.DASHBOARD_QUERY_THREADS, 1)
+    if threads not in _pools:
+        _pools[threads] = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='dashboard')
+    return _pools[threads]
+
+
+def _run(query):
+    # The worker's connection is kept or closed as a request's would be
+    close_old_connections()
+    try:
+        return query()
+    finally:
+        close_old_connections()
+
+
+async def _offload(query):
+    # Never thread-sensitive: under ASGI the thread Django ran the view's sync
+    # code on may be gone by the time the response is read
+    return await sync_to_async(_run, thread_sensitive=False, executor=_pool())(query)
+
+
+def _fill(section, figures, location):
+    html = render_to_string(f'dashboard/{section.name}.html', {
+        **{name: figures[name] for name in section.figures},
+        'location': location,
+    })
+    return (
+        f'<template id="section-{section.name}-content">{html}</template>'
+        f'<script>fillSection("{section.name}")</script>\n'
+    )
+
+
+def stream(head, tail, location=None):
+    """The page as an async iterator: ``head`` and ``tail`` are the shell before and after ``STREAM_MARKER``.
+
+    The queries start on the first read, on the loop that reads the
+    response: under WSGI that is a loop of its own, not the view's. They run
+    in the context the view had, which the middleware has reset by then.
+    """
+    return _sections(contextvars.copy_context(), queries(location), head, tail, location)
+
+
+async def _sections(context, queries, head, tail, location):
+    # Context.run() makes each task copy the view's context, not this one's
+    pending = {name: context.run(asyncio.ensure_future, _offload(query)) for name, query in queries.items()}
+    try:
+        yield head
+        figures = {}
+        waiting = list(SECTIONS)
+        while waiting:
+            done, _ = await asyncio.wait(
+                [task for name, task in pending.items() if name not in figures],
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            for name, task in pending.items():
+                if task in done:
+                    figures[name] = task.result()
+            for section in [section for section in waiting if figures.keys() >= set(section.figures)]:
+                waiting.remove(section)
+                yield _fill(section, figures, location)
+        yield tail
+    finally:
+        # The client went away or a query failed: stop what is still running
+        for task in pending.values():
+            task.cancel()
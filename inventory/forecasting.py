@@ -0,0 +1,190 @@
+"""
+Sales-velocity forecasting and reorder suggestions for the whole catalog.
+
+History is read with two grouped queries (till sales and order lines of
+non-cancelled orders, summed per product per day) straight into NumPy arrays;
+every statistic is then computed for all products at once with ``bincount``,
+so the cost grows with the number of product-days that sold something, not
+with the number of products times a per-product query. Suggestions are
+written with one upsert and can optionally replace ``reorder_threshold`` of
+the products that sold in the window.
+
+For each active product:
+
+* ``daily_velocity`` is the mean units sold per day over the window,
+  counting days without sales as zero.
+* ``weekday_factors`` scale that mean for Monday..Sunday.
+* ``reorder_point`` is the expected demand over the lead time, using the
+  weekday factors of the days it covers, plus ``z * std * sqrt(lead_time)``
+  of safety stock for the requested service level.
+* ``reorder_quantity`` tops stock up to cover the lead time plus one review
+  period, plus the same safety stock.
+"""
+from collections import namedtuple
+from datetime import datetime, time, timedelta
+from statistics import NormalDist
+
+import numpy as np
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from . import catalog
+from .models import OrderItem, Product, ReorderSuggestion, Sale
+
+ForecastResult = namedtuple('ForecastResult', 'products selling suggestions thresholds_updated')
+Forecast = namedtuple(
+    'Forecast', 'velocity std weekday_factors days_of_cover reorder_point reorder_quantity'
+)
+
+
+def _daily_rows(queryset, start):
+    # A range on the aware local midnight can use the created_at index;
+    # created_at__date would convert every row's timestamp first
+    since = timezone.make_aware(datetime.combine(start, time.min))
+    return (
+        queryset.filter(created_at__gte=since)
+        .annotate(day=TruncDate('created_at'))
+        .values('product_id', 'day')
+        .annotate(units=Sum('quantity'))
+        .order_by()
+        .values_list('product_id', 'day', 'units')
+    )
+
+
+def load_history(start):
+    """Units sold per (product, day) since ``start`` as three parallel arrays"""
+    rows = list(_daily_rows(Sale.objects.all(), start))
+    rows += _daily_rows(OrderItem.objects.exclude(order__status='cancelled'), start)
+    count = len(rows)
+    product_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=count)
+    days = np.fromiter((row[1].toordinal() for row in rows), dtype=np.int64, count=count)
+    units = np.fromiter((row[2] for row in rows), dtype=np.float64, count=count)
+    return product_ids, days - start.toordinal(), units
+
+
+def compute(product_ids, stock, sale_product_ids, sale_days, sale_units, *, start, days,
+            lead_time, review_days, service_level):
+    """Forecast every product in ``product_ids`` (sorted) from per-day sales arrays.
+
+    ``sale_days`` are offsets from ``start``; a product and day may appear more
+    than once (one row per source) and are summed. Returns a ``Forecast`` of
+    arrays aligned with ``product_ids``.
+    """
+    n = len(product_ids)
+    # Drop sales of products that are not being forecast (inactive or deleted)
+    pidx = np.minimum(np.searchsorted(product_ids, sale_product_ids), max(n - 1, 0))
+    known = (sale_days >= 0) & (sale_days < days)
+    known &= product_ids[pidx] == sale_product_ids if n else False
+    pidx, sale_days, sale_units = pidx[known], sale_days[known], sale_units[known]
+
+    # Merge rows for the same product-day so the variance sees daily totals
+    cells, inverse = np.unique(pidx * days + sale_days, return_inverse=True)
+    daily = np.bincount(inverse, weights=sale_units, minlength=len(cells))
+    cell_pidx = cells // days
+    cell_weekday = (start.weekday() + cells % days) % 7
+
+    total = np.bincount(cell_pidx, weights=daily, minlength=n)
+    velocity = total / days
+    variance = np.bincount(cell_pidx, weights=daily * daily, minlength=n) / days - velocity ** 2
+    std = np.sqrt(np.maximum(variance, 0.0))
+
+    weekday_counts = np.bincount((start.weekday() + np.arange(days)) % 7, minlength=7)
+    weekday_mean = np.bincount(cell_pidx * 7 + cell_weekday, weights=daily, minlength=n * 7).reshape(n, 7)
+    weekday_mean /= np.maximum(weekday_counts, 1)
+    selling = velocity > 0
+    factors = np.ones((n, 7))
+    factors[selling] = weekday_mean[selling] / velocity[selling, None]
+
+    # The days a reorder placed tomorrow has to cover, as weekdays
+    today = start + timedelta(days=days - 1)
+    horizon = (today.weekday() + 1 + np.arange(lead_time + review_days)) % 7
+    lead_demand = velocity * factors[:, horizon[:lead_time]].sum(axis=1)
+    cycle_demand = velocity * factors[:, horizon].sum(axis=1)
+    safety = NormalDist().inv_cdf(service_level) * std * np.sqrt(lead_time)
+
+    stock = np.asarray(stock, dtype=np.float64)
+    with np.errstate(divide='ignore'):
+        days_of_cover = np.where(selling, stock / np.where(selling, velocity, 1.0), np.nan)
+    return Forecast(
+        velocity=velocity,
+        std=std,
+        weekday_factors=factors,
+        days_of_cover=days_of_cover,
+        reorder_point=np.ceil(lead_demand + safety).astype(np.int64),
+        reorder_quantity=np.maximum(np.ceil(cycle_demand + safety - stock), 0).astype(np.int64),
+    )
+
+
+def forecast_reorders(days=90, lead_time=7, review_days=7, service_level=0.95,
+                      apply_thresholds=False, batch_size=2000):
+    """Recompute ``ReorderSuggestion`` for every active product"""
+    if not 0 < service_level < 1:
+        raise ValueError('service_level must be between 0 and 1')
+    today = timezone.localdate()
+    start = today - timedelta(days=days - 1)
+
+    products = list(Product.objects.filter(is_active=True).order_by('pk').values_list('pk', 'stock'))
+    product_ids = np.fromiter((pk for pk, _ in products), dtype=np.int64, count=len(products))
+    stock = np.fromiter((s for _, s in products), dtype=np.int64, count=len(products))
+    forecast = compute(
+        product_ids, stock, *load_history(start),
+        start=start, days=days, lead_time=lead_time, review_days=review_days,
+        service_level=service_level,
+    )
+
+    now = timezone.now()
+    cover = forecast.days_of_cover
+    suggestions = [
+        ReorderSuggestion(
+            product_id=pk,
+            daily_velocity=velocity,
+            demand_std=std,
+            weekday_factors=[round(f, 3) for f in factors],
+            days_of_cover=None if np.isnan(days_cover) else days_cover,
+            reorder_point=point,
+            reorder_quantity=quantity,
+            computed_at=now,
+        )
+        for pk, velocity, std, factors, days_cover, point, quantity in zip(
+            product_ids.tolist(), forecast.velocity.tolist(), forecast.std.tolist(),
+            forecast.weekday_factors.tolist(), cover.tolist(),
+            forecast.reorder_point.tolist(), forecast.reorder_quantity.tolist(),
+        )
+    ]
+
+    thresholds_updated = 0
+    with transaction.atomic():
+        ReorderSuggestion.objects.exclude(product__is_active=True).delete()
+        ReorderSuggestion.objects.bulk_create(
+            suggestions,
+            batch_size=batch_size,
+            update_conflicts=True,
+            unique_fields=['product'],
+            update_fields=[
+                'daily_velocity', 'demand_std', 'weekday_factors', 'days_of_cover',
+                'reorder_point', 'reorder_quantity', 'computed_at',
+            ],
+        )
+        if apply_thresholds:
+            # A point of 0 means no sales in the window, which says nothing
+            # about a threshold set by hand or for a new product: keep those
+            thresholds_updated = Product.objects.filter(
+                is_active=True, reorder_suggestion__reorder_point__gt=0,
+            ).update(
+                reorder_threshold=Subquery(
+                    ReorderSuggestion.objects.filter(product=OuterRef('pk')).values('reorder_point')[:1]
+                ),
+                updated_at=now,
+                version=F('version') + 1,
+            )
+            # Scan entries carry the threshold sell_scanned() alerts on
+            catalog.bump_generation()
+            catalog.bump_sku_generation()
+    return ForecastResult(
+        products=len(suggestions),
+        selling=int(np.count_nonzero(forecast.velocity)),
+        suggestions=int(np.count_nonzero(forecast.reorder_quantity)),
+        thresholds_updated=thresholds_updated,
+    )
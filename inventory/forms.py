@@ -1,10 +1,60 @@
 from django import forms
+from django.core.exceptions import ValidationError
+from django.utils.functional import SimpleLazyObject
+import uuid
+from . import catalog
+from .concurrency import save_changes
 from .models import Product, Category, Order, OrderItem
 
-class ProductForm(forms.ModelForm):
+class VersionedModelForm(forms.ModelForm):
+    """Model form whose edits are saved with ``concurrency.save_changes()``.
+
+    The row's ``version`` travels in a hidden field, so saving a form opened
+    before someone else's save raises ``VersionConflict`` instead of writing
+    over their change. Fields in ``guarded_fields`` change elsewhere without
+    moving the version (stock, on every sale); they post the value they were
+    loaded with and are written only when edited, and only if the row still
+    holds that value.
+    """
+    guarded_fields = ()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if 'version' in self.fields:
+            self.fields['version'].widget = forms.HiddenInput()
+        for name in self.guarded_fields:
+            self.fields[name].show_hidden_initial = True
+
+    def loaded_values(self):
+        """``{field: value as loaded}`` for the guarded fields that were edited"""
+        values = {}
+        for name in self.guarded_fields:
+            if name not in self.changed_data:
+                continue
+            field = self.fields[name]
+            raw = field.hidden_widget().value_from_datadict(self.data, self.files, self.add_initial_prefix(name))
+            try:
+                value = field.to_python(raw)
+            except ValidationError:
+                value = None
+            values[name] = self[name].initial if value is None else value
+        return values
+
+    def save(self, commit=True):
+        if not commit or self.instance._state.adding:
+            return super().save(commit)
+        save_changes(self.instance, self.changed_data, expect=self.loaded_values())
+        return self.instance
+
+class ProductForm(VersionedModelForm):
+    guarded_fields = ('stock',)
+
     class Meta:
         model = Product
-        fields = ['name', 'sku', 'category', 'size', 'color', 'price', 'cost', 'stock', 'reorder_threshold', 'is_active']
+        fields = [
+            'name', 'sku', 'category', 'size', 'color', 'price', 'cost', 'stock', 'reorder_threshold', 'is_active',
+            'version',
+        ]
         widgets = {
             'name': forms.TextInput(attrs={
                 'class': 'input w-full px-3 py-2 border border-gray-300 rounded-lg focus:ring-2 focus:ring-blue-500 focus:border-transparent',
@@ -63,10 +113,10 @@ class CategoryForm(forms.ModelForm):
             }),
         }
 
-class OrderForm(forms.ModelForm):
+class OrderForm(VersionedModelForm):
     class Meta:
         model = Order
-        fields = ['customer_name', 'customer_email', 'customer_phone', 'customer_address', 'status', 'notes']
+        fields = ['customer_name', 'customer_email', 'customer_phone', 'customer_address', 'status', 'notes', 'version']
         widgets = {
             'customer_name': forms.TextInput(attrs={
                 'class': 'input w-full px-3 py-2 border border-gray-300 rounded-lg focus:ring-2 focus:ring-blue-500 focus:border-transparent',
@@ -95,10 +145,76 @@ class OrderForm(forms.ModelForm):
             }),
         }
 
+    def clean_status(self):
+        status = self.cleaned_data['status']
+        if self.instance.pk and not self.instance.can_transition_to(status):
+            raise forms.ValidationError(
+                f'An order that is {self.instance.get_status_display()} cannot be moved to '
+                f'{dict(Order.STATUS_CHOICES)[status]}.'
+            )
+        return status
+
+class CatalogChoiceIterator:
+    """Product options read from the catalog cache when the widget renders, less those out of stock"""
+
+    def __init__(self, field):
+        self.field = field
+
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield ('', self.field.empty_label)
+        stocked = self.field.stocked_ids()
+        for pk, product in catalog.product_map().items():
+            if pk in stocked:
+                yield (pk, f"{product.name} ({product.sku})")
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __bool__(self):
+        return self.field.empty_label is not None or bool(catalog.product_map())
+
+class PreloadedModelChoiceField(forms.ModelChoiceField):
+    """ModelChoiceField that can resolve submitted values from a {pk: obj} map"""
+
+    # Filled in by a formset so its forms share one lookup instead of a query each
+    preloaded = None
+
+    def to_python(self, value):
+        if self.preloaded is None or value in self.empty_values:
+            return super().to_python(value)
+        try:
+            return self.preloaded[int(value)]
+        except (KeyError, TypeError, ValueError):
+            raise forms.ValidationError(
+                self.error_messages['invalid_choice'],
+                code='invalid_choice',
+                params={'value': value},
+            )
+
+class CatalogProductChoiceField(PreloadedModelChoiceField):
+    """Active product select that renders without loading the product rows.
+
+    The cached options leave stock out, so sales do not invalidate them; the
+    sold-out ones are dropped at render time with one query for the ids
+    ``queryset`` still accepts.
+    """
+
+    iterator = CatalogChoiceIterator
+
+    # Shared by a formset so its forms' selects make that query once between them
+    stocked = None
+
+    def stocked_ids(self):
+        if self.stocked is None:
+            self.stocked = set(self.queryset.values_list('pk', flat=True))
+        return self.stocked
+
 class OrderItemForm(forms.ModelForm):
     class Meta:
         model = OrderItem
         fields = ['product', 'quantity', 'unit_price']
+        field_classes = {'product': CatalogProductChoiceField}
         widgets = {
             'product': forms.Select(attrs={
                 'class': 'input w-full px-3 py-2 border border-gray-300 rounded-lg focus:ring-2 focus:ring-blue-500 focus:border-transparent'
@@ -115,6 +231,14 @@ class OrderItemForm(forms.ModelForm):
             }),
         }
 
+    def _get_validation_exclusions(self):
+        exclude = super()._get_validation_exclusions()
+        # The product field has already loaded the row, so skip the model's
+        # per-line FK and (order, product) lookups; BaseOrderItemFormSet checks
+        # for duplicate products across the whole order instead.
+        exclude.add('product')
+        return exclude
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # Only show active products
@@ -123,16 +247,56 @@ class OrderItemForm(forms.ModelForm):
         if not self.instance.pk and 'product' in self.data:
             try:
                 product_id = int(self.data['product'])
-                product = Product.objects.get(id=product_id)
-                self.fields['unit_price'].initial = product.price
-            except (ValueError, Product.DoesNotExist):
+                self.fields['unit_price'].initial = catalog.product_map()[product_id].price
+            except (ValueError, KeyError):
                 pass
 
+class BaseOrderItemFormSet(forms.BaseInlineFormSet):
+    """Order item formset that validates in a fixed number of queries"""
+
+    def add_fields(self, form, index):
+        super().add_fields(form, index)
+        pk_name = self.model._meta.pk.name
+        pk_field = form.fields[pk_name]
+        form.fields[pk_name] = PreloadedModelChoiceField(
+            pk_field.queryset, initial=pk_field.initial, required=False, widget=pk_field.widget
+        )
+        product_field = form.fields['product']
+        if not hasattr(self, '_stocked'):
+            self._stocked = SimpleLazyObject(lambda: set(product_field.queryset.values_list('pk', flat=True)))
+        product_field.stocked = self._stocked
+
+    def full_clean(self):
+        # Resolve every line's item and product from two bulk lookups
+        if self.is_bound and self.forms:
+            product_ids = {form['product'].data for form in self.forms}
+            product_ids = {int(pk) for pk in product_ids if str(pk).isdigit()}
+            products = self.forms[0].fields['product'].queryset.in_bulk(product_ids)
+            items = {item.pk: item for item in self.get_queryset()}
+            pk_name = self.model._meta.pk.name
+            for form in self.forms:
+                form.fields['product'].preloaded = products
+                form.fields[pk_name].preloaded = items
+        super().full_clean()
+
+    def clean(self):
+        super().clean()
+        deleted_forms = self.deleted_forms
+        seen = set()
+        for form in self.forms:
+            if form in deleted_forms or not form.cleaned_data.get('product'):
+                continue
+            product = form.cleaned_data['product']
+            if product.pk in seen:
+                raise forms.ValidationError(f'{product.name} is added more than once. Combine it into one line.')
+            seen.add(product.pk)
+
 # Formset for handling multiple order items
 OrderItemFormSet = forms.inlineformset_factory(
     Order, 
     OrderItem, 
     form=OrderItemForm,
+    formset=BaseOrderItemFormSet,
     extra=1,  # Start with 1 empty form
     min_num=1,  # Require at least 1 item
     validate_min=True,
@@ -141,7 +305,7 @@ OrderItemFormSet = forms.inlineformset_factory(
 
 # Simple form for quick sales to reduce stock
 class SellForm(forms.Form):
-    product = forms.ModelChoiceField(
+    product = CatalogProductChoiceField(
         queryset=Product.objects.filter(is_active=True, stock__gt=0),
         widget=forms.Select(attrs={
             'class': 'input w-full px-3 py-2 border border-gray-300 rounded-lg focus:ring-2 focus:ring-blue-500 focus:border-transparent'
@@ -154,11 +318,66 @@ class SellForm(forms.Form):
             'placeholder': 'e.g., 1'
         })
     )
+    # A fresh token per rendered form; see inventory/idempotency.py
+    idempotency_key = forms.CharField(
+        required=False,
+        initial=lambda: uuid.uuid4().hex,
+        widget=forms.HiddenInput(),
+    )
 
     def clean(self):
         cleaned_data = super().clean()
         product = cleaned_data.get('product')
         quantity = cleaned_data.get('quantity')
-        if product and quantity and product.stock < quantity:
-            self.add_error('quantity', f'Only {product.stock} in stock for {product.name}.')
-        return cleaned_data
\ No newline at end of file
+        if product and quantity and product.default_location_stock < quantity:
+            self.add_error('quantity', f'Only {product.default_location_stock} in stock for {product.name}.')
+        return cleaned_data
+
+class MarginReportForm(forms.Form):
+    FILTER_CLASS = 'input px-3 py-2 border border-gray-300 rounded-lg focus:ring-2 focus:ring-blue-500 focus:border-transparent'
+
+    group_by = forms.ChoiceField(
+        choices=[('category', 'Category'), ('size', 'Size'), ('color', 'Color'), ('product', 'Product')],
+        required=False,
+        widget=forms.Select(attrs={'class': FILTER_CLASS}),
+    )
+    period = forms.ChoiceField(
+        choices=[('', 'Whole range'), ('day', 'Day'), ('week', 'Week'), ('month', 'Month'), ('year', 'Year')],
+        required=False,
+        widget=forms.Select(attrs={'class': FILTER_CLASS}),
+    )
+    source = forms.ChoiceField(
+        choices=[('', 'Sales and delivered orders'), ('sale', 'Sales only'), ('order', 'Delivered orders only')],
+        required=False,
+        widget=forms.Select(attrs={'class': FILTER_CLASS}),
+    )
+    start = forms.DateField(required=False, widget=forms.DateInput(attrs={'type': 'date', 'class': FILTER_CLASS}))
+    end = forms.DateField(required=False, widget=forms.DateInput(attrs={'type': 'date', 'class': FILTER_CLASS}))
+    live_only = forms.BooleanField(
+        required=False,
+        label='Live data only',
+        widget=forms.CheckboxInput(attrs={'class': 'h-4 w-4 text-blue-600 focus:ring-blue-500 border-gray-300 rounded'}),
+    )
+
+    def clean(self):
+        cleaned_data = super().clean()
+        start = cleaned_data.get('start')
+        end = cleaned_data.get('end')
+        if start and end and start > end:
+            self.add_error('end', 'End date must not be before the start date.')
+        return cleaned_data
+
+class StockTakeUploadForm(forms.Form):
+    count_file = forms.FileField(
+        label='Counted file',
+        help_text='CSV of SKU and counted quantity, one product per line',
+        widget=forms.ClearableFileInput(attrs={'accept': '.csv,text/csv', 'class': 'block text-sm text-gray-700'}),
+    )
+    note = forms.CharField(
+        max_length=200,
+        required=False,
+        widget=forms.TextInput(attrs={
+            'class': 'input w-full px-3 py-2 border border-gray-300 rounded-lg focus:ring-2 focus:ring-blue-500 focus:border-transparent',
+            'placeholder': 'e.g., Back store, March cycle count'
+        }),
+    )
@@ -0,0 +1,158 @@
+"""
+Idempotency keys for endpoints that must not run twice.
+
+A client sends a key in the ``Idempotency-Key`` header (or, from an HTML
+form, in an ``idempotency_key`` field) and may retry with the same key as
+often as it likes. The first request claims the key by inserting a row; a
+duplicate arriving at the same time loses on the unique constraint instead
+of waiting on a lock, and gets ``409 Conflict`` until the first one finishes.
+The claim is only a lease of ``IDEMPOTENCY_LOCK_TIMEOUT`` seconds: if the
+worker running the first request dies, a retry after that takes the key
+over instead of getting 409 for the whole ``IDEMPOTENCY_KEY_TTL``. Once the first request
+finishes, its response is stored on the row and every retry gets that
+response back from one indexed lookup, with ``Idempotent-Replayed: true``.
+
+Only responses below 400 are stored. Errors release the key so the client
+can correct the request and try again with it.
+
+On DRF views the decorator goes inside ``@api_view``, under it, so the key
+belongs to the user DRF authenticated (Basic auth included) rather than to
+the session user Django's middleware saw.
+"""
+from datetime import timedelta
+from functools import wraps
+import hashlib
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
+
+from .models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+FORM_FIELD = 'idempotency_key'
+MAX_KEY_LENGTH = 255
+
+
+def _fingerprint(request):
+    digest = hashlib.sha256(f'{request.method} {request.path}\n'.encode('utf-8'))
+    if request.content_type in ('application/x-www-form-urlencoded', 'multipart/form-data'):
+        # The CSRF token changes between page loads of the same form
+        for name, values in sorted(request.POST.lists()):
+            if name != 'csrfmiddlewaretoken':
+                digest.update(f'{name}={values}\n'.encode('utf-8'))
+    else:
+        digest.update(request.body)
+    return digest.hexdigest()
+
+
+def _replay(record):
+    response = HttpResponse(
+        bytes(record.response_body), status=record.status_code, content_type=record.content_type,
+    )
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def _existing(record, fingerprint):
+    """Response for a request whose key was already claimed"""
+    if record.fingerprint != fingerprint:
+        return JsonResponse(
+            {'success': False, 'error': 'This idempotency key was already used with a different request.'},
+            status=422,
+        )
+    if record.status_code is None:
+        response = JsonResponse(
+            {'success': False, 'error': 'A request with this idempotency key is still in progress.'},
+            status=409,
+        )
+        response['Retry-After'] = '1'
+        return response
+    return _replay(record)
+
+
+def _content(request, response):
+    """The body to store, rendering a DRF ``Response`` as ``APIView.finalize_response()`` would"""
+    if getattr(response, 'is_rendered', True):
+        return response.content
+    response.accepted_renderer = request.accepted_renderer
+    response.accepted_media_type = request.accepted_media_type
+    response.renderer_context = {**request.parser_context, 'request': request, 'response': response}
+    return response.render().content
+
+
+def idempotent(scope):
+    """Make a view replay its stored response for a repeated idempotency key"""
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            # Under @api_view this is DRF's request; the key and body are read
+            # from Django's, which DRF has not consumed yet
+            http_request = getattr(request, '_request', request)
+            key = http_request.headers.get(HEADER) or http_request.POST.get(FORM_FIELD)
+            if http_request.method != 'POST' or not key or not request.user.is_authenticated:
+                return view_func(request, *args, **kwargs)
+            if len(key) > MAX_KEY_LENGTH:
+                return JsonResponse(
+                    {'success': False, 'error': f'Idempotency keys are at most {MAX_KEY_LENGTH} characters.'},
+                    status=400,
+                )
+
+            fingerprint = _fingerprint(http_request)
+            now = timezone.now()
+            lookup = {'user': request.user, 'scope': scope, 'key': key}
+            record = IdempotencyKey.objects.filter(**lookup).first()
+            if record is not None:
+                if record.expires_at > now:
+                    return _existing(record, fingerprint)
+                record.delete()
+
+            try:
+                with transaction.atomic():
+                    record = IdempotencyKey.objects.create(
+                        fingerprint=fingerprint,
+                        created_at=now,
+                        expires_at=now + timedelta(seconds=settings.IDEMPOTENCY_LOCK_TIMEOUT),
+                        **lookup,
+                    )
+            except IntegrityError:
+                # A concurrent duplicate claimed the key first
+                record = IdempotencyKey.objects.filter(**lookup).first()
+                if record is None:
+                    return view_func(request, *args, **kwargs)
+                return _existing(record, fingerprint)
+
+            try:
+                response = view_func(request, *args, **kwargs)
+            except BaseException:
+                record.delete()
+                raise
+            if response.status_code >= 400 or response.streaming:
+                record.delete()
+                return response
+            # A no-op if this ran past its lease and a retry took the key over
+            IdempotencyKey.objects.filter(pk=record.pk).update(
+                response_body=_content(request, response),
+                status_code=response.status_code,
+                content_type=response.get('Content-Type', ''),
+                expires_at=timezone.now() + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL),
+            )
+            return response
+        return wrapper
+    return decorator
+
+
+def expire_keys(batch_size=1000, now=None):
+    """Delete expired keys ``batch_size`` rows at a time; returns how many went"""
+    now = now or timezone.now()
+    deleted = 0
+    while True:
+        batch = list(
+            IdempotencyKey.objects.filter(expires_at__lte=now)
+            .order_by('expires_at')
+            .values_list('pk', flat=True)[:batch_size]
+        )
+        if not batch:
+            return deleted
+        deleted += IdempotencyKey.objects.filter(pk__in=batch).delete()[0]
@@ -0,0 +1,193 @@
+"""
+Stock ledger: every change to ``Product.stock`` as an append-only row.
+
+Each path that moves stock appends a ``StockMovement`` in its own
+transaction, labelled with a reason and, where there is one, the order,
+sale, user and location (none for the default one) behind it:
+
+* single saves (``reduce_stock()``, product forms, the admin and the API)
+  through the ``post_save`` receiver here, which compares the stock saved
+  with the stock loaded. ``tag()`` labels the row;
+* set-based paths (``services.apply_stock_deltas()``, ``sell_scanned()``,
+  ``transfer_stock()``) through ``record()``, one insert for all their
+  rows, which also queues the stock webhooks;
+* stock takes through one ``INSERT ... SELECT`` (``insert_select()``).
+
+Point-in-time stock comes from snapshots. ``take_snapshots()``, run nightly
+by ``manage.py snapshot_stock``, adds each product's movements up to a
+cutoff to its previous ``StockSnapshot``; products that did not move get no
+row. A product's stock at any moment is its latest snapshot at or before
+that moment plus the movements after it, so ``stock_at()`` reads one
+snapshot and at most a snapshot period's movements on the
+``(product, created_at)`` index, however long the ledger grows. Movements
+are never rewritten, so snapshots can always be rebuilt from them.
+
+Writes that bypass all of this (``QuerySet.update()`` from a shell, raw SQL)
+leave the ledger behind ``Product.stock``; ``reconcile()`` appends a
+correction for every difference.
+"""
+from collections import namedtuple
+from datetime import datetime, timezone as dt_timezone
+
+from django.db import connections, router
+from django.db.models import DateTimeField, F, IntegerField, Max, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import webhooks
+from .models import Product, StockMovement, StockSnapshot
+
+Reason = StockMovement.Reason
+
+# One stock change: stock before and after, for the ledger row and the webhooks
+Move = namedtuple(
+    'Move',
+    'product_id before after reorder_threshold reason order_id sale_id user_id location_id',
+    defaults=(None, None, None, None),
+)
+
+MOVEMENT_COLUMNS = ('product_id', 'quantity', 'reason', 'order_id', 'sale_id', 'user_id', 'location_id', 'created_at')
+# Reasons that do not change a product's total, so send no stock webhooks
+_UNANNOUNCED = (Reason.CREATED, Reason.TRANSFER)
+_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def _pk(value):
+    return getattr(value, 'pk', value)
+
+
+def tag(product, reason=None, order=None, sale=None, user=None):
+    """Label the ledger row for the next stock change saved on ``product``"""
+    product._stock_tags = {'reason': reason, 'order': order, 'sale': sale, 'user': user}
+
+
+def record(moves):
+    """Append ``moves`` to the ledger in one insert and queue their stock webhooks"""
+    moves = [move for move in moves if move.after != move.before or move.reason == Reason.CREATED]
+    if not moves:
+        return
+    now = timezone.now()
+    StockMovement.objects.bulk_create([
+        StockMovement(
+            product_id=move.product_id,
+            quantity=move.after - move.before,
+            reason=move.reason,
+            order_id=move.order_id,
+            sale_id=move.sale_id,
+            user_id=move.user_id,
+            location_id=move.location_id,
+            created_at=now,
+        )
+        for move in moves
+    ], batch_size=2000)
+    webhooks.emit(webhooks.stock_events(
+        (move.product_id, move.before, move.after, move.reorder_threshold)
+        for move in moves if move.reason not in _UNANNOUNCED
+    ))
+
+
+def _insert_select(model, columns, rows):
+    """Copy ``rows``, a ``values_list()`` in ``columns`` order, into ``model`` with one ``INSERT ... SELECT``"""
+    # Compiled for the primary: a read replica may be behind this transaction
+    db = router.db_for_write(model)
+    sql, params = rows.query.get_compiler(db).as_sql()
+    with connections[db].cursor() as cursor:
+        cursor.execute(f'INSERT INTO {model._meta.db_table} ({", ".join(columns)}) {sql}', params)
+        return cursor.rowcount
+
+
+def insert_select(rows):
+    """Append ``rows``, a ``values_list()`` in ``MOVEMENT_COLUMNS`` order, in one statement"""
+    return _insert_select(StockMovement, MOVEMENT_COLUMNS, rows)
+
+
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    if raw or (update_fields is not None and 'stock' not in update_fields):
+        return
+    tags = instance._stock_tags or {}
+    instance._stock_tags = None
+    if created:
+        before, reason = 0, Reason.CREATED
+    elif instance._saved_stock is not None:
+        before, reason = instance._saved_stock, tags.get('reason') or Reason.EDIT
+    else:
+        return
+    instance._saved_stock = instance.stock
+    record([Move(
+        instance.pk, before, instance.stock, instance.reorder_threshold, reason,
+        order_id=_pk(tags.get('order')), sale_id=_pk(tags.get('sale')), user_id=_pk(tags.get('user')),
+    )])
+
+
+def stock_at(product_id, when):
+    """A product's stock at ``when``, or None if that is before the ledger has it"""
+    snapshot = (
+        StockSnapshot.objects.filter(product_id=product_id, taken_at__lte=when)
+        .order_by('-taken_at').values_list('taken_at', 'stock').first()
+    )
+    movements = StockMovement.objects.filter(product_id=product_id, created_at__lte=when)
+    if snapshot is not None:
+        movements = movements.filter(created_at__gt=snapshot[0])
+    moved = movements.aggregate(total=Sum('quantity'))['total']
+    if snapshot is None and moved is None:
+        return None
+    return (snapshot[1] if snapshot else 0) + (moved or 0)
+
+
+def take_snapshots(until):
+    """Snapshot every product that moved since the last run, as of ``until``; returns the rows written.
+
+    ``until`` should be older than any transaction still open, so no
+    movement before it commits after the snapshot is taken.
+    """
+    if until > timezone.now():
+        raise ValueError('Snapshots can only be taken up to the present.')
+    since = StockSnapshot.objects.aggregate(last=Max('taken_at'))['last']
+    if since is not None and until <= since:
+        return 0
+    moved = StockMovement.objects.filter(created_at__lte=until)
+    if since is not None:
+        moved = moved.filter(created_at__gt=since)
+    previous = StockSnapshot.objects.filter(product=OuterRef('product')).order_by('-taken_at').values('stock')[:1]
+    rows = (
+        moved.order_by().values('product')
+        .annotate(
+            taken=Value(until, output_field=DateTimeField()),
+            stock=Coalesce(Subquery(previous), 0) + Sum('quantity'),
+        )
+        .values_list('product', 'taken', 'stock')
+    )
+    return _insert_select(StockSnapshot, ('product_id', 'taken_at', 'stock'), rows)
+
+
+def ledger_stock():
+    """Expression for a product's current stock as the ledger has it"""
+    latest = StockSnapshot.objects.filter(product=OuterRef('pk')).order_by('-taken_at')
+    since = StockSnapshot.objects.filter(product=OuterRef(OuterRef('pk'))).order_by('-taken_at').values('taken_at')[:1]
+    moved = (
+        StockMovement.objects.filter(product=OuterRef('pk'), created_at__gt=Coalesce(Subquery(since), Value(_EPOCH)))
+        .order_by().values('product').annotate(total=Sum('quantity')).values('total')
+    )
+    return Coalesce(Subquery(latest.values('stock')[:1]), 0) + Coalesce(Subquery(moved), 0)
+
+
+def reconcile(user=None):
+    """Append a correction for every product whose stock the ledger does not add up to; returns how many"""
+    none = Value(None, output_field=IntegerField())
+    rows = (
+        Product.objects.annotate(ledger=ledger_stock()).exclude(ledger=F('stock')).order_by()
+        .annotate(
+            quantity=F('stock') - F('ledger'),
+            reason=Value(Reason.CORRECTION.value),
+            no_order=none,
+            no_sale=none,
+            by=Value(_pk(user), output_field=IntegerField()),
+            no_location=none,
+            at=Value(timezone.now(), output_field=DateTimeField()),
+        )
+        .values_list('pk', 'quantity', 'reason', 'no_order', 'no_sale', 'by', 'no_location', 'at')
+    )
+    return insert_select(rows)
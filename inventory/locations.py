@@ -0,0 +1,106 @@
+"""
+Stock held per location: the warehouse and the shops.
+
+``Product.stock`` stays each product's total across locations, so
+everything that reads one figure keeps working:
+
+* The default location (``Location.is_default``) has no rows. It holds
+  whatever is not anywhere else, ``Product.stock - Product.located_stock``.
+  Everything that moved stock before locations existed moves only this
+  remainder: orders, the sell page, product edits and stock takes. None of
+  them can take units that are at a shop.
+* Every other location has a ``ProductLocationStock`` row for each product
+  it holds. ``Product.located_stock`` is the sum of those rows.
+* A POS terminal sends its location's code. A sale there takes units off
+  that location's row with one ``UPDATE ... WHERE stock >= quantity``
+  (``take()``), so the oversell check at one shop never waits on another
+  shop's. The product's totals are then moved with an ``UPDATE`` that reads
+  nothing first.
+* ``services.transfer_stock()`` moves units between two locations. It only
+  touches the product row when one side is the default location.
+
+Every path writes rows in one order: location rows by location id, then the
+product row. Two transactions therefore never wait on each other in a cycle,
+which would deadlock on PostgreSQL.
+
+The product row is still written inside every shop sale's transaction, so
+shops selling the same product still queue on it. The lock is only taken
+late, after the location row and the ``Sale`` insert. It is then held for the
+totals read, the ledger and webhook inserts, any low-stock notification and
+the commit. On SQLite with 200k products that is about 2.5 ms of a 4 ms sale,
+which caps one product at roughly 400 shop sales a second across all shops.
+Sales of different products never wait on each other.
+
+``at_location()`` narrows a product queryset to one location. The join uses
+the unique ``(location, product)`` index; the default location's stock is
+computed on the product row.
+"""
+from django.db.models import F
+from django.utils import timezone
+
+from . import catalog
+from .models import Product, ProductLocationStock
+
+
+def located_id(location):
+    """The id to store for ``location`` (a code, ``CachedLocation`` or ``Location``): None for the default one"""
+    if isinstance(location, str):
+        location = catalog.location(location)
+    if location is None or location.is_default:
+        return None
+    return location.id
+
+
+def default_location():
+    """The default location as a ``CachedLocation``, or None if none is set up"""
+    return next((location for location in catalog.locations() if location.is_default), None)
+
+
+def take(product_id, location_id, quantity):
+    """Take ``quantity`` off a location's row if it holds that many; returns whether it did"""
+    return bool(
+        ProductLocationStock.objects.filter(product_id=product_id, location_id=location_id, stock__gte=quantity)
+        .update(stock=F('stock') - quantity, updated_at=timezone.now())
+    )
+
+
+def put(product_id, location_id, quantity):
+    """Add ``quantity`` to a location's row, creating the row the first time"""
+    rows = ProductLocationStock.objects.filter(product_id=product_id, location_id=location_id)
+    if not rows.update(stock=F('stock') + quantity, updated_at=timezone.now()):
+        # Another transfer may create the row first; then add to theirs
+        ProductLocationStock.objects.bulk_create(
+            [ProductLocationStock(product_id=product_id, location_id=location_id, stock=0)], ignore_conflicts=True,
+        )
+        rows.update(stock=F('stock') + quantity, updated_at=timezone.now())
+
+
+def stock_at(product_id, location_id):
+    """Units of a product at a location; None is the default location"""
+    if location_id is None:
+        return (
+            Product.objects.filter(pk=product_id)
+            .values_list(F('stock') - F('located_stock'), flat=True).first() or 0
+        )
+    return (
+        ProductLocationStock.objects.filter(product_id=product_id, location_id=location_id)
+        .values_list('stock', flat=True).first() or 0
+    )
+
+
+def at_location(queryset, location):
+    """Products of ``queryset`` held at ``location``, annotated with their units there as ``location_stock``.
+
+    The default location lists every product. Any other lists the products
+    it has a row for, even when the row is at zero.
+    """
+    if location.is_default:
+        return queryset.annotate(location_stock=F('stock') - F('located_stock'))
+    return queryset.filter(location_stocks__location=location.id).annotate(
+        location_stock=F('location_stocks__stock'),
+    )
+
+
+def sales_at(queryset, location):
+    """Sales of ``queryset`` made at ``location``"""
+    return queryset.filter(location=located_id(location))
@@ -0,0 +1,57 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from inventory.archive import archivable_orders, archivable_sales, archive_orders, archive_sales
+
+
+class Command(BaseCommand):
+    help = 'Move sales and finished orders older than a cutoff into the archive tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than-days',
+            type=int,
+            default=365,
+            help='Archive rows created more than this many days ago (default: 365)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Rows moved per transaction (default: 500)',
+        )
+        parser.add_argument(
+            '--max-batches',
+            type=int,
+            default=None,
+            help='Stop after this many batches per table; run again to continue',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only count what would be archived',
+        )
+
+    def handle(self, *args, **options):
+        if options['older_than_days'] < 1 or options['batch_size'] < 1:
+            raise CommandError('--older-than-days and --batch-size must be at least 1.')
+        cutoff = timezone.now() - timedelta(days=options['older_than_days'])
+
+        if options['dry_run']:
+            self.stdout.write(
+                f'Would archive {archivable_orders(cutoff).count()} orders and '
+                f'{archivable_sales(cutoff).count()} sales created before {cutoff:%Y-%m-%d %H:%M}'
+            )
+            return
+
+        batching = {'batch_size': options['batch_size'], 'max_batches': options['max_batches']}
+        orders = archive_orders(cutoff, **batching)
+        sales = archive_sales(cutoff, **batching)
+        self.stdout.write(self.style.SUCCESS(
+            f'Archived {orders} orders and {sales} sales created before {cutoff:%Y-%m-%d %H:%M}'
+        ))
+        remaining = archivable_orders(cutoff).exists() or archivable_sales(cutoff).exists()
+        if remaining:
+            self.stdout.write('More rows remain; run the command again to continue.')
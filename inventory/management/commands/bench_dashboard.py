@@ -0,0 +1,142 @@
+from collections import namedtuple
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.urls import reverse
+import asyncio
+import time
+import uuid
+
+from inventory import catalog
+
+# One request: its status, and ms to the first body bytes and to the last
+Timing = namedtuple('Timing', 'status first_byte total')
+
+
+def _percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+    return pick(0.50), pick(0.95), samples[-1]
+
+
+async def _get(app, path, query, headers):
+    """GET ``path`` from the ASGI application the way a server would, timing the response"""
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': query.encode(),
+        'root_path': '',
+        'headers': headers,
+        'client': ('127.0.0.1', 0),
+        'server': ('localhost', 80),
+    }
+    finished = asyncio.Event()
+    requested = False
+    status = first_byte = None
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        await finished.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        nonlocal status, first_byte
+        if message['type'] == 'http.response.start':
+            status = message['status']
+        elif message.get('body') and first_byte is None:
+            first_byte = (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    await app(scope, receive, send)
+    finished.set()
+    return Timing(status, first_byte, (time.perf_counter() - started) * 1000)
+
+
+class Command(BaseCommand):
+    help = 'Compare the sync and the streamed async dashboard, served in-process through the ASGI handler'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--requests',
+            type=int,
+            default=30,
+            help='Requests timed per dashboard (default: 30)',
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=1,
+            help='Requests in flight at once (default: 1)',
+        )
+        parser.add_argument(
+            '--location',
+            default='',
+            help='Location code to view the dashboard at (default: all locations)',
+        )
+
+    def handle(self, *args, **options):
+        if min(options['requests'], options['concurrency']) < 1:
+            raise CommandError('--requests and --concurrency must be positive.')
+        if options['location'] and catalog.location(options['location']) is None:
+            raise CommandError(f'No location with code "{options["location"]}".')
+
+        # A throwaway staff login, removed with its session at the end
+        user = User.objects.create_user(f'dashboard-bench-{uuid.uuid4().hex[:8]}', is_staff=True)
+        client = Client()
+        client.force_login(user)
+        host = next(
+            (host for host in settings.ALLOWED_HOSTS if host != '*' and not host.startswith('.')), 'localhost',
+        )
+        headers = [
+            (b'host', host.encode()),
+            (b'cookie', f'{settings.SESSION_COOKIE_NAME}={client.cookies[settings.SESSION_COOKIE_NAME].value}'.encode()),
+        ]
+        query = f'location={options["location"]}' if options['location'] else ''
+        try:
+            results = asyncio.run(self._bench(get_asgi_application(), query, headers, options))
+        finally:
+            client.logout()
+            user.delete()
+
+        self.stdout.write(
+            f'{options["requests"]} requests each, {options["concurrency"]} at a time, '
+            f'{settings.DASHBOARD_QUERY_THREADS} query threads'
+        )
+        self.stdout.write(
+            f'{"":<16} {"first p50":>10} {"first p95":>10} {"total p50":>10} {"total p95":>10} {"max ms":>8}'
+        )
+        for label, timings in results:
+            first_p50, first_p95, _ = _percentiles([timing.first_byte for timing in timings])
+            p50, p95, worst = _percentiles([timing.total for timing in timings])
+            self.stdout.write(self.style.SUCCESS(
+                f'{label:<16} {first_p50:>10.1f} {first_p95:>10.1f} {p50:>10.1f} {p95:>10.1f} {worst:>8.1f}'
+            ))
+
+    async def _bench(self, app, query, headers, options):
+        results = []
+        for label, url_name in (('sync', 'dashboard'), ('async streamed', 'dashboard-live')):
+            path = reverse(url_name)
+            # Warm up: connections, templates and the catalog cache
+            for _ in range(2):
+                timing = await _get(app, path, query, headers)
+                if timing.status != 200:
+                    raise CommandError(f'{path} answered {timing.status}; check ALLOWED_HOSTS and the login.')
+            slots = asyncio.Semaphore(options['concurrency'])
+
+            async def timed():
+                async with slots:
+                    return await _get(app, path, query, headers)
+
+            timings = await asyncio.gather(*(timed() for _ in range(options['requests'])))
+            results.append((label, timings))
+        return results
@@ -0,0 +1,115 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test import override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+import random
+import time
+import uuid
+
+from inventory import catalog
+from inventory.api import ProductViewSet, scan_lookup, scan_sell
+from inventory.models import Category, Product
+
+
+class Rollback(Exception):
+    pass
+
+
+def _percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+    return pick(0.50), pick(0.95), pick(0.99), samples[-1]
+
+
+class Command(BaseCommand):
+    help = 'Measure SKU scan lookup and scan-to-sell latency against throwaway products'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--products',
+            type=int,
+            default=2000,
+            help='Number of temporary products to create (default: 2000)',
+        )
+        parser.add_argument(
+            '--scans',
+            type=int,
+            default=5000,
+            help='Lookups per scenario (default: 5000)',
+        )
+        parser.add_argument(
+            '--sells',
+            type=int,
+            default=500,
+            help='Scan-to-sell calls to time (default: 500)',
+        )
+
+    def handle(self, *args, **options):
+        if min(options['products'], options['scans'], options['sells']) < 1:
+            raise CommandError('--products, --scans and --sells must be positive.')
+        # Everything runs in one transaction that is rolled back at the end,
+        # so the benchmark leaves no products, sales or users behind
+        try:
+            with transaction.atomic(), override_settings(RATE_LIMITS={}):
+                self._run(options)
+                raise Rollback
+        except Rollback:
+            pass
+        finally:
+            catalog.clear_local()
+
+    def _run(self, options):
+        run = uuid.uuid4().hex[:8].upper()
+        category = Category.objects.create(name=f'Scan benchmark {run}')
+        skus = [f'BENCH-{run}-{i:06d}' for i in range(options['products'])]
+        Product.objects.bulk_create(
+            [
+                Product(name=f'Bench item {i}', sku=sku, category=category, price=100, cost=60, stock=10 ** 6)
+                for i, sku in enumerate(skus)
+            ],
+            batch_size=500,
+        )
+        user = User.objects.create_user(f'scan-bench-{run}')
+        factory = APIRequestFactory()
+        picks = [random.choice(skus) for _ in range(options['scans'])]
+
+        def request(method, path, **kwargs):
+            req = getattr(factory, method)(path, **kwargs)
+            req.user = user
+            force_authenticate(req, user=user)
+            return req
+
+        def timed(calls):
+            samples = []
+            for call in calls:
+                started = time.perf_counter()
+                call()
+                samples.append((time.perf_counter() - started) * 1000)
+            return samples
+
+        search = ProductViewSet.as_view({'get': 'list'})
+        catalog.clear_local()
+        scenarios = [
+            ('search endpoint', timed(
+                lambda sku=sku: search(request('get', '/api/products/', data={'search': sku}))
+                for sku in picks[:min(len(picks), 200)]
+            )),
+            ('scan_entry cold', timed(lambda sku=sku: catalog.scan_entry(sku) for sku in skus)),
+            ('scan_entry warm', timed(lambda sku=sku: catalog.scan_entry(sku) for sku in picks)),
+            ('scan endpoint warm', timed(
+                lambda sku=sku: scan_lookup(request('get', f'/api/scan/{sku}/'), sku=sku) for sku in picks
+            )),
+            ('scan-sell endpoint', timed(
+                lambda sku=sku: scan_sell(request('post', '/api/sales/scan/', data={'sku': sku}, format='json'))
+                for sku in picks[:options['sells']]
+            )),
+        ]
+
+        self.stdout.write(f'{options["products"]} products, {options["scans"]} lookups, {options["sells"]} sells')
+        self.stdout.write(f'{"":<20} {"calls":>6} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"max ms":>8}')
+        for label, samples in scenarios:
+            p50, p95, p99, worst = _percentiles(samples)
+            self.stdout.write(self.style.SUCCESS(
+                f'{label:<20} {len(samples):>6} {p50:>8.3f} {p95:>8.3f} {p99:>8.3f} {worst:>8.3f}'
+            ))
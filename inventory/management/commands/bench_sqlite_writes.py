@@ -0,0 +1,135 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import time
+
+SCHEMA = """
+CREATE TABLE product (id INTEGER PRIMARY KEY, stock INTEGER NOT NULL);
+CREATE TABLE sale (
+    id INTEGER PRIMARY KEY,
+    product_id INTEGER NOT NULL REFERENCES product (id),
+    quantity INTEGER NOT NULL,
+    unit_price DECIMAL NOT NULL,
+    total_amount DECIMAL NOT NULL,
+    created_at TEXT NOT NULL
+);
+"""
+
+
+def _write_worker(path, init_command, transaction_mode, writes, product_count, results):
+    """Run the sell write pattern (read stock, decrement, insert sale) in a loop"""
+    # Python's sqlite3 default timeout is 5s, the same as a stock Django connection
+    conn = sqlite3.connect(path, timeout=5.0, isolation_level=None)
+    for statement in init_command.split(';'):
+        if statement.strip():
+            conn.execute(statement)
+
+    committed = locked = 0
+    for i in range(writes):
+        product_id = (os.getpid() + i) % product_count + 1
+        try:
+            conn.execute(f'BEGIN {transaction_mode}')
+            conn.execute('SELECT stock FROM product WHERE id = ?', (product_id,)).fetchone()
+            conn.execute('UPDATE product SET stock = stock - 1 WHERE id = ? AND stock >= 1', (product_id,))
+            conn.execute(
+                "INSERT INTO sale (product_id, quantity, unit_price, total_amount, created_at) "
+                "VALUES (?, 1, 100, 100, datetime('now'))",
+                (product_id,)
+            )
+            conn.execute('COMMIT')
+            committed += 1
+        except sqlite3.OperationalError as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            if 'locked' not in str(e) and 'busy' not in str(e):
+                raise
+            locked += 1
+    conn.close()
+    results.put((committed, locked))
+
+
+class Command(BaseCommand):
+    help = 'Benchmark concurrent SQLite writes with default vs. configured connection settings'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes',
+            type=int,
+            default=4,
+            help='Number of concurrent writer processes (default: 4)',
+        )
+        parser.add_argument(
+            '--writes',
+            type=int,
+            default=500,
+            help='Sell transactions per process (default: 500)',
+        )
+        parser.add_argument(
+            '--products',
+            type=int,
+            default=20,
+            help='Number of products the writers contend on (default: 20)',
+        )
+
+    def handle(self, *args, **options):
+        db = settings.DATABASES['default']
+        if 'sqlite3' not in db['ENGINE']:
+            raise CommandError('The default database is not SQLite; nothing to benchmark.')
+        db_options = db.get('OPTIONS', {})
+
+        init_command = db_options.get('init_command', '')
+        transaction_mode = (db_options.get('transaction_mode') or 'DEFERRED').upper()
+        scenarios = [
+            ('sqlite defaults', '', 'DEFERRED'),
+            ('pragmas only', init_command, 'DEFERRED'),
+        ]
+        if transaction_mode != 'DEFERRED':
+            scenarios.append(('configured', init_command, transaction_mode))
+
+        self.stdout.write(
+            f'{options["processes"]} processes x {options["writes"]} writes '
+            f'over {options["products"]} products'
+        )
+        for label, init_command, transaction_mode in scenarios:
+            committed, locked, elapsed = self._run(init_command, transaction_mode, options)
+            style = self.style.SUCCESS if locked == 0 else self.style.WARNING
+            self.stdout.write(style(
+                f'{label:<24} {transaction_mode:<9} '
+                f'{committed / elapsed:>8.0f} writes/s  '
+                f'{committed:>6} committed  {locked:>5} lock errors  ({elapsed:.2f}s)'
+            ))
+
+    def _run(self, init_command, transaction_mode, options):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'bench.sqlite3')
+            conn = sqlite3.connect(path)
+            conn.executescript(SCHEMA)
+            conn.executemany(
+                'INSERT INTO product (id, stock) VALUES (?, ?)',
+                [(i, 10 ** 9) for i in range(1, options['products'] + 1)]
+            )
+            conn.commit()
+            conn.close()
+
+            results = multiprocessing.Queue()
+            workers = [
+                multiprocessing.Process(
+                    target=_write_worker,
+                    args=(path, init_command, transaction_mode, options['writes'], options['products'], results),
+                )
+                for _ in range(options['processes'])
+            ]
+            started = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            totals = [results.get() for _ in workers]
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - started
+
+        committed = sum(c for c, _ in totals)
+        locked = sum(l for _, l in totals)
+        return committed, locked, elapsed
@@ -0,0 +1,79 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from inventory.webhooks import ConnectionPool, deliver_due
+
+
+class Command(BaseCommand):
+    help = 'Send queued webhook events to their endpoints, retrying failures with backoff'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=50,
+            help='Events sent to an endpoint per request (default: 50)',
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=4,
+            help='Requests in flight at once, and keep-alive connections kept per host (default: 4)',
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=1000,
+            help='Events claimed from the queue per round (default: 1000)',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Exit once nothing is due instead of polling',
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=5,
+            help='Seconds to wait when nothing is due before polling again (default: 5)',
+        )
+
+    def handle(self, *args, **options):
+        for name in ('batch_size', 'concurrency', 'limit'):
+            if options[name] < 1:
+                raise CommandError(f'--{name.replace("_", "-")} must be at least 1.')
+        pool = ConnectionPool(timeout=settings.WEBHOOK_TIMEOUT, size=options['concurrency'])
+        try:
+            while True:
+                started = time.monotonic()
+                opened = pool.opened
+                delivered = failed = dead = requests = 0
+                while True:
+                    run = deliver_due(
+                        pool,
+                        batch_size=options['batch_size'],
+                        limit=options['limit'],
+                        concurrency=options['concurrency'],
+                    )
+                    if not run.requests:
+                        break
+                    delivered += run.delivered
+                    failed += run.failed
+                    dead += run.dead
+                    requests += run.requests
+                if requests:
+                    elapsed = time.monotonic() - started
+                    self.stdout.write(self.style.SUCCESS(
+                        f'Delivered {delivered} events in {requests} requests '
+                        f'over {pool.opened - opened} new connections ({delivered / elapsed:.0f} events/s); '
+                        f'{failed} to retry, {dead} dead'
+                    ))
+                if options['once']:
+                    return
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            pool.close()
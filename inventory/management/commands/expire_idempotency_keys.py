@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from inventory.idempotency import expire_keys
+
+
+class Command(BaseCommand):
+    help = 'Delete idempotency keys whose replay window has passed'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Rows deleted per statement, to keep write locks short (default: 1000)',
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1.')
+        deleted = expire_keys(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Expired {deleted} idempotency keys'))
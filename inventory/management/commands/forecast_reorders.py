@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand, CommandError
+from time import perf_counter
+
+from inventory.forecasting import forecast_reorders
+
+
+class Command(BaseCommand):
+    help = 'Forecast sales velocity for every active product and write reorder suggestions'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=90,
+            help='Days of sales history to learn from (default: 90)',
+        )
+        parser.add_argument(
+            '--lead-time',
+            type=int,
+            default=7,
+            help='Days between placing and receiving a reorder (default: 7)',
+        )
+        parser.add_argument(
+            '--review-days',
+            type=int,
+            default=7,
+            help='Days until stock is reviewed again; reorder quantities cover this too (default: 7)',
+        )
+        parser.add_argument(
+            '--service-level',
+            type=float,
+            default=0.95,
+            help='Target probability of not running out during the lead time (default: 0.95)',
+        )
+        parser.add_argument(
+            '--apply-thresholds',
+            action='store_true',
+            help='Also set reorder_threshold to the suggested reorder point on products that sold in the window',
+        )
+
+    def handle(self, *args, **options):
+        if options['days'] < 1 or options['lead_time'] < 1 or options['review_days'] < 0:
+            raise CommandError('--days and --lead-time must be positive and --review-days not negative.')
+        start = perf_counter()
+        try:
+            result = forecast_reorders(
+                days=options['days'],
+                lead_time=options['lead_time'],
+                review_days=options['review_days'],
+                service_level=options['service_level'],
+                apply_thresholds=options['apply_thresholds'],
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Forecast {result.products} products in {perf_counter() - start:.2f}s: '
+            f'{result.selling} selling, {result.suggestions} to reorder'
+        ))
+        if options['apply_thresholds']:
+            self.stdout.write(f'Updated reorder_threshold on {result.thresholds_updated} products')
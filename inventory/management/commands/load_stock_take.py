@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from inventory.stocktake import CountFileError, apply_stock_take, load_count, read_counts, summary
+
+
+class Command(BaseCommand):
+    help = 'Load a counted CSV file of SKU and quantity as a stock take and report its variances'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV file with a SKU and a counted quantity per line')
+        parser.add_argument(
+            '--note',
+            default='',
+            help='Label shown on the stock take (default: none)',
+        )
+        parser.add_argument(
+            '--apply',
+            action='store_true',
+            help='Apply the variances to stock right away instead of leaving a draft',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            with open(options['path'], encoding='utf-8-sig', newline='') as count_file:
+                counts = read_counts(count_file)
+        except OSError as e:
+            raise CommandError(f'Cannot read {options["path"]}: {e}')
+        except (CountFileError, UnicodeDecodeError) as e:
+            raise CommandError(str(e))
+        if not counts:
+            raise CommandError('The file has no counted lines.')
+
+        stock_take = load_count(counts, note=options['note'])
+        totals = summary(stock_take)
+        self.stdout.write(
+            f'Stock take {stock_take.pk}: {stock_take.line_count} SKUs, {stock_take.unknown_count} unknown, '
+            f'{totals["variances"]} variances (+{totals["units_over"]} / {totals["units_short"]} units, '
+            f'{totals["value_at_cost"]:.2f} at cost)'
+        )
+        if options['apply']:
+            updated = apply_stock_take(stock_take)
+            self.stdout.write(self.style.SUCCESS(f'Applied: stock corrected on {updated} products'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Loaded as a draft; review and apply it from the Stock Take page'))
@@ -0,0 +1,17 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+import os
+
+
+class Command(BaseCommand):
+    help = 'Re-measure every endpoint and rewrite inventory/query_budgets.json'
+
+    def handle(self, *args, **options):
+        # QueryBudgetTests records instead of checking when this is set; the
+        # run still fails if any endpoint's query count grows with data size
+        os.environ['QUERY_BUDGETS_RECORD'] = '1'
+        try:
+            call_command('test', 'inventory.tests.QueryBudgetTests', verbosity=options['verbosity'])
+        finally:
+            del os.environ['QUERY_BUDGETS_RECORD']
+        self.stdout.write(self.style.SUCCESS('Query budgets refreshed; review and commit inventory/query_budgets.json'))
@@ -0,0 +1,95 @@
+from decimal import Decimal, InvalidOperation
+
+from django.core.management.base import BaseCommand, CommandError
+
+from inventory.models import Category
+from inventory.repricing import ROUNDINGS, RepricingRule, apply_repricing, check_rule, preview
+
+
+def _decimal(value):
+    try:
+        return Decimal(value)
+    except InvalidOperation:
+        raise CommandError(f'{value!r} is not a number.')
+
+
+class Command(BaseCommand):
+    help = 'Preview, and with --apply make, a price change across the products a rule selects'
+
+    def add_arguments(self, parser):
+        change = parser.add_mutually_exclusive_group(required=True)
+        change.add_argument('--percent', help='Change prices by this percentage, e.g. -20')
+        change.add_argument('--amount', help='Change prices by this many rupees, e.g. 150')
+        parser.add_argument(
+            '--category',
+            help='Only products in this category, by name or id (default: all categories)',
+        )
+        parser.add_argument(
+            '--size',
+            action='append',
+            default=[],
+            help='Only this size; repeat for several (default: all sizes)',
+        )
+        parser.add_argument(
+            '--color',
+            action='append',
+            default=[],
+            help='Only this color; repeat for several (default: all colors)',
+        )
+        parser.add_argument(
+            '--rounding',
+            choices=ROUNDINGS,
+            default='paisa',
+            help='Round new prices to the paisa, the rupee, or an x9 / x99 ending (default: paisa)',
+        )
+        parser.add_argument(
+            '--min-margin',
+            help='Keep at least this gross margin over cost, in percent (default: no floor)',
+        )
+        parser.add_argument(
+            '--note',
+            default='',
+            help='Label stored with the price history (default: none)',
+        )
+        parser.add_argument(
+            '--apply',
+            action='store_true',
+            help='Apply the change instead of only previewing it',
+        )
+
+    def handle(self, *args, **options):
+        category = None
+        if options['category']:
+            lookup = {'pk': options['category']} if options['category'].isdigit() else {'name': options['category']}
+            category = Category.objects.filter(**lookup).values_list('pk', flat=True).first()
+            if category is None:
+                raise CommandError(f'No category {options["category"]!r}.')
+        rule = RepricingRule(
+            mode='percent' if options['percent'] is not None else 'amount',
+            value=_decimal(options['percent'] if options['percent'] is not None else options['amount']),
+            rounding=options['rounding'],
+            min_margin=_decimal(options['min_margin']) if options['min_margin'] is not None else None,
+            category=category,
+            sizes=tuple(options['size']),
+            colors=tuple(options['color']),
+        )
+        try:
+            check_rule(rule)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        result = preview(rule)
+        self.stdout.write(
+            f'{result.matched} products matched, {result.changed} changing '
+            f'({result.raised} up, {result.lowered} down, {result.floored} held by the margin floor); '
+            f'stock value {result.value_before:.2f} -> {result.value_after:.2f}'
+        )
+        for row in result.samples:
+            self.stdout.write(f'  {row.sku:<20} {row.old_price:>10} -> {row.new_price:>10}  (cost {row.cost})')
+        if options['apply']:
+            repricing = apply_repricing([rule], note=options['note'])
+            self.stdout.write(self.style.SUCCESS(
+                f'Applied as repricing {repricing.pk}: {repricing.change_count} prices changed'
+            ))
+        else:
+            self.stdout.write(self.style.SUCCESS('Preview only; run again with --apply to change prices'))
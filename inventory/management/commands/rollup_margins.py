@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from inventory.analytics import rollup_margins
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the daily margin rollup that profitability reports read for past days'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=35,
+            help='Trailing days to rebuild, ending yesterday; covers late deliveries (default: 35)',
+        )
+
+    def handle(self, *args, **options):
+        if options['days'] < 1:
+            raise CommandError('--days must be at least 1.')
+        written = rollup_margins(days=options['days'])
+        self.stdout.write(self.style.SUCCESS(f'Wrote {written} margin rollup rows'))
@@ -0,0 +1,80 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+import glob
+import json
+
+
+class Command(BaseCommand):
+    help = 'Summarize the slow-query log by query shape'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--file',
+            type=str,
+            default=None,
+            help='Log file to read (default: SLOW_QUERY_LOG and its rotated copies)',
+        )
+        parser.add_argument(
+            '--top',
+            type=int,
+            default=20,
+            help='Number of query shapes to show (default: 20)',
+        )
+        parser.add_argument(
+            '--sort',
+            choices=['total', 'count', 'max'],
+            default='total',
+            help='Rank by total time, call count or slowest call (default: total)',
+        )
+        parser.add_argument(
+            '--plans',
+            action='store_true',
+            help='Print the captured query plan under each shape',
+        )
+
+    def handle(self, *args, **options):
+        path = options['file'] or settings.SLOW_QUERY_LOG
+        if not path:
+            raise CommandError('The slow-query log is disabled; set SLOW_QUERY_LOG or pass --file.')
+        paths = [p for p in glob.glob(f'{path}*') if p == path or p[len(path):].lstrip('.').isdigit()]
+        if not paths:
+            raise CommandError(f'No slow-query log found at {path}')
+
+        shapes = {}
+        for log_path in paths:
+            with open(log_path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    shape = shapes.setdefault(entry['shape'], {
+                        'count': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                        'sql': entry['sql'], 'views': set(), 'stack': entry.get('stack', []), 'plan': None,
+                    })
+                    shape['count'] += 1
+                    shape['total_ms'] += entry['duration_ms']
+                    shape['max_ms'] = max(shape['max_ms'], entry['duration_ms'])
+                    if entry.get('view'):
+                        shape['views'].add(entry['view'])
+                    if entry.get('plan'):
+                        shape['plan'] = entry['plan']
+
+        sort_key = {'total': 'total_ms', 'count': 'count', 'max': 'max_ms'}[options['sort']]
+        ranked = sorted(shapes.items(), key=lambda item: item[1][sort_key], reverse=True)[:options['top']]
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{sum(s["count"] for s in shapes.values())} slow queries in {len(shapes)} shapes'
+        ))
+        for shape_hash, shape in ranked:
+            self.stdout.write(
+                f'\n{shape_hash}  total {shape["total_ms"]:.0f}ms  calls {shape["count"]}  '
+                f'mean {shape["total_ms"] / shape["count"]:.1f}ms  max {shape["max_ms"]:.1f}ms'
+            )
+            self.stdout.write(f'  views: {", ".join(sorted(shape["views"])) or "-"}')
+            self.stdout.write(f'  sql:   {shape["sql"][:300]}')
+            for frame in reversed(shape['stack']):
+                self.stdout.write(f'  from:  {frame}')
+            if options['plans'] and shape['plan']:
+                for plan_line in shape['plan'].splitlines():
+                    self.stdout.write(f'         {plan_line}')
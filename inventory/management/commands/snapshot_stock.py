@@ -0,0 +1,40 @@
+from datetime import datetime, time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from inventory.ledger import reconcile, take_snapshots
+
+
+class Command(BaseCommand):
+    help = 'Snapshot stock from the ledger so point-in-time lookups read a bounded number of movements'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--until',
+            help='Snapshot movements up to this ISO 8601 date and time (default: the start of today)',
+        )
+        parser.add_argument(
+            '--reconcile',
+            action='store_true',
+            help='First append corrections for stock changed outside the ledger',
+        )
+
+    def handle(self, *args, **options):
+        if options['until']:
+            until = parse_datetime(options['until'])
+            if until is None:
+                raise CommandError('--until must be an ISO 8601 date and time.')
+            if timezone.is_naive(until):
+                until = timezone.make_aware(until)
+        else:
+            until = timezone.make_aware(datetime.combine(timezone.localdate(), time.min))
+        if options['reconcile']:
+            corrected = reconcile()
+            self.stdout.write(self.style.SUCCESS(f'Corrected {corrected} products'))
+        try:
+            written = take_snapshots(until)
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(f'Wrote {written} stock snapshots up to {until:%Y-%m-%d %H:%M %Z}'))
@@ -0,0 +1,294 @@
+"""
+Request, database and business metrics in Prometheus text format.
+
+Every worker process appends to its own memory-mapped file in
+``settings.METRICS_DIR``; updating a metric is a dict lookup plus an in-place
+write of one double, with no locking across processes. The ``/metrics`` view
+reads every worker's file and sums them, so totals cover all gunicorn workers,
+including ones that have since been recycled. Clear the directory on deploy.
+"""
+from contextlib import ExitStack
+import atexit
+import glob
+import hmac
+import math
+import mmap
+import os
+import struct
+import threading
+from time import perf_counter
+
+from django.conf import settings
+from django.db import connections
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.http import HttpResponse, HttpResponseForbidden
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+HISTOGRAMS = {
+    'http_request_duration_seconds': ('Request latency by URL name.', LATENCY_BUCKETS),
+    'http_request_db_queries': ('Database queries per request by URL name.', QUERY_COUNT_BUCKETS),
+    'http_request_db_seconds': ('Time spent in database queries per request by URL name.', LATENCY_BUCKETS),
+}
+COUNTERS = {
+    'orders_created_total': 'Orders created.',
+    'sales_recorded_total': 'Sales recorded.',
+    'stock_decrement_failures_total': 'Stock decrements refused for insufficient stock.',
+    'notifications_emitted_total': 'Notifications created, by type.',
+    'requests_throttled_total': 'Write requests rejected by rate limit or concurrency cap, by scope.',
+}
+
+_HEADER = struct.Struct('q')
+_LENGTH = struct.Struct('i')
+_VALUE = struct.Struct('d')
+_INITIAL_SIZE = 64 * 1024
+
+
+class MmapStore:
+    """Append-only key -> float64 map in a memory-mapped file, one per process.
+
+    Layout: an 8-byte "bytes used" header, then entries of a 4-byte key
+    length, the UTF-8 key padded to 8 bytes, and the 8-byte value. Entries are
+    written before the header is bumped, so concurrent readers only ever see
+    complete entries.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'a+b')
+        if os.fstat(self._file.fileno()).st_size < _INITIAL_SIZE:
+            self._file.truncate(_INITIAL_SIZE)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self._used = _HEADER.unpack_from(self._map, 0)[0] or _HEADER.size
+        self._positions = {key: pos for key, _, pos in _read_entries(self._map, self._used)}
+        self._lock = threading.Lock()
+
+    def close(self):
+        with self._lock:
+            self._map.close()
+            self._file.close()
+
+    def inc(self, key, amount=1.0):
+        with self._lock:
+            pos = self._positions.get(key)
+            if pos is None:
+                pos = self._add(key)
+            _VALUE.pack_into(self._map, pos, _VALUE.unpack_from(self._map, pos)[0] + amount)
+
+    def _add(self, key):
+        encoded = key.encode('utf-8')
+        padded = encoded + b' ' * (-(_LENGTH.size + len(encoded)) % 8)
+        size = _LENGTH.size + len(padded) + _VALUE.size
+        if self._used + size > len(self._map):
+            capacity = len(self._map)
+            while self._used + size > capacity:
+                capacity *= 2
+            self._map.close()
+            self._file.truncate(capacity)
+            self._map = mmap.mmap(self._file.fileno(), 0)
+        _LENGTH.pack_into(self._map, self._used, len(encoded))
+        self._map[self._used + _LENGTH.size:self._used + _LENGTH.size + len(padded)] = padded
+        pos = self._used + _LENGTH.size + len(padded)
+        _VALUE.pack_into(self._map, pos, 0.0)
+        self._used += size
+        _HEADER.pack_into(self._map, 0, self._used)
+        self._positions[key] = pos
+        return pos
+
+
+def _read_entries(data, used):
+    pos = _HEADER.size
+    while pos < used:
+        length = _LENGTH.unpack_from(data, pos)[0]
+        key_start = pos + _LENGTH.size
+        key = bytes(data[key_start:key_start + length]).decode('utf-8')
+        value_pos = key_start + length + (-(_LENGTH.size + length) % 8)
+        yield key, _VALUE.unpack_from(data, value_pos)[0], value_pos
+        pos = value_pos + _VALUE.size
+
+
+_store = None
+_store_key = None
+_store_lock = threading.Lock()
+
+
+def _get_store():
+    global _store, _store_key
+    key = (os.getpid(), settings.METRICS_DIR)
+    if _store_key != key:
+        # First use in this process, a fork inherited the parent's store, or
+        # METRICS_DIR was changed (as tests do)
+        with _store_lock:
+            if _store_key != key:
+                if _store is not None:
+                    _store.close()
+                os.makedirs(settings.METRICS_DIR, exist_ok=True)
+                _store = MmapStore(os.path.join(settings.METRICS_DIR, f'metrics_{key[0]}.db'))
+                _store_key = key
+    return _store
+
+
+@atexit.register
+def close():
+    """Close this process's metrics file; the next metric opens it again"""
+    global _store, _store_key
+    with _store_lock:
+        if _store is not None:
+            _store.close()
+        _store = _store_key = None
+
+
+def _labels(labels):
+    return ','.join(f'{name}="{value}"' for name, value in sorted(labels.items()))
+
+
+def inc(name, amount=1, **labels):
+    """Increment a counter from COUNTERS"""
+    _get_store().inc(f'{name}\x00{_labels(labels)}\x00', amount)
+
+
+_bucket_keys = {}
+
+
+def observe(name, value, **labels):
+    """Record an observation in a histogram from HISTOGRAMS"""
+    label_str = _labels(labels)
+    keys = _bucket_keys.get((name, label_str))
+    if keys is None:
+        buckets = HISTOGRAMS[name][1]
+        keys = [f'{name}\x00{label_str}\x00{i}' for i in range(len(buckets) + 1)]
+        keys.append(f'{name}\x00{label_str}\x00sum')
+        _bucket_keys[(name, label_str)] = keys
+    # Buckets are stored per-interval and made cumulative when exported
+    index = len(HISTOGRAMS[name][1])
+    for i, bound in enumerate(HISTOGRAMS[name][1]):
+        if value <= bound:
+            index = i
+            break
+    store = _get_store()
+    store.inc(keys[index])
+    store.inc(keys[-1], value)
+
+
+def collect():
+    """Sum every worker's file into {(name, labels, suffix): value}"""
+    totals = {}
+    for path in glob.glob(os.path.join(settings.METRICS_DIR, 'metrics_*.db')):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) < _HEADER.size:
+            continue
+        used = min(_HEADER.unpack_from(data, 0)[0], len(data))
+        for key, value, _ in _read_entries(data, used):
+            key = tuple(key.split('\x00'))
+            totals[key] = totals.get(key, 0.0) + value
+    return totals
+
+
+def _format_value(value):
+    if value == math.floor(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def _format_bound(bound):
+    return '+Inf' if bound == math.inf else repr(float(bound))
+
+
+def render():
+    totals = collect()
+    by_metric = {}
+    for (name, labels, suffix), value in totals.items():
+        by_metric.setdefault(name, {}).setdefault(labels, {})[suffix] = value
+
+    lines = []
+    for name, (help_text, buckets) in HISTOGRAMS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} histogram')
+        for labels, values in sorted(by_metric.get(name, {}).items()):
+            prefix = f'{labels},' if labels else ''
+            cumulative = 0.0
+            for i, bound in enumerate(tuple(buckets) + (math.inf,)):
+                cumulative += values.get(str(i), 0.0)
+                lines.append(f'{name}_bucket{{{prefix}le="{_format_bound(bound)}"}} {_format_value(cumulative)}')
+            suffix = f'{{{labels}}}' if labels else ''
+            lines.append(f'{name}_sum{suffix} {_format_value(values.get("sum", 0.0))}')
+            lines.append(f'{name}_count{suffix} {_format_value(cumulative)}')
+    for name, help_text in COUNTERS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} counter')
+        series = by_metric.get(name, {})
+        if not series:
+            lines.append(f'{name} 0')
+        for labels, values in sorted(series.items()):
+            suffix = f'{{{labels}}}' if labels else ''
+            lines.append(f'{name}{suffix} {_format_value(values.get("", 0.0))}')
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint for staff sessions, or scrapers sending METRICS_TOKEN as a bearer token"""
+    token = settings.METRICS_TOKEN
+    sent = request.headers.get('Authorization', '').encode()
+    scraper = token and hmac.compare_digest(sent, f'Bearer {token}'.encode())
+    if not scraper and not request.user.is_staff:
+        return HttpResponseForbidden()
+    return HttpResponse(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class _QueryTimer:
+    __slots__ = ('count', 'seconds')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += perf_counter() - start
+
+
+class MetricsMiddleware:
+    """Record latency, query count and query time for every request by URL name"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timer = _QueryTimer()
+        start = perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(timer))
+            response = self.get_response(request)
+        duration = perf_counter() - start
+
+        match = request.resolver_match
+        view = match.view_name if match else 'unmatched'
+        observe('http_request_duration_seconds', duration, view=view)
+        observe('http_request_db_queries', timer.count, view=view)
+        observe('http_request_db_seconds', timer.seconds, view=view)
+        return response
+
+
+@receiver(post_save, sender='inventory.Order')
+def count_order(sender, instance, created, **kwargs):
+    if created:
+        inc('orders_created_total')
+
+
+@receiver(post_save, sender='inventory.Sale')
+def count_sale(sender, instance, created, **kwargs):
+    if created:
+        inc('sales_recorded_total')
+
+
+@receiver(post_save, sender='inventory.Notification')
+def count_notification(sender, instance, created, **kwargs):
+    if created:
+        inc('notifications_emitted_total', type=instance.type)
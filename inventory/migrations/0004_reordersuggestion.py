@@ -0,0 +1,33 @@
+# Generated by Django 4.2.7 on 2026-10-19 02:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0003_sale'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReorderSuggestion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('daily_velocity', models.FloatField(help_text='Average units sold per day over the history window')),
+                ('demand_std', models.FloatField(help_text='Standard deviation of daily units sold')),
+                ('weekday_factors', models.JSONField(default=list, help_text='Demand multiplier for Monday..Sunday')),
+                ('days_of_cover', models.FloatField(blank=True, help_text='Days current stock lasts; empty when nothing sells', null=True)),
+                ('reorder_point', models.PositiveIntegerField()),
+                ('reorder_quantity', models.PositiveIntegerField()),
+                ('computed_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='reorder_suggestion', to='inventory.product')),
+            ],
+            options={
+                'ordering': ['days_of_cover'],
+                'indexes': [models.Index(fields=['reorder_quantity', 'days_of_cover'], name='inventory_r_reorder_9b2016_idx')],
+            },
+        ),
+    ]
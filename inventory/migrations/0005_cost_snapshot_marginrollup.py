@@ -0,0 +1,40 @@
+# Generated by Django 4.2.7 on 2026-10-19 02:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0004_reordersuggestion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderitem',
+            name='unit_cost',
+            field=models.DecimalField(blank=True, decimal_places=2, help_text='Product cost when the line was created', max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='sale',
+            name='unit_cost',
+            field=models.DecimalField(blank=True, decimal_places=2, help_text='Product cost at the time of sale', max_digits=10, null=True),
+        ),
+        migrations.CreateModel(
+            name='MarginRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('source', models.CharField(choices=[('sale', 'Sale'), ('order', 'Delivered order')], max_length=10)),
+                ('quantity', models.PositiveIntegerField()),
+                ('revenue', models.DecimalField(decimal_places=2, max_digits=14)),
+                ('cost', models.DecimalField(decimal_places=2, max_digits=14)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='margin_rollups', to='inventory.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['day'], name='inventory_m_day_18a6c1_idx')],
+                'unique_together': {('day', 'source', 'product')},
+            },
+        ),
+    ]
@@ -0,0 +1,77 @@
+# Generated by Django 4.2.7 on 2026-10-19 02:57
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+SIZE_CODES = {'XS', 'S', 'M', 'L', 'XL', 'XXL', 'EU40', 'EU41', 'EU42', 'EU43', 'EU44'}
+
+
+def sku_prefix(sku, size, color):
+    # Frozen copy of ProductFamily.prefix_for
+    tokens = set(SIZE_CODES)
+    for value in (size, color):
+        if value:
+            tokens.update({value.upper(), value[:3].upper()})
+    parts = sku.split('-')
+    while len(parts) > 1 and parts[-1].upper() in tokens:
+        parts.pop()
+    return '-'.join(parts)
+
+
+def infer_families(apps, schema_editor):
+    """Group existing products by name and SKU prefix; one UPDATE per family"""
+    Product = apps.get_model('inventory', 'Product')
+    ProductFamily = apps.get_model('inventory', 'ProductFamily')
+
+    keys = {}
+    for pk, name, sku, size, color, category_id in Product.objects.filter(family__isnull=True).values_list(
+        'pk', 'name', 'sku', 'size', 'color', 'category_id'
+    ):
+        key = (name, sku_prefix(sku, size, color))
+        keys.setdefault(key, {'category_id': category_id, 'products': []})['products'].append(pk)
+    if not keys:
+        return
+
+    ProductFamily.objects.bulk_create(
+        [ProductFamily(name=name, sku_prefix=prefix, category_id=group['category_id'])
+         for (name, prefix), group in keys.items()],
+        ignore_conflicts=True,
+    )
+    family_ids = {
+        (name, prefix): pk
+        for pk, name, prefix in ProductFamily.objects.values_list('pk', 'name', 'sku_prefix')
+    }
+    for key, group in keys.items():
+        Product.objects.filter(pk__in=group['products']).update(family_id=family_ids[key])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0007_archive_tables'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductFamily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200)),
+                ('sku_prefix', models.CharField(help_text='SKU of the variants without size/color segments', max_length=50)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='families', to='inventory.category')),
+            ],
+            options={
+                'verbose_name_plural': 'product families',
+                'ordering': ['name'],
+                'unique_together': {('name', 'sku_prefix')},
+            },
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='family',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='variants', to='inventory.productfamily'),
+        ),
+        migrations.RunPython(infer_families, migrations.RunPython.noop),
+    ]
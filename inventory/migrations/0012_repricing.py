@@ -0,0 +1,45 @@
+# Generated by Django 4.2.7 on 2026-10-19 03:20
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('inventory', '0011_row_versions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Repricing',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('note', models.CharField(blank=True, max_length=200)),
+                ('rules', models.JSONField(default=list, help_text='The rules as applied, in order')),
+                ('change_count', models.PositiveIntegerField(default=0, help_text='Price changes written, over all rules')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='PriceChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rule', models.PositiveSmallIntegerField(help_text='Position of the rule in the run')),
+                ('old_price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('new_price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='price_changes', to='inventory.product')),
+                ('repricing', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='changes', to='inventory.repricing')),
+            ],
+            options={
+                'unique_together': {('repricing', 'rule', 'product')},
+            },
+        ),
+    ]
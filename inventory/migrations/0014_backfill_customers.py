@@ -0,0 +1,106 @@
+from decimal import Decimal
+
+from django.db import migrations, transaction
+from django.db.models import Count, DecimalField, F, IntegerField, Max, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest
+
+BATCH_SIZE = 2000
+
+
+def normalize_phone(phone):
+    # Frozen copy of Customer.normalize_phone() as of this migration
+    digits = ''.join(ch for ch in phone or '' if ch.isdigit())
+    if digits.startswith('0092'):
+        digits = digits[4:]
+    elif digits.startswith('92') and len(digits) == 12:
+        digits = digits[2:]
+    if len(digits) == 10 and digits.startswith('3'):
+        digits = '0' + digits
+    return digits if 7 <= len(digits) <= 20 else ''
+
+
+def link_batch(connection, Customer, model, rows):
+    """Create a customer per new phone number in ``rows`` and link the orders to them"""
+    details = {}
+    links = []
+    for row in rows:
+        phone = normalize_phone(row['customer_phone'])
+        if phone:
+            details.setdefault(phone, row)
+            links.append((phone, row['pk']))
+    if not links:
+        return
+
+    existing = set(Customer.objects.filter(phone__in=details).values_list('phone', flat=True))
+    Customer.objects.bulk_create([
+        Customer(phone=phone, name=row['customer_name'], email=row['customer_email'], address=row['customer_address'])
+        for phone, row in details.items() if phone not in existing
+    ])
+    ids = dict(Customer.objects.filter(phone__in=details).values_list('phone', 'pk'))
+    # A prepared statement run per row; bulk_update's CASE over the whole
+    # batch is quadratic and an ORM update per customer is mostly overhead
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f'UPDATE {connection.ops.quote_name(model._meta.db_table)} SET customer_id = %s WHERE id = %s',
+            [(ids[phone], pk) for phone, pk in links],
+        )
+
+
+def lifetime_totals(model):
+    orders = model.objects.filter(customer=OuterRef('pk')).order_by().values('customer')
+    count = orders.annotate(n=Count('pk')).values('n')
+    spent = orders.exclude(status='cancelled').annotate(total=Sum('total_amount')).values('total')
+    last = orders.annotate(last=Max('created_at')).values('last')
+    return (
+        Coalesce(Subquery(count), Value(0), output_field=IntegerField()),
+        Coalesce(Subquery(spent), Value(Decimal('0.00')), output_field=DecimalField(max_digits=12, decimal_places=2)),
+        Subquery(last),
+    )
+
+
+def backfill_customers(apps, schema_editor):
+    """Link existing orders to a customer per normalized phone number, then total each customer.
+
+    Orders are read in primary-key batches, each in its own transaction, and
+    only unlinked ones, so an interrupted run carries on where it stopped.
+    """
+    Customer = apps.get_model('inventory', 'Customer')
+    for model in (apps.get_model('inventory', 'ArchivedOrder'), apps.get_model('inventory', 'Order')):
+        last_pk = 0
+        while True:
+            with transaction.atomic():
+                rows = list(
+                    model.objects.filter(pk__gt=last_pk, customer__isnull=True).order_by('pk')
+                    .values('pk', 'customer_phone', 'customer_name', 'customer_email', 'customer_address')
+                    [:BATCH_SIZE]
+                )
+                if not rows:
+                    break
+                link_batch(schema_editor.connection, Customer, model, rows)
+            last_pk = rows[-1]['pk']
+
+    Order = apps.get_model('inventory', 'Order')
+    live_count, live_spent, live_last = lifetime_totals(Order)
+    archived_count, archived_spent, archived_last = lifetime_totals(apps.get_model('inventory', 'ArchivedOrder'))
+    # Details come from the customer's latest live order, as Customer.for_order() keeps them
+    latest = Order.objects.filter(customer=OuterRef('pk')).order_by('-created_at', '-pk')
+    Customer.objects.update(
+        order_count=live_count + archived_count,
+        total_spent=live_spent + archived_spent,
+        last_order_at=Greatest(Coalesce(live_last, archived_last), Coalesce(archived_last, live_last)),
+        name=Coalesce(Subquery(latest.values('customer_name')[:1]), F('name')),
+        email=Coalesce(Subquery(latest.values('customer_email')[:1]), F('email')),
+        address=Coalesce(Subquery(latest.values('customer_address')[:1]), F('address')),
+    )
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('inventory', '0013_customer'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_customers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+from django.db import migrations
+from django.db.models import DateTimeField, IntegerField, Value
+from django.utils import timezone
+
+OPENING = 1
+
+
+def open_ledger(apps, schema_editor):
+    """Start every product's ledger with its current stock, in one ``INSERT ... SELECT``"""
+    Product = apps.get_model('inventory', 'Product')
+    StockMovement = apps.get_model('inventory', 'StockMovement')
+    connection = schema_editor.connection
+    rows = (
+        Product.objects.order_by()
+        .annotate(
+            reason=Value(OPENING, output_field=IntegerField()),
+            at=Value(timezone.now(), output_field=DateTimeField()),
+        )
+        .values_list('pk', 'stock', 'reason', 'at')
+    )
+    sql, params = rows.query.get_compiler(connection.alias).as_sql()
+    columns = ', '.join(connection.ops.quote_name(name) for name in ('product_id', 'quantity', 'reason', 'created_at'))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {connection.ops.quote_name(StockMovement._meta.db_table)} ({columns}) {sql}', params,
+        )
+
+
+def close_ledger(apps, schema_editor):
+    apps.get_model('inventory', 'StockMovement').objects.filter(reason=OPENING).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0017_stock_ledger'),
+    ]
+
+    operations = [
+        migrations.RunPython(open_ledger, close_ledger),
+    ]
@@ -0,0 +1,89 @@
+# Generated by Django 4.2.7 on 2026-10-19 03:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0018_opening_stock'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Location',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('code', models.SlugField(help_text='Sent by POS terminals to sell from this location', max_length=20, unique=True)),
+                ('kind', models.CharField(choices=[('warehouse', 'Warehouse'), ('shop', 'Shop')], default='shop', max_length=10)),
+                ('is_default', models.BooleanField(default=False, help_text='Holds all stock not assigned elsewhere; orders and the sell page draw from it')),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ProductLocationStock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stock', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='located_stock',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='stockmovement',
+            name='reason',
+            field=models.PositiveSmallIntegerField(choices=[(1, 'Opening balance'), (2, 'Product created'), (3, 'Edited'), (4, 'Order'), (5, 'Order edited'), (6, 'Order cancelled'), (7, 'Sale'), (8, 'Stock take'), (9, 'Correction'), (10, 'Transfer')]),
+        ),
+        migrations.AddField(
+            model_name='productlocationstock',
+            name='location',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='product_stocks', to='inventory.location'),
+        ),
+        migrations.AddField(
+            model_name='productlocationstock',
+            name='product',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='location_stocks', to='inventory.product'),
+        ),
+        migrations.AddConstraint(
+            model_name='location',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_default', True)), fields=('is_default',), name='one_default_location'),
+        ),
+        migrations.AddField(
+            model_name='archivedsale',
+            name='location',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='inventory.location'),
+        ),
+        migrations.AddField(
+            model_name='sale',
+            name='location',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='sales', to='inventory.location'),
+        ),
+        migrations.AddIndex(
+            model_name='sale',
+            index=models.Index(fields=['location', 'created_at'], name='sale_location_time'),
+        ),
+        migrations.AddField(
+            model_name='stockmovement',
+            name='location',
+            field=models.ForeignKey(blank=True, db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='inventory.location'),
+        ),
+        migrations.AddIndex(
+            model_name='productlocationstock',
+            index=models.Index(fields=['location', 'stock'], name='locationstock_level'),
+        ),
+        migrations.AddConstraint(
+            model_name='productlocationstock',
+            constraint=models.UniqueConstraint(fields=('location', 'product'), name='unique_location_stock'),
+        ),
+    ]
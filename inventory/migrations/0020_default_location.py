@@ -0,0 +1,19 @@
+from django.db import migrations
+
+
+def create_default_location(apps, schema_editor):
+    """All stock so far is at one place: make it the default location"""
+    Location = apps.get_model('inventory', 'Location')
+    if not Location.objects.filter(is_default=True).exists():
+        Location.objects.create(name='Warehouse', code='warehouse', kind='warehouse', is_default=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0019_locations'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_default_location, migrations.RunPython.noop),
+    ]
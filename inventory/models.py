@@ -1,10 +1,16 @@
-from django.db import models
+from decimal import Decimal
+from django.core.exceptions import ValidationError
+from django.db import models, router
+from django.db.models import F, Q, Value
+from django.db.models.functions import Coalesce, Greatest
 from django.utils import timezone
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 import uuid
 
+from . import metrics
+
 class Category(models.Model):
     name = models.CharField(max_length=100, unique=True)
     description = models.TextField(blank=True)
@@ -15,6 +21,58 @@ class Category(models.Model):
     def __str__(self):
         return self.name
 
+class Location(models.Model):
+    """A shop or warehouse holding stock; see `inventory.locations`"""
+    KIND_CHOICES = [
+        ('warehouse', 'Warehouse'),
+        ('shop', 'Shop'),
+    ]
+
+    name = models.CharField(max_length=100, unique=True)
+    code = models.SlugField(max_length=20, unique=True, help_text='Sent by POS terminals to sell from this location')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, default='shop')
+    is_default = models.BooleanField(
+        default=False, help_text='Holds all stock not assigned elsewhere; orders and the sell page draw from it',
+    )
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['name']
+        constraints = [
+            models.UniqueConstraint(fields=['is_default'], condition=Q(is_default=True), name='one_default_location'),
+        ]
+
+    def __str__(self):
+        return self.name
+
+class ProductFamily(models.Model):
+    """One garment sold in several sizes and colors; each variant is a Product"""
+    name = models.CharField(max_length=200)
+    sku_prefix = models.CharField(max_length=50, help_text='SKU of the variants without size/color segments')
+    category = models.ForeignKey(Category, on_delete=models.PROTECT, related_name='families')
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['name']
+        unique_together = [('name', 'sku_prefix')]
+        verbose_name_plural = 'product families'
+
+    def __str__(self):
+        return f"{self.name} ({self.sku_prefix})"
+
+    @staticmethod
+    def prefix_for(sku, size='', color=''):
+        """Strip trailing SKU segments naming a size or color: JNS-BLU-M -> JNS"""
+        variant_tokens = {code.upper() for code, _ in Product.SIZES}
+        for value in (size, color):
+            if value:
+                variant_tokens.update({value.upper(), value[:3].upper()})
+        parts = sku.split('-')
+        while len(parts) > 1 and parts[-1].upper() in variant_tokens:
+            parts.pop()
+        return '-'.join(parts)
+
 class Product(models.Model):
     SIZES = [
         ('XS', 'XS'), ('S', 'S'), ('M', 'M'), ('L', 'L'), ('XL', 'XL'), ('XXL', 'XXL'),
@@ -24,17 +82,23 @@ class Product(models.Model):
     name = models.CharField(max_length=200)
     sku = models.CharField(max_length=50, unique=True)
     category = models.ForeignKey(Category, on_delete=models.PROTECT, related_name='products')
+    family = models.ForeignKey(ProductFamily, on_delete=models.SET_NULL, null=True, blank=True, related_name='variants')
     size = models.CharField(max_length=10, blank=True)
     color = models.CharField(max_length=50, blank=True)
 
     price = models.DecimalField(max_digits=10, decimal_places=2)
     cost = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     stock = models.PositiveIntegerField(default=0)
+    # Units at locations other than the default; the rest is at the default
+    # location. Both are rollups kept by inventory.locations
+    located_stock = models.PositiveIntegerField(default=0, editable=False)
     reorder_threshold = models.PositiveIntegerField(default=0, help_text='Alert when stock ≤ this value')
 
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
+    # Moved by every edit; see concurrency.save_changes()
+    version = models.PositiveIntegerField(default=1)
 
     class Meta:
         indexes = [
@@ -44,24 +108,150 @@ class Product(models.Model):
         ordering = ['name']
         unique_together = [('name', 'sku')]
 
+    # Stock when loaded or last saved, for the stock ledger; None for new
+    # products and when stock was not loaded
+    _saved_stock = None
+    # Reason, order, sale and user for the ledger row of the next stock change
+    # saved; see reduce_stock() and inventory/ledger.py
+    _stock_tags = None
+
     def __str__(self):
         return f"{self.name} ({self.sku})"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        product = super().from_db(db, field_names, values)
+        product._saved_stock = product.__dict__.get('stock')
+        return product
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        # Reloaded stock is the new baseline for the next ledger row
+        if fields is None or 'stock' in fields:
+            self._saved_stock = self.stock
+
+    def save(self, *args, **kwargs):
+        # New variants join the family their name and SKU prefix point to
+        if self.family_id is None and self.sku and self.category_id and not kwargs.get('update_fields'):
+            self.family, _ = ProductFamily.objects.get_or_create(
+                name=self.name,
+                sku_prefix=ProductFamily.prefix_for(self.sku, self.size, self.color),
+                defaults={'category_id': self.category_id},
+            )
+        super().save(*args, **kwargs)
+
+    def clean(self):
+        if self.stock < self.located_stock:
+            raise ValidationError({
+                'stock': f'{self.located_stock} units are at other locations; transfer them back before lowering stock below that.',
+            })
+
     @property
     def inventory_value(self):
         return self.price * self.stock
 
+    @property
+    def default_location_stock(self):
+        return self.stock - self.located_stock
+
     @property
     def low_stock(self):
         return self.reorder_threshold and self.stock <= self.reorder_threshold
 
-    def reduce_stock(self, quantity):
-        """Reduce stock by quantity and return True if successful"""
-        if self.stock >= quantity:
-            self.stock -= quantity
-            self.save()
-            return True
-        return False
+    def reduce_stock(self, quantity, **tags):
+        """Reduce stock at the default location by quantity and return True if successful
+
+        One ``UPDATE ... WHERE stock >= located_stock + quantity``, as in
+        ``services.sell_scanned()``: the check is made on the row, not on the
+        stock this instance was loaded with, so two concurrent sales can
+        neither both take the last units nor write over each other's
+        decrement. ``stock`` is then read back, and ``post_save`` sent for the
+        ledger row, which ``tags`` (``reason``, ``order``, ``sale``, ``user``)
+        label.
+        """
+        model = type(self)
+        moved = model.objects.filter(pk=self.pk, stock__gte=F('located_stock') + quantity).update(
+            stock=F('stock') - quantity, updated_at=timezone.now()
+        )
+        self.stock, self.located_stock, self.updated_at = model.objects.filter(pk=self.pk).values_list(
+            'stock', 'located_stock', 'updated_at'
+        ).get()
+        if not moved:
+            self._saved_stock = self.stock
+            metrics.inc('stock_decrement_failures_total')
+            return False
+        self._saved_stock = self.stock + quantity
+        self._stock_tags = tags
+        post_save.send(
+            sender=model, instance=self, created=False, raw=False,
+            using=router.db_for_write(model, instance=self), update_fields=frozenset({'stock', 'updated_at'}),
+        )
+        return True
+
+class Customer(models.Model):
+    """A buyer identified by phone number, with lifetime totals kept up to date by each order.
+
+    ``order_count`` counts every order placed, ``total_spent`` the totals of
+    those not cancelled. Both move by deltas as orders are placed, edited
+    and cancelled (``Order.record_spend()``), follow an order whose phone is
+    changed to another customer (``Order.relink_customer()``), and outlive
+    archived orders.
+    """
+    phone = models.CharField(max_length=20, unique=True, help_text='Normalized; see normalize_phone()')
+    name = models.CharField(max_length=200)
+    email = models.EmailField(blank=True)
+    address = models.TextField(blank=True)
+    order_count = models.PositiveIntegerField(default=0)
+    total_spent = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    last_order_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['name']
+
+    def __str__(self):
+        return f"{self.name} ({self.phone})"
+
+    @staticmethod
+    def normalize_phone(phone):
+        """National digits of a phone number: '+92 300-1234567' and '0300 1234567' are both 03001234567.
+
+        Returns '' for anything with fewer than 7 digits, which identifies no one.
+        """
+        digits = ''.join(ch for ch in phone or '' if ch.isdigit())
+        if digits.startswith('0092'):
+            digits = digits[4:]
+        elif digits.startswith('92') and len(digits) == 12:
+            digits = digits[2:]
+        if len(digits) == 10 and digits.startswith('3'):
+            digits = '0' + digits
+        return digits if 7 <= len(digits) <= 20 else ''
+
+    @classmethod
+    def for_order(cls, order):
+        """The customer with the order's phone number, created or updated from its details"""
+        phone = cls.normalize_phone(order.customer_phone)
+        if not phone:
+            return None
+        details = {
+            'name': order.customer_name or '',
+            'email': order.customer_email or '',
+            'address': order.customer_address or '',
+        }
+        customer, created = cls.objects.get_or_create(phone=phone, defaults=details)
+        if not created and any(getattr(customer, name) != value for name, value in details.items()):
+            # The latest order has the details to autofill next time
+            cls.objects.filter(pk=customer.pk).update(**details)
+        return customer
+
+    @classmethod
+    def record(cls, customer_id, placed_at=None, spent=0):
+        """Count an order placed at ``placed_at`` and add ``spent`` to the lifetime totals"""
+        changes = {'total_spent': F('total_spent') + Value(spent)}
+        if placed_at is not None:
+            changes['order_count'] = F('order_count') + 1
+            changes['last_order_at'] = Greatest(Coalesce(F('last_order_at'), Value(placed_at)), Value(placed_at))
+        cls.objects.filter(pk=customer_id).update(**changes)
 
 class Order(models.Model):
     STATUS_CHOICES = [
@@ -73,7 +263,18 @@ class Order(models.Model):
         ('cancelled', 'Cancelled'),
     ]
 
+    # Statuses each status may move to; delivered and cancelled are final
+    STATUS_TRANSITIONS = {
+        'pending': ('confirmed', 'processing', 'cancelled'),
+        'confirmed': ('processing', 'shipped', 'cancelled'),
+        'processing': ('shipped', 'cancelled'),
+        'shipped': ('delivered',),
+        'delivered': (),
+        'cancelled': (),
+    }
+
     order_number = models.CharField(max_length=20, unique=True)
+    customer = models.ForeignKey(Customer, on_delete=models.SET_NULL, null=True, blank=True, related_name='orders')
     customer_name = models.CharField(max_length=200)
     customer_email = models.EmailField(blank=True)
     customer_phone = models.CharField(max_length=20)
@@ -86,13 +287,35 @@ class Order(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     
     notes = models.TextField(blank=True, help_text='Internal notes for this order')
+    # Moved by every edit and status transition; see concurrency.save_changes()
+    version = models.PositiveIntegerField(default=1)
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['created_at']),
+        ]
+
+    # What this order counted toward its customer's spend when loaded or last
+    # recorded; None when status or total were not loaded
+    _recorded_spend = Decimal('0.00')
+    # Status when loaded or last saved, for the order.status_changed webhook
+    _saved_status = None
+    # Phone when loaded or last saved, to move the order to another customer
+    _saved_phone = None
 
     def __str__(self):
         return f"Order {self.order_number} - {self.customer_name}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        order = super().from_db(db, field_names, values)
+        loaded = 'status' in order.__dict__ and 'total_amount' in order.__dict__
+        order._recorded_spend = order.counted_spend if loaded else None
+        order._saved_status = order.__dict__.get('status')
+        order._saved_phone = order.__dict__.get('customer_phone')
+        return order
+
     def save(self, *args, **kwargs):
         # Ensure a unique order number is assigned when creating via admin or elsewhere
         if not self.order_number:
@@ -102,7 +325,52 @@ class Order(models.Model):
                 if not type(self).objects.filter(order_number=candidate).exists():
                     self.order_number = candidate
                     break
+        placed = self._state.adding
+        if placed and self.customer_id is None:
+            self.customer = Customer.for_order(self)
+        elif not placed and self.relink_customer() and kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'customer'}
         super().save(*args, **kwargs)
+        self._saved_phone = self.__dict__.get('customer_phone')
+        self.record_spend(placed=placed)
+
+    def relink_customer(self):
+        """Move the order, with its count and spend, to the customer its edited phone number names.
+
+        Sets ``customer`` for the caller to save; returns whether it changed.
+        """
+        if self._saved_phone is None or self.customer_phone == self._saved_phone:
+            return False
+        self._saved_phone = self.customer_phone
+        customer = Customer.for_order(self)
+        customer_id = customer.pk if customer else None
+        if customer_id == self.customer_id:
+            return False
+        spent = self._recorded_spend or 0
+        if self.customer_id:
+            # last_order_at is left as it was; it only ever moves forward
+            Customer.objects.filter(pk=self.customer_id).update(
+                order_count=Greatest(F('order_count') - 1, Value(0)),
+                total_spent=F('total_spent') - Value(spent),
+            )
+        if customer_id:
+            Customer.record(customer_id, placed_at=self.created_at, spent=spent)
+        self.customer = customer
+        return True
+
+    @property
+    def counted_spend(self):
+        """What this order adds to its customer's lifetime spend; cancelled orders add nothing"""
+        return Decimal('0.00') if self.status == 'cancelled' else Decimal(self.total_amount)
+
+    def record_spend(self, placed=False):
+        """Move the customer's totals by this order's change since it was loaded or last recorded"""
+        if self._recorded_spend is None:
+            return
+        spent = self.counted_spend - self._recorded_spend
+        self._recorded_spend = self.counted_spend
+        if self.customer_id and (placed or spent):
+            Customer.record(self.customer_id, placed_at=self.created_at if placed else None, spent=spent)
 
     def calculate_total(self):
         """Calculate and update total amount"""
@@ -111,6 +379,9 @@ class Order(models.Model):
         self.save()
         return total
 
+    def can_transition_to(self, status):
+        return status == self.status or status in self.STATUS_TRANSITIONS.get(self.status, ())
+
     @property
     def item_count(self):
         return sum(item.quantity for item in self.items.all())
@@ -120,11 +391,15 @@ class OrderItem(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField()
     unit_price = models.DecimalField(max_digits=10, decimal_places=2)
+    unit_cost = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True, help_text='Product cost when the line was created')
     
     created_at = models.DateTimeField(default=timezone.now)
 
     class Meta:
         unique_together = ['order', 'product']
+        indexes = [
+            models.Index(fields=['created_at']),
+        ]
 
     def __str__(self):
         return f"{self.quantity}x {self.product.name} in {self.order.order_number}"
@@ -139,6 +414,8 @@ class OrderItem(models.Model):
         # Set unit price from product if not provided
         if not self.unit_price and self.product:
             self.unit_price = self.product.price
+        if self.unit_cost is None and self.product:
+            self.unit_cost = self.product.cost
         super().save(*args, **kwargs)
 
 class Notification(models.Model):
@@ -161,10 +438,24 @@ class Notification(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['created_at']),
+            # The unread count and latest alerts, see inventory/notifications.py
+            models.Index(fields=['created_at'], condition=models.Q(is_read=False), name='notification_unread'),
+        ]
+
+    # is_read when loaded or last saved, for the unread counter
+    _saved_is_read = None
 
     def __str__(self):
         return f"{self.get_type_display()}: {self.title}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        notification = super().from_db(db, field_names, values)
+        notification._saved_is_read = notification.__dict__.get('is_read')
+        return notification
+
 # Signal handlers for automatic notifications and stock management
 @receiver(post_save, sender=Order)
 def create_order_notification(sender, instance, created, **kwargs):
@@ -181,20 +472,343 @@ class Sale(models.Model):
     quantity = models.PositiveIntegerField()
     unit_price = models.DecimalField(max_digits=10, decimal_places=2)
     total_amount = models.DecimalField(max_digits=12, decimal_places=2)
+    unit_cost = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True, help_text='Product cost at the time of sale')
+    # Null for sales at the default location
+    location = models.ForeignKey(Location, on_delete=models.PROTECT, null=True, blank=True, related_name='sales', db_index=False)
     created_at = models.DateTimeField(default=timezone.now)
     created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['created_at']),
+            models.Index(fields=['location', 'created_at'], name='sale_location_time'),
+        ]
 
     def __str__(self):
         return f"Sale: {self.quantity}x {self.product.name} @ {self.unit_price}"
 
+    def save(self, *args, **kwargs):
+        # Snapshot cost so later cost changes do not rewrite past margins
+        if self.unit_cost is None and self.product_id:
+            self.unit_cost = self.product.cost
+        super().save(*args, **kwargs)
+
+class MarginRollup(models.Model):
+    """Units, revenue and cost of goods per product per day, built by `rollup_margins`"""
+    SOURCE_CHOICES = [
+        ('sale', 'Sale'),
+        ('order', 'Delivered order'),
+    ]
+
+    day = models.DateField()
+    source = models.CharField(max_length=10, choices=SOURCE_CHOICES)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='margin_rollups')
+    quantity = models.PositiveIntegerField()
+    revenue = models.DecimalField(max_digits=14, decimal_places=2)
+    cost = models.DecimalField(max_digits=14, decimal_places=2)
+
+    class Meta:
+        unique_together = [('day', 'source', 'product')]
+        indexes = [
+            models.Index(fields=['day']),
+        ]
+
+    def __str__(self):
+        return f"{self.get_source_display()} {self.product_id} on {self.day}"
+
+class ReorderSuggestion(models.Model):
+    """Latest replenishment forecast for a product, rewritten by `forecast_reorders`"""
+    product = models.OneToOneField(Product, on_delete=models.CASCADE, related_name='reorder_suggestion')
+    daily_velocity = models.FloatField(help_text='Average units sold per day over the history window')
+    demand_std = models.FloatField(help_text='Standard deviation of daily units sold')
+    weekday_factors = models.JSONField(default=list, help_text='Demand multiplier for Monday..Sunday')
+    days_of_cover = models.FloatField(null=True, blank=True, help_text='Days current stock lasts; empty when nothing sells')
+    reorder_point = models.PositiveIntegerField()
+    reorder_quantity = models.PositiveIntegerField()
+    computed_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['days_of_cover']
+        indexes = [
+            models.Index(fields=['reorder_quantity', 'days_of_cover']),
+        ]
+
+    def __str__(self):
+        return f"Reorder {self.reorder_quantity} of {self.product.name}"
+
+class IdempotencyKey(models.Model):
+    """A client-supplied request key and the response it produced, replayed on retries"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='idempotency_keys')
+    scope = models.CharField(max_length=50, help_text='Endpoint the key was used on')
+    key = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=64, help_text='SHA-256 of the request body')
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True, help_text='Empty while the first request is running')
+    content_type = models.CharField(max_length=100, blank=True)
+    response_body = models.BinaryField(blank=True, default=b'')
+    created_at = models.DateTimeField(default=timezone.now)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'scope', 'key'], name='unique_idempotency_key'),
+        ]
+        indexes = [
+            models.Index(fields=['expires_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.scope}:{self.key}"
+
+class ArchivedOrder(models.Model):
+    """A finished order moved out of the live table by `archive_history`; keeps its id"""
+    id = models.BigIntegerField(primary_key=True)
+    order_number = models.CharField(max_length=20, db_index=True)
+    customer = models.ForeignKey(
+        Customer, on_delete=models.SET_NULL, null=True, blank=True, related_name='archived_orders'
+    )
+    customer_name = models.CharField(max_length=200)
+    customer_email = models.EmailField(blank=True)
+    customer_phone = models.CharField(max_length=20)
+    customer_address = models.TextField()
+    status = models.CharField(max_length=20, choices=Order.STATUS_CHOICES)
+    total_amount = models.DecimalField(max_digits=10, decimal_places=2)
+    created_at = models.DateTimeField(db_index=True)
+    updated_at = models.DateTimeField()
+    notes = models.TextField(blank=True)
+    archived_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"Archived order {self.order_number} - {self.customer_name}"
+
+class ArchivedOrderItem(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    order = models.ForeignKey(ArchivedOrder, on_delete=models.CASCADE, related_name='items')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    quantity = models.PositiveIntegerField()
+    unit_price = models.DecimalField(max_digits=10, decimal_places=2)
+    unit_cost = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    created_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.quantity}x {self.product_id} in archived order {self.order_id}"
+
+class ArchivedSale(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    product = models.ForeignKey(Product, on_delete=models.PROTECT, related_name='archived_sales')
+    quantity = models.PositiveIntegerField()
+    unit_price = models.DecimalField(max_digits=10, decimal_places=2)
+    total_amount = models.DecimalField(max_digits=12, decimal_places=2)
+    unit_cost = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    location = models.ForeignKey(Location, on_delete=models.PROTECT, null=True, blank=True, related_name='+', db_index=False)
+    created_at = models.DateTimeField(db_index=True)
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    archived_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"Archived sale: {self.quantity}x {self.product_id} @ {self.unit_price}"
+
+class StockTake(models.Model):
+    """A physical count loaded from a file, reconciled against stock by `inventory.stocktake`"""
+    STATUS_CHOICES = [
+        ('draft', 'Draft'),
+        ('applied', 'Applied'),
+    ]
+
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='draft')
+    note = models.CharField(max_length=200, blank=True)
+    line_count = models.PositiveIntegerField(default=0, help_text='Distinct SKUs in the counted file')
+    unknown_count = models.PositiveIntegerField(default=0, help_text='Counted SKUs with no matching product')
+    created_at = models.DateTimeField(default=timezone.now)
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    applied_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"Stock take {self.pk} ({self.get_status_display()})"
+
+class StockCountLine(models.Model):
+    """Staging row for one counted SKU; matched rows are cleared once the take is applied"""
+    stock_take = models.ForeignKey(StockTake, on_delete=models.CASCADE, related_name='lines')
+    sku = models.CharField(max_length=50)
+    counted = models.PositiveIntegerField()
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['stock_take', 'sku']),
+        ]
+
+    def __str__(self):
+        return f"{self.sku}: {self.counted}"
+
+class StockAdjustment(models.Model):
+    """A counted quantity that differed from stock, with the price and cost to value it"""
+    stock_take = models.ForeignKey(StockTake, on_delete=models.CASCADE, related_name='adjustments')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='stock_adjustments')
+    expected = models.PositiveIntegerField(help_text='Stock when the count was loaded')
+    counted = models.PositiveIntegerField()
+    variance = models.IntegerField(help_text='counted - expected')
+    unit_price = models.DecimalField(max_digits=10, decimal_places=2)
+    unit_cost = models.DecimalField(max_digits=10, decimal_places=2)
+
+    class Meta:
+        unique_together = [('stock_take', 'product')]
+
+    def __str__(self):
+        return f"{self.product_id}: {self.variance:+d}"
+
+class Repricing(models.Model):
+    """One run of repricing rules applied by `inventory.repricing`"""
+    note = models.CharField(max_length=200, blank=True)
+    rules = models.JSONField(default=list, help_text='The rules as applied, in order')
+    change_count = models.PositiveIntegerField(default=0, help_text='Price changes written, over all rules')
+    created_at = models.DateTimeField(default=timezone.now)
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"Repricing {self.pk} ({self.change_count} changes)"
+
+class PriceChange(models.Model):
+    """A product's price before and after one rule of a repricing run"""
+    repricing = models.ForeignKey(Repricing, on_delete=models.CASCADE, related_name='changes')
+    rule = models.PositiveSmallIntegerField(help_text='Position of the rule in the run')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='price_changes')
+    old_price = models.DecimalField(max_digits=10, decimal_places=2)
+    new_price = models.DecimalField(max_digits=10, decimal_places=2)
+
+    class Meta:
+        unique_together = [('repricing', 'rule', 'product')]
+
+    def __str__(self):
+        return f"{self.product_id}: {self.old_price} -> {self.new_price}"
+
+class StockMovement(models.Model):
+    """One change to a product's stock; append-only, written by `inventory.ledger`"""
+    class Reason(models.IntegerChoices):
+        OPENING = 1, 'Opening balance'
+        CREATED = 2, 'Product created'
+        EDIT = 3, 'Edited'
+        ORDER = 4, 'Order'
+        ORDER_EDIT = 5, 'Order edited'
+        ORDER_CANCELLED = 6, 'Order cancelled'
+        SALE = 7, 'Sale'
+        STOCK_TAKE = 8, 'Stock take'
+        CORRECTION = 9, 'Correction'
+        TRANSFER = 10, 'Transfer'
+
+    # Compact columns and no foreign key constraints or cascades on the
+    # references: the table grows without bound, and archived orders and
+    # sales keep their ids
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, db_index=False, related_name='stock_movements')
+    quantity = models.IntegerField(help_text='Units added; negative when stock went down')
+    reason = models.PositiveSmallIntegerField(choices=Reason.choices)
+    order = models.ForeignKey(Order, on_delete=models.DO_NOTHING, db_constraint=False, null=True, blank=True, related_name='+')
+    sale = models.ForeignKey(Sale, on_delete=models.DO_NOTHING, db_constraint=False, db_index=False, null=True, blank=True, related_name='+')
+    user = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, db_index=False, null=True, blank=True, related_name='+')
+    # Null for the default location
+    location = models.ForeignKey(Location, on_delete=models.DO_NOTHING, db_constraint=False, db_index=False, null=True, blank=True, related_name='+')
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['product', 'created_at'], name='stockmovement_product_time'),
+            models.Index(fields=['created_at'], name='stockmovement_time'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id}: {self.quantity:+d} ({self.get_reason_display()})"
+
+class ProductLocationStock(models.Model):
+    """Units of a product at a location other than the default, moved by `inventory.locations`"""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='location_stocks')
+    location = models.ForeignKey(Location, on_delete=models.PROTECT, related_name='product_stocks', db_index=False)
+    stock = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['location', 'product'], name='unique_location_stock'),
+        ]
+        indexes = [
+            models.Index(fields=['location', 'stock'], name='locationstock_level'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} at {self.location_id}: {self.stock}"
+
+class StockSnapshot(models.Model):
+    """A product's stock as of ``taken_at``, summed from the ledger by `inventory.ledger.take_snapshots`"""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, db_index=False, related_name='stock_snapshots')
+    taken_at = models.DateTimeField()
+    stock = models.IntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'taken_at'], name='unique_stock_snapshot'),
+        ]
+        indexes = [
+            models.Index(fields=['taken_at'], name='stocksnapshot_time'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} at {self.taken_at}: {self.stock}"
+
+class WebhookEndpoint(models.Model):
+    """A receiver URL subscribed to order and stock events, sent by `deliver_webhooks`"""
+    url = models.URLField(max_length=500)
+    secret = models.CharField(max_length=100, help_text='Key for the HMAC-SHA256 signature on every delivery')
+    events = models.JSONField(default=list, blank=True, help_text='Event types to send, e.g. ["order.created"]; empty for all')
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return self.url
+
+class WebhookEvent(models.Model):
+    """One event queued for one endpoint, written in the transaction that caused it"""
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('delivered', 'Delivered'),
+        ('dead', 'Dead'),
+    ]
+
+    endpoint = models.ForeignKey(WebhookEndpoint, on_delete=models.CASCADE, related_name='queued_events')
+    type = models.CharField(max_length=50)
+    object_id = models.PositiveBigIntegerField(help_text='The order or product the event is about')
+    data = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.CharField(max_length=500, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    delivered_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['pk']
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.type} {self.object_id} ({self.get_status_display()})"
+
 @receiver(post_save, sender=OrderItem)
 def process_order_item(sender, instance, created, **kwargs):
     if created:
         # Reduce stock automatically
-        if instance.product.reduce_stock(instance.quantity):
+        if instance.product.reduce_stock(instance.quantity, reason=StockMovement.Reason.ORDER, order=instance.order):
             # Check if stock is now low
             if instance.product.low_stock:
                 Notification.objects.create(
@@ -208,7 +822,7 @@ def process_order_item(sender, instance, created, **kwargs):
             Notification.objects.create(
                 type='stock_update',
                 title=f'Insufficient Stock: {instance.product.name}',
-                message=f'Order #{instance.order.order_number} requires {instance.quantity} units but only {instance.product.stock} available',
+                message=f'Order #{instance.order.order_number} requires {instance.quantity} units but only {instance.product.default_location_stock} available',
                 order=instance.order,
                 product=instance.product
             )
\ No newline at end of file
@@ -0,0 +1,108 @@
+"""
+The unread notification count and latest alerts shown on every page.
+
+``base.html`` reads both through the ``navigation`` context processor, so
+they come from the shared cache instead of a query per request:
+
+* The unread count is a counter in the cache. Creating an unread
+  notification adds one and marking one read takes one off, with ``incr``
+  once the transaction commits, so a rolled-back notification is never
+  counted. Writes that mark many rows go through ``mark_read()``, which
+  moves the counter by the rows its ``UPDATE`` actually changed.
+* The latest unread alerts are a short cached list, dropped whenever the
+  counter moves and rebuilt by the next page with one query on the partial
+  unread index.
+* The counter is recounted from the table, on the same index, when it
+  expires after ``UNREAD_RECOUNT_SECONDS``, when it is evicted, and after
+  deletes (``recount_unread()``), which bounds any drift from deletes or
+  lost updates.
+
+Code that writes ``is_read`` or creates notifications with ``QuerySet``
+methods skips the model signal and must call ``add_unread()`` or
+``recount_unread()`` itself.
+"""
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils.functional import SimpleLazyObject
+
+from .models import Notification
+
+UNREAD_KEY = 'notifications:unread'
+LATEST_KEY = 'notifications:latest'
+LATEST_SIZE = 5
+
+Alert = namedtuple('Alert', 'id type title created_at')
+NavNotifications = namedtuple('NavNotifications', 'unread latest')
+
+
+def unread_count():
+    count = cache.get(UNREAD_KEY)
+    if count is None:
+        count = Notification.objects.filter(is_read=False).count()
+        # add() leaves a counter another request just set and moved alone
+        if not cache.add(UNREAD_KEY, count, timeout=settings.UNREAD_RECOUNT_SECONDS):
+            count = cache.get(UNREAD_KEY, count)
+    return max(count, 0)
+
+
+def latest_unread():
+    latest = cache.get(LATEST_KEY)
+    if latest is None:
+        latest = [
+            Alert(*row) for row in Notification.objects.filter(is_read=False).order_by('-created_at')
+            .values_list('pk', 'type', 'title', 'created_at')[:LATEST_SIZE]
+        ]
+        cache.set(LATEST_KEY, latest, timeout=settings.UNREAD_RECOUNT_SECONDS)
+    return latest
+
+
+def _move(delta):
+    try:
+        cache.incr(UNREAD_KEY, delta)
+    except ValueError:
+        # Not cached; the next page counts
+        pass
+    cache.delete(LATEST_KEY)
+
+
+def add_unread(delta):
+    """Move the unread counter by ``delta`` once the current transaction commits"""
+    if delta:
+        transaction.on_commit(lambda: _move(delta))
+
+
+def recount_unread():
+    """Have the next page recount, after deletes or other writes that skip ``add_unread()``"""
+    transaction.on_commit(lambda: cache.delete_many([UNREAD_KEY, LATEST_KEY]))
+
+
+def mark_read(queryset, is_read=True):
+    """Set ``is_read`` on ``queryset`` in one ``UPDATE``; returns the rows that changed"""
+    updated = queryset.filter(is_read=not is_read).update(is_read=is_read)
+    add_unread(-updated if is_read else updated)
+    return updated
+
+
+def navigation(request):
+    """Context processor: ``nav_notifications`` with the unread count and latest alerts"""
+    if not request.user.is_authenticated:
+        return {}
+    # Lazy, so responses that do not render the navigation bar never look
+    return {'nav_notifications': SimpleLazyObject(lambda: NavNotifications(unread_count(), latest_unread()))}
+
+
+@receiver(post_save, sender=Notification)
+def notification_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        if not instance.is_read:
+            add_unread(1)
+    elif instance._saved_is_read is not None and instance.is_read != instance._saved_is_read:
+        add_unread(-1 if instance.is_read else 1)
+    instance._saved_is_read = instance.is_read
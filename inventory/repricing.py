@@ -0,0 +1,194 @@
+"""
+Bulk repricing: change many prices by rule in set-based steps.
+
+A ``RepricingRule`` picks products by category, size and color, and moves
+their price by a percentage or an amount. The result is rounded (to the
+paisa, the rupee, or a ``x9`` / ``x99`` ending) and can be held to a
+minimum gross margin over ``cost``, which wins over the rounding. The new
+price is one SQL expression, so:
+
+* ``preview()`` counts the products a rule matches and changes, and totals
+  the stock value before and after, in one aggregate query, plus a few
+  sample rows;
+* ``apply_repricing()`` copies each rule's changes into ``PriceChange``
+  with one ``INSERT ... SELECT``, then sets every changed price with one
+  ``UPDATE`` that reads the new price back from that history, all in one
+  transaction. No row passes through Python.
+
+Rules in a run apply in order, so a later rule starts from the prices an
+earlier one set. Each rule's preview is against current prices.
+"""
+from collections import namedtuple
+from decimal import Decimal
+
+from django.db import connections, router, transaction
+from django.db.models import Case, Count, DecimalField, F, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Ceil, Greatest, Round
+from django.db.models.lookups import GreaterThanOrEqual
+from django.utils import timezone
+
+from . import catalog
+from .models import PriceChange, Product, Repricing
+
+MODES = ('percent', 'amount')
+ROUNDINGS = ('paisa', 'rupee', 'x9', 'x99')
+
+RepricingRule = namedtuple(
+    'RepricingRule',
+    'mode value rounding min_margin category sizes colors',
+    defaults=('paisa', None, None, (), ()),
+)
+RulePreview = namedtuple(
+    'RulePreview', 'matched changed raised lowered floored value_before value_after samples'
+)
+PriceSample = namedtuple('PriceSample', 'id sku name cost old_price new_price')
+
+_PRICE = DecimalField(max_digits=10, decimal_places=2)
+_PAISA = Decimal('0.01')
+
+
+def check_rule(rule):
+    """Raise ``ValueError`` naming the first thing wrong with ``rule``"""
+    if rule.mode not in MODES:
+        raise ValueError(f'Unknown change mode {rule.mode!r}; use one of {", ".join(MODES)}.')
+    if rule.mode == 'percent' and rule.value <= -100:
+        raise ValueError('A percentage change must be greater than -100.')
+    if rule.rounding not in ROUNDINGS:
+        raise ValueError(f'Unknown rounding {rule.rounding!r}; use one of {", ".join(ROUNDINGS)}.')
+    if rule.min_margin is not None and not 0 <= rule.min_margin < 100:
+        raise ValueError('A minimum margin must be at least 0 and under 100 percent.')
+
+
+def _ending(price, step):
+    # Nearest price ending in step - 1 (1234 -> 1239 for x9); prices under
+    # one step are only rounded to the rupee
+    charm = Round((price + Value(1)) / Value(step)) * Value(step) - Value(1)
+    return Case(When(GreaterThanOrEqual(price, Value(step)), then=charm), default=Round(price), output_field=_PRICE)
+
+
+def _rounded(price, rounding):
+    if rounding == 'rupee':
+        return Round(price)
+    if rounding == 'x9':
+        return _ending(price, 10)
+    if rounding == 'x99':
+        return _ending(price, 100)
+    return Round(price, 2)
+
+
+def _floor_price(min_margin):
+    # Lowest price with (price - cost) / price >= min_margin, up to the next paisa
+    return Ceil(F('cost') / Value(1 - min_margin / 100) * Value(100)) / Value(100)
+
+
+def price_expression(rule):
+    """The SQL expression for a product's new price under ``rule``"""
+    if rule.mode == 'percent':
+        changed = F('price') * Value(1 + rule.value / 100)
+    else:
+        changed = F('price') + Value(rule.value)
+    price = _rounded(changed, rule.rounding)
+    if rule.min_margin is not None:
+        price = Greatest(price, _floor_price(rule.min_margin))
+    return Greatest(price, Value(Decimal('0.00')), output_field=_PRICE)
+
+
+def matched_products(rule, queryset=None):
+    """Active products ``rule`` applies to, annotated with ``new_price``"""
+    queryset = Product.objects.all() if queryset is None else queryset
+    queryset = queryset.filter(is_active=True)
+    if rule.category is not None:
+        queryset = queryset.filter(category_id=rule.category)
+    if rule.sizes:
+        queryset = queryset.filter(size__in=rule.sizes)
+    if rule.colors:
+        queryset = queryset.filter(color__in=rule.colors)
+    return queryset.annotate(new_price=price_expression(rule))
+
+
+def preview(rule, queryset=None, sample_size=10):
+    """What ``rule`` would change, totalled in one query, with ``sample_size`` changed rows"""
+    check_rule(rule)
+    products = matched_products(rule, queryset)
+    changed = ~Q(new_price=F('price'))
+    aggregates = {
+        'matched': Count('pk'),
+        'changed': Count('pk', filter=changed),
+        'raised': Count('pk', filter=Q(new_price__gt=F('price'))),
+        'lowered': Count('pk', filter=Q(new_price__lt=F('price'))),
+        'value_before': Sum(F('price') * F('stock'), output_field=_PRICE),
+        'value_after': Sum(F('new_price') * F('stock'), output_field=_PRICE),
+    }
+    if rule.min_margin is not None:
+        # Products the margin floor held above the rounded change
+        unfloored = price_expression(rule._replace(min_margin=None))
+        aggregates['floored'] = Count('pk', filter=Q(new_price__gt=unfloored))
+    totals = products.aggregate(**aggregates)
+    # SQLite hands computed decimals back unquantized
+    samples = [
+        PriceSample(pk, sku, name, cost, price, new_price.quantize(_PAISA))
+        for pk, sku, name, cost, price, new_price in products.filter(changed).order_by('name', 'pk')
+        .values_list('pk', 'sku', 'name', 'cost', 'price', 'new_price')[:sample_size]
+    ]
+    return RulePreview(
+        matched=totals['matched'],
+        changed=totals['changed'],
+        raised=totals['raised'],
+        lowered=totals['lowered'],
+        floored=totals.get('floored', 0),
+        value_before=(totals['value_before'] or Decimal('0.00')).quantize(_PAISA),
+        value_after=(totals['value_after'] or Decimal('0.00')).quantize(_PAISA),
+        samples=samples,
+    )
+
+
+def _insert_history(repricing, position, products):
+    """Copy the changed rows of ``products`` into ``PriceChange`` with one ``INSERT ... SELECT``"""
+    rows = (
+        products.exclude(new_price=F('price')).order_by()
+        .annotate(run=Value(repricing.pk), position=Value(position))
+        .values_list('pk', 'price', 'new_price', 'run', 'position')
+    )
+    # Compiled for the primary: a read replica may be behind this transaction
+    db = router.db_for_write(PriceChange)
+    sql, params = rows.query.get_compiler(db).as_sql()
+    table = PriceChange._meta.db_table
+    with connections[db].cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {table} (product_id, old_price, new_price, repricing_id, rule) {sql}', params
+        )
+        return cursor.rowcount
+
+
+def rule_as_json(rule):
+    return {
+        name: str(value) if isinstance(value, Decimal) else list(value) if isinstance(value, tuple) else value
+        for name, value in rule._asdict().items()
+    }
+
+
+@transaction.atomic
+def apply_repricing(rules, user=None, note='', queryset=None):
+    """Apply ``rules`` in order as one ``Repricing`` run and return it.
+
+    ``queryset`` narrows every rule to those products (an admin selection).
+    """
+    for rule in rules:
+        check_rule(rule)
+    repricing = Repricing.objects.create(
+        created_by=user, note=note, rules=[rule_as_json(rule) for rule in rules]
+    )
+    now = timezone.now()
+    for position, rule in enumerate(rules):
+        repricing.change_count += _insert_history(repricing, position, matched_products(rule, queryset))
+        written = PriceChange.objects.filter(repricing=repricing, rule=position)
+        Product.objects.filter(pk__in=written.values('product_id')).update(
+            price=Subquery(written.filter(product=OuterRef('pk')).values('new_price')[:1]),
+            updated_at=now,
+            version=F('version') + 1,
+        )
+
+    repricing.save(update_fields=['change_count'])
+    catalog.bump_generation()
+    catalog.bump_sku_generation()
+    return repricing
@@ -0,0 +1,101 @@
+"""
+Primary/replica database routing.
+
+Only active when ``DATABASE_REPLICA_URL`` adds a ``replica`` alias to
+``settings.DATABASES``. Reads are sent to the replica only while serving a
+safe (GET, HEAD or OPTIONS) request for a view marked with ``replica_reads``; everything
+else stays on the primary:
+
+* any write, and any read after a write in the same request
+* anything inside an atomic block on the primary
+* auth and session tables
+* every request from a client that wrote within the last
+  ``REPLICA_PIN_SECONDS``, so staff see their own changes despite replica lag
+"""
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+REPLICA_DB_ALIAS = 'replica'
+PIN_COOKIE_NAME = 'pin_primary'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+REPLICA_APP_LABELS = {'inventory'}
+
+
+class _RequestState:
+    __slots__ = ('replica_reads', 'pinned', 'wrote')
+
+    def __init__(self, pinned=False):
+        self.replica_reads = False
+        self.pinned = pinned
+        self.wrote = False
+
+
+_request_state = ContextVar('replica_request_state', default=None)
+
+
+def replica_reads(view_func):
+    """Mark a function view as safe to serve from the replica on GET, HEAD and OPTIONS"""
+    view_func.replica_reads = True
+    return view_func
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _request_state.get()
+        if state is None or not state.replica_reads or state.pinned or state.wrote:
+            return None
+        # Sessions and users must never be read stale, or a fresh login bounces
+        if model._meta.app_label not in REPLICA_APP_LABELS:
+            return None
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        return REPLICA_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        state = _request_state.get()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same rows as the primary
+        aliases = {DEFAULT_DB_ALIAS, REPLICA_DB_ALIAS}
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+
+class ReplicaRoutingMiddleware:
+    """Track per-request routing state and pin recent writers to the primary"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        state = _RequestState(pinned=PIN_COOKIE_NAME in request.COOKIES)
+        token = _request_state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_state.reset(token)
+        if state.wrote:
+            response.set_cookie(
+                PIN_COOKIE_NAME, '1',
+                max_age=settings.REPLICA_PIN_SECONDS,
+                httponly=True,
+                samesite='Lax',
+            )
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.method not in SAFE_METHODS:
+            return None
+        # Class-based views expose the class as view_class, DRF viewsets as cls
+        view_class = getattr(view_func, 'view_class', None) or getattr(view_func, 'cls', None)
+        if getattr(view_func, 'replica_reads', False) or getattr(view_class, 'replica_reads', False):
+            state = _request_state.get()
+            if state is not None:
+                state.replica_reads = True
+        return None
@@ -1,5 +1,9 @@
 from rest_framework import serializers
-from .models import Category, Product
+from . import catalog, ledger
+from .analytics import GROUPINGS, PERIODS
+from .concurrency import save_changes
+from .models import Category, Customer, Location, Product, ProductFamily, Order
+from .repricing import MODES, ROUNDINGS, RepricingRule, check_rule
 
 class CategorySerializer(serializers.ModelSerializer):
     product_count = serializers.SerializerMethodField()
@@ -9,18 +13,214 @@ class CategorySerializer(serializers.ModelSerializer):
         fields = ['id', 'name', 'description', 'product_count']
     
     def get_product_count(self, obj):
+        # List views annotate the count; a single saved instance counts directly
+        if hasattr(obj, 'active_product_count'):
+            return obj.active_product_count
         return obj.products.filter(is_active=True).count()
 
+def resolve_location(code):
+    """The active location with this code as a ``CachedLocation``; no code is None"""
+    if not code:
+        return None
+    location = catalog.location(code)
+    if location is None:
+        raise serializers.ValidationError(f'No active location with code {code}.')
+    return location
+
+class LocationSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Location
+        fields = ['id', 'code', 'name', 'kind', 'is_default']
+
 class ProductSerializer(serializers.ModelSerializer):
-    category_name = serializers.CharField(source='category.name', read_only=True)
+    category_name = serializers.SerializerMethodField()
     inventory_value = serializers.ReadOnlyField()
     low_stock = serializers.ReadOnlyField()
+    location_stock = serializers.SerializerMethodField()
+    expected_stock = serializers.IntegerField(
+        write_only=True, required=False, min_value=0,
+        help_text='The stock the product was loaded with; an update only changes stock when this is sent',
+    )
     
     class Meta:
         model = Product
         fields = [
             'id', 'name', 'sku', 'category', 'category_name', 'size', 'color',
-            'price', 'cost', 'stock', 'reorder_threshold', 'is_active',
-            'created_at', 'updated_at', 'inventory_value', 'low_stock'
+            'price', 'cost', 'stock', 'located_stock', 'location_stock', 'reorder_threshold', 'is_active',
+            'created_at', 'updated_at', 'inventory_value', 'low_stock', 'version', 'expected_stock',
         ]
-        read_only_fields = ['created_at', 'updated_at']
+        read_only_fields = ['located_stock', 'created_at', 'updated_at']
+
+    def get_category_name(self, obj):
+        return catalog.category_names().get(obj.category_id)
+
+    def get_location_stock(self, obj):
+        # Annotated when the list is filtered by location
+        return getattr(obj, 'location_stock', None)
+
+    def validate_stock(self, value):
+        if self.instance is not None and value < self.instance.located_stock:
+            raise serializers.ValidationError(
+                f'{self.instance.located_stock} units are at other locations; transfer them back first.'
+            )
+        return value
+
+    def create(self, validated_data):
+        validated_data.pop('expected_stock', None)
+        return super().create(validated_data)
+
+    def update(self, instance, validated_data):
+        # Conditional on the submitted version, or the one just loaded if none was sent.
+        # Sales do not move the version, so a stock value is only an edit when it comes
+        # with the stock it was loaded at; otherwise it is what the client last read,
+        # and writing it back would undo the sales made since.
+        expected = validated_data.pop('expected_stock', None)
+        if expected is None or validated_data.get('stock') == expected:
+            validated_data.pop('stock', None)
+        instance.version = validated_data.pop('version', instance.version)
+        changed = [name for name, value in validated_data.items() if getattr(instance, name) != value]
+        for name in changed:
+            setattr(instance, name, validated_data[name])
+        ledger.tag(instance, user=self.context['request'].user)
+        save_changes(instance, changed, expect={'stock': expected} if 'stock' in changed else None)
+        return instance
+
+class ProductFamilySerializer(serializers.ModelSerializer):
+    """One row per family; expects the annotations from families.family_summaries()"""
+    category_name = serializers.SerializerMethodField()
+    variant_count = serializers.IntegerField(read_only=True)
+    total_stock = serializers.IntegerField(read_only=True)
+    min_price = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)
+    max_price = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)
+    low_stock = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ProductFamily
+        fields = [
+            'id', 'name', 'sku_prefix', 'category', 'category_name',
+            'variant_count', 'total_stock', 'min_price', 'max_price', 'low_stock',
+        ]
+
+    def get_category_name(self, obj):
+        return catalog.category_names().get(obj.category_id)
+
+    def get_low_stock(self, obj):
+        return obj.low_stock_count > 0
+
+class VariantCellSerializer(serializers.ModelSerializer):
+    low_stock = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Product
+        fields = ['id', 'sku', 'price', 'stock', 'reorder_threshold', 'is_active', 'low_stock']
+
+    def get_low_stock(self, obj):
+        return bool(obj.low_stock)
+
+class OrderStatusTransitionSerializer(serializers.Serializer):
+    order_ids = serializers.ListField(child=serializers.IntegerField(min_value=1), allow_empty=False)
+    status = serializers.ChoiceField(choices=Order.STATUS_CHOICES)
+
+class ScanSellSerializer(serializers.Serializer):
+    sku = serializers.CharField(max_length=50)
+    quantity = serializers.IntegerField(min_value=1, default=1)
+    # The terminal's location code; the default location if left out
+    location = serializers.CharField(max_length=20, required=False, default='')
+
+    def validate_location(self, value):
+        return resolve_location(value)
+
+class StockTransferSerializer(serializers.Serializer):
+    product = serializers.PrimaryKeyRelatedField(queryset=Product.objects.all())
+    source = serializers.CharField(max_length=20)
+    destination = serializers.CharField(max_length=20)
+    quantity = serializers.IntegerField(min_value=1)
+
+    def validate_source(self, value):
+        return resolve_location(value)
+
+    def validate_destination(self, value):
+        return resolve_location(value)
+
+    def validate(self, attrs):
+        if attrs['source'] == attrs['destination']:
+            raise serializers.ValidationError('Source and destination must differ.')
+        return attrs
+
+class MarginReportQuerySerializer(serializers.Serializer):
+    group_by = serializers.ChoiceField(choices=list(GROUPINGS), required=False, default='category')
+    period = serializers.ChoiceField(choices=PERIODS, required=False, allow_blank=True, default='')
+    start = serializers.DateField(required=False, allow_null=True, default=None)
+    end = serializers.DateField(required=False, allow_null=True, default=None)
+    source = serializers.ChoiceField(choices=['sale', 'order'], required=False, allow_blank=True, default='')
+    include_archive = serializers.BooleanField(required=False, default=True)
+
+    def validate(self, data):
+        if data['start'] and data['end'] and data['start'] > data['end']:
+            raise serializers.ValidationError('start must not be after end.')
+        return data
+
+class MarginRowSerializer(serializers.Serializer):
+    group = serializers.CharField(allow_null=True)
+    period = serializers.DateField(allow_null=True)
+    quantity = serializers.IntegerField()
+    revenue = serializers.DecimalField(max_digits=14, decimal_places=2)
+    cost = serializers.DecimalField(max_digits=14, decimal_places=2)
+    margin = serializers.DecimalField(max_digits=14, decimal_places=2)
+    margin_percent = serializers.DecimalField(max_digits=7, decimal_places=1, allow_null=True)
+
+class RepricingRuleSerializer(serializers.Serializer):
+    """One repricing rule; validates to a ``repricing.RepricingRule``"""
+    mode = serializers.ChoiceField(choices=MODES)
+    value = serializers.DecimalField(max_digits=10, decimal_places=2)
+    rounding = serializers.ChoiceField(choices=ROUNDINGS, required=False, default='paisa')
+    min_margin = serializers.DecimalField(max_digits=5, decimal_places=2, required=False, allow_null=True, default=None)
+    category = serializers.PrimaryKeyRelatedField(
+        queryset=Category.objects.all(), required=False, allow_null=True, default=None
+    )
+    sizes = serializers.ListField(child=serializers.CharField(max_length=10), required=False, default=list)
+    colors = serializers.ListField(child=serializers.CharField(max_length=50), required=False, default=list)
+
+    def validate(self, data):
+        rule = RepricingRule(
+            mode=data['mode'],
+            value=data['value'],
+            rounding=data['rounding'],
+            min_margin=data['min_margin'],
+            category=data['category'].pk if data['category'] else None,
+            sizes=tuple(data['sizes']),
+            colors=tuple(data['colors']),
+        )
+        try:
+            check_rule(rule)
+        except ValueError as e:
+            raise serializers.ValidationError(str(e))
+        return rule
+
+class RepricingSerializer(serializers.Serializer):
+    rules = RepricingRuleSerializer(many=True, allow_empty=False)
+    note = serializers.CharField(max_length=200, required=False, allow_blank=True, default='')
+
+class PriceSampleSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    sku = serializers.CharField()
+    name = serializers.CharField()
+    cost = serializers.DecimalField(max_digits=10, decimal_places=2)
+    old_price = serializers.DecimalField(max_digits=10, decimal_places=2)
+    new_price = serializers.DecimalField(max_digits=10, decimal_places=2)
+
+class RulePreviewSerializer(serializers.Serializer):
+    matched = serializers.IntegerField()
+    changed = serializers.IntegerField()
+    raised = serializers.IntegerField()
+    lowered = serializers.IntegerField()
+    floored = serializers.IntegerField()
+    value_before = serializers.DecimalField(max_digits=16, decimal_places=2)
+    value_after = serializers.DecimalField(max_digits=16, decimal_places=2)
+    samples = PriceSampleSerializer(many=True)
+
+class CustomerSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Customer
+        fields = ['id', 'phone', 'name', 'email', 'address', 'order_count', 'total_spent', 'last_order_at']
+        read_only_fields = fields
@@ -0,0 +1,401 @@
+"""
+Write paths that touch several tables at once and must stay set-based.
+
+Each function runs in a single transaction and issues a fixed number of
+queries regardless of how many rows it touches.
+"""
+from collections import Counter, namedtuple
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Case, DecimalField, F, Subquery, Sum, Value, When
+from django.utils import timezone
+
+from . import ledger, locations, metrics, webhooks
+from .concurrency import save_changes
+from .models import Customer, Notification, Order, OrderItem, Product, Sale, StockMovement
+from .notifications import add_unread
+
+TransitionResult = namedtuple('TransitionResult', 'updated skipped')
+ScanSale = namedtuple('ScanSale', 'sale stock')
+Transfer = namedtuple('Transfer', 'source_stock destination_stock')
+
+
+class InsufficientStock(Exception):
+    def __init__(self, product, available, requested):
+        self.product = product
+        self.available = available
+        self.requested = requested
+        super().__init__(
+            f'Insufficient stock for {product.name}. '
+            f'Available: {available}, Requested: {requested}'
+        )
+
+
+def apply_stock_deltas(deltas, reason, order_lines=None, user=None):
+    """Take ``{product_id: units}`` out of stock (negative units restock).
+
+    Locks the affected rows, refuses the whole change if any product's stock
+    at the default location would go negative, then applies every delta in
+    one ``UPDATE ... CASE``. The ledger
+    gets a row per product, or per ``(order_id, product_id, units)`` in
+    ``order_lines`` when the deltas add up several orders. Returns the locked
+    products with their stock as it was before the update.
+    """
+    deltas = {pk: units for pk, units in deltas.items() if units}
+    if not deltas:
+        return {}
+    products = Product.objects.select_for_update().in_bulk(deltas)
+    for pk, units in deltas.items():
+        if units > 0 and products[pk].default_location_stock < units:
+            metrics.inc('stock_decrement_failures_total')
+            raise InsufficientStock(products[pk], products[pk].default_location_stock, units)
+
+    Product.objects.filter(pk__in=deltas).update(
+        stock=Case(*[When(pk=pk, then=F('stock') - units) for pk, units in deltas.items()]),
+        updated_at=timezone.now(),
+    )
+
+    stock = {pk: product.stock for pk, product in products.items()}
+    moves = []
+    for order_id, pk, units in order_lines or [(None, pk, units) for pk, units in deltas.items()]:
+        if pk in stock:
+            moves.append(ledger.Move(
+                pk, stock[pk], stock[pk] - units, products[pk].reorder_threshold, reason,
+                order_id=order_id, user_id=getattr(user, 'pk', None),
+            ))
+            stock[pk] -= units
+    ledger.record(moves)
+    return products
+
+
+def create_notifications(notifications):
+    """Insert notifications in one query; bulk_create skips post_save, so count them here"""
+    if not notifications:
+        return
+    Notification.objects.bulk_create(notifications)
+    add_unread(sum(not n.is_read for n in notifications))
+    for notification_type, count in Counter(n.type for n in notifications).items():
+        metrics.inc('notifications_emitted_total', count, type=notification_type)
+
+
+def add_customer_spend(amounts):
+    """Add ``{customer_id: amount}`` to customers' lifetime spend in one ``UPDATE ... CASE``"""
+    amounts = {pk: amount for pk, amount in amounts.items() if amount}
+    if not amounts:
+        return
+    Customer.objects.filter(pk__in=amounts).update(
+        total_spent=F('total_spent') + Case(
+            *[When(pk=pk, then=Value(amount)) for pk, amount in amounts.items()],
+            output_field=DecimalField(max_digits=12, decimal_places=2),
+        )
+    )
+
+
+def held_stock(order_ids):
+    """Units each order holds per product, as ``{(order_id, product_id): units}``.
+
+    Read from the orders' net ledger movements rather than their lines, since
+    ``process_order_item`` saves a line without taking stock when the product
+    runs short. Orders placed before the ledger was opened have no movements
+    of their own and hold their line quantities.
+    """
+    Reason = StockMovement.Reason
+    opened = StockMovement.objects.order_by('created_at').values('created_at')[:1]
+    held = Counter()
+    unledgered = set()
+    for order_id, product_id, units in (
+        OrderItem.objects.filter(order_id__in=order_ids, order__created_at__lt=Subquery(opened))
+        .values_list('order_id', 'product_id', 'quantity')
+    ):
+        held[order_id, product_id] += units
+        unledgered.add(order_id)
+    for order_id, product_id, units in (
+        StockMovement.objects.filter(
+            order_id__in=order_ids, reason__in=[Reason.ORDER, Reason.ORDER_EDIT, Reason.ORDER_CANCELLED],
+        )
+        .values('order_id', 'product_id')
+        .annotate(units=Sum('quantity'))
+        .values_list('order_id', 'product_id', 'units')
+    ):
+        if order_id not in unledgered:
+            held[order_id, product_id] -= units
+    return held
+
+
+def low_stock_notifications(products, deltas):
+    """Unsaved low-stock notifications for products that ``deltas`` pushed to their threshold"""
+    notifications = []
+    for pk, units in deltas.items():
+        product = products.get(pk)
+        if product is None or units <= 0:
+            continue
+        stock = product.stock - units
+        if product.reorder_threshold and stock <= product.reorder_threshold:
+            notifications.append(Notification(
+                type='low_stock',
+                title=f'Low Stock Alert: {product.name}',
+                message=f'{product.name} is now at {stock} units (threshold: {product.reorder_threshold})',
+                product=product,
+            ))
+    return notifications
+
+
+@transaction.atomic
+def save_order_edit(form, formset, user=None):
+    """Save an edited order header and item formset, adjusting stock by the diff.
+
+    Stock moves by the net change per product between the lines as loaded and
+    the lines as submitted, so changed quantities and deleted lines are
+    accounted for, not only new ones. Raises ``InsufficientStock`` and rolls
+    back everything if a product cannot cover its increase, and
+    ``VersionConflict`` if the order was saved by someone else since the form
+    was loaded.
+    """
+    order = form.save(commit=False)
+    deleted_forms = set(formset.deleted_forms)
+    # A cancelled order holds no stock, so cancelling through the form restocks its lines
+    held_before = form.initial.get('status') != 'cancelled'
+    held_after = order.status != 'cancelled'
+
+    old_quantities = Counter()
+    new_quantities = Counter()
+    to_create, to_update, to_delete = [], [], []
+    total = Decimal('0.00')
+
+    for item_form in formset.forms:
+        item = item_form.instance
+        if item.pk:
+            # The instance already carries the submitted values; initial is what was loaded
+            if held_before:
+                old_quantities[item_form.initial['product']] += item_form.initial['quantity']
+            if item_form in deleted_forms:
+                to_delete.append(item.pk)
+                continue
+            if item_form.has_changed():
+                if item.product_id != item_form.initial['product']:
+                    item.unit_cost = None
+                to_update.append(item)
+        else:
+            if not item_form.has_changed() or item_form in deleted_forms:
+                continue
+            item.order = order
+            to_create.append(item)
+        if not item.unit_price:
+            item.unit_price = item.product.price
+        # bulk writes skip OrderItem.save(), which snapshots the cost
+        if item.unit_cost is None:
+            item.unit_cost = item.product.cost
+        if held_after:
+            new_quantities[item.product_id] += item.quantity
+        total += item.subtotal
+
+    if held_before and not held_after:
+        # Give back what the order actually took, not what its lines ask for
+        old_quantities = Counter()
+        for (_, pk), units in held_stock([order.pk]).items():
+            old_quantities[pk] += units
+    deltas = {
+        pk: new_quantities[pk] - old_quantities[pk]
+        for pk in set(old_quantities) | set(new_quantities)
+    }
+    if held_before and not held_after:
+        reason = StockMovement.Reason.ORDER_CANCELLED
+    else:
+        reason = StockMovement.Reason.ORDER_EDIT
+    products = apply_stock_deltas(
+        deltas, reason, order_lines=[(order.pk, pk, units) for pk, units in deltas.items()], user=user,
+    )
+
+    if to_delete:
+        OrderItem.objects.filter(pk__in=to_delete).delete()
+    if to_update:
+        OrderItem.objects.bulk_update(to_update, ['product', 'quantity', 'unit_price', 'unit_cost'])
+    if to_create:
+        OrderItem.objects.bulk_create(to_create)
+
+    create_notifications(low_stock_notifications(products, deltas))
+
+    # Conditional on the version the form was loaded at; a conflict rolls back the lines and stock too
+    order.total_amount = total
+    fields = [*form.changed_data, 'total_amount']
+    if order.relink_customer():
+        fields.append('customer')
+    save_changes(order, fields)
+    order.record_spend()
+    return order
+
+
+@transaction.atomic
+def transition_orders(order_ids, status, user=None):
+    """Move many orders to ``status`` at once, skipping disallowed transitions.
+
+    Orders move with one ``UPDATE ... WHERE id IN (...) AND status IN (...)``
+    limited to the statuses allowed to reach ``status``. Cancelled orders give
+    back the stock they hold (see ``held_stock``) in one ``UPDATE`` and have
+    their totals taken off their
+    customers' lifetime spend in another. One ``order_status`` notification
+    and one ``order.status_changed`` webhook per moved order are each written
+    in a single insert.
+    """
+    if status not in dict(Order.STATUS_CHOICES):
+        raise ValueError(f'Unknown order status: {status}')
+    allowed_from = [
+        current for current, targets in Order.STATUS_TRANSITIONS.items() if status in targets
+    ]
+    order_ids = set(order_ids)
+    orders = list(
+        Order.objects.select_for_update()
+        .filter(pk__in=order_ids, status__in=allowed_from)
+        .order_by()
+        .values_list('pk', 'order_number', 'status', 'customer_id', 'total_amount')
+    )
+    moved = [pk for pk, *_ in orders]
+    if not moved:
+        return TransitionResult(updated=[], skipped=sorted(order_ids))
+
+    Order.objects.filter(pk__in=moved, status__in=allowed_from).update(
+        status=status, updated_at=timezone.now(), version=F('version') + 1
+    )
+    webhooks.emit(
+        webhooks.status_event(pk, order_number, previous, status) for pk, order_number, previous, _, _ in orders
+    )
+
+    if status == 'cancelled':
+        restock = [
+            (order_id, product_id, -units) for (order_id, product_id), units in held_stock(moved).items() if units
+        ]
+        deltas = Counter()
+        for _, product_id, units in restock:
+            deltas[product_id] += units
+        apply_stock_deltas(deltas, StockMovement.Reason.ORDER_CANCELLED, order_lines=restock, user=user)
+        refunded = Counter()
+        for _, _, _, customer_id, total in orders:
+            if customer_id:
+                refunded[customer_id] += total
+        add_customer_spend({customer_id: -total for customer_id, total in refunded.items()})
+
+    labels = dict(Order.STATUS_CHOICES)
+    create_notifications([
+        Notification(
+            type='order_status',
+            title=f'Order #{order_number} {labels[status]}',
+            message=f'Order #{order_number} moved from {labels[previous]} to {labels[status]}',
+            order_id=pk,
+        )
+        for pk, order_number, previous, _, _ in orders
+    ])
+    return TransitionResult(updated=sorted(moved), skipped=sorted(order_ids - set(moved)))
+
+
+@transaction.atomic
+def sell_scanned(entry, quantity, user=None, location=None):
+    """Sell ``quantity`` of a product resolved by ``catalog.scan_entry()``.
+
+    Stock comes off the terminal's ``location`` (the default one if None)
+    with one ``UPDATE ... WHERE stock >= quantity``, so two terminals
+    selling the last unit cannot both succeed and no row lock is held across
+    queries. Away from the default location that is the location's own row,
+    and the product's totals follow it (see ``inventory.locations``). Price
+    and cost come from the scan entry, which product writes invalidate.
+    Raises ``InsufficientStock`` if the location cannot cover the sale;
+    ``ScanSale.stock`` is what the location has left.
+    """
+    location_id = locations.located_id(location)
+    now = timezone.now()
+    if location_id is None:
+        moved = Product.objects.filter(pk=entry.id, stock__gte=F('located_stock') + quantity).update(
+            stock=F('stock') - quantity, updated_at=now
+        )
+    else:
+        moved = locations.take(entry.id, location_id, quantity)
+    if not moved:
+        metrics.inc('stock_decrement_failures_total')
+        raise InsufficientStock(entry, locations.stock_at(entry.id, location_id), quantity)
+
+    sale = Sale.objects.create(
+        product_id=entry.id,
+        quantity=quantity,
+        unit_price=entry.price,
+        total_amount=entry.price * quantity,
+        unit_cost=entry.cost,
+        location_id=location_id,
+        created_by=user,
+    )
+    if location_id is not None:
+        # The product row comes after the location's, as in transfers, and as
+        # late as it can, to keep its lock short (see inventory.locations)
+        Product.objects.filter(pk=entry.id).update(
+            stock=F('stock') - quantity, located_stock=F('located_stock') - quantity, updated_at=now
+        )
+    stock, located = Product.objects.filter(pk=entry.id).values_list('stock', 'located_stock').first() or (0, 0)
+    left = stock - located if location_id is None else locations.stock_at(entry.id, location_id)
+    ledger.record([ledger.Move(
+        entry.id, stock + quantity, stock, entry.reorder_threshold, StockMovement.Reason.SALE,
+        sale_id=sale.pk, user_id=getattr(user, 'pk', None), location_id=location_id,
+    )])
+    if entry.reorder_threshold and stock <= entry.reorder_threshold:
+        create_notifications([Notification(
+            type='low_stock',
+            title=f'Low Stock Alert: {entry.name}',
+            message=f'{entry.name} is now at {stock} units (threshold: {entry.reorder_threshold})',
+            product_id=entry.id,
+        )])
+    return ScanSale(sale=sale, stock=left)
+
+
+@transaction.atomic
+def transfer_stock(product, source, destination, quantity, user=None):
+    """Move ``quantity`` units of ``product`` between two locations (or their codes).
+
+    Units leave ``source`` with a conditional ``UPDATE``, as a sale there
+    would take them, so a transfer cannot move what a terminal just sold.
+    The product's total does not change. Raises ``InsufficientStock`` if
+    the source is short and ``ValueError`` for a transfer to the same
+    place. Returns the stock left at each end.
+    """
+    source_id, destination_id = locations.located_id(source), locations.located_id(destination)
+    if source_id == destination_id:
+        raise ValueError('A transfer needs two different locations.')
+    now = timezone.now()
+
+    def take():
+        if source_id is None:
+            return Product.objects.filter(pk=product.pk, stock__gte=F('located_stock') + quantity).update(
+                located_stock=F('located_stock') + quantity, updated_at=now
+            )
+        return locations.take(product.pk, source_id, quantity)
+
+    def put():
+        if destination_id is None:
+            Product.objects.filter(pk=product.pk).update(located_stock=F('located_stock') - quantity, updated_at=now)
+        else:
+            locations.put(product.pk, destination_id, quantity)
+        return True
+
+    # Rows are written in the one order every stock path uses, so two
+    # transactions never wait on each other in a cycle: location rows by
+    # location id, then the product row. A put made before a failed take is
+    # rolled back with it.
+    steps = [(source_id, take), (destination_id, put)]
+    steps.sort(key=lambda step: (step[0] is None, step[0] or 0))
+    if not all(step() for _, step in steps):
+        metrics.inc('stock_decrement_failures_total')
+        raise InsufficientStock(product, locations.stock_at(product.pk, source_id), quantity)
+
+    transfer = Transfer(
+        source_stock=locations.stock_at(product.pk, source_id),
+        destination_stock=locations.stock_at(product.pk, destination_id),
+    )
+    user_id = getattr(user, 'pk', None)
+    ledger.record([
+        ledger.Move(
+            product.pk, transfer.source_stock + quantity, transfer.source_stock, product.reorder_threshold,
+            StockMovement.Reason.TRANSFER, user_id=user_id, location_id=source_id,
+        ),
+        ledger.Move(
+            product.pk, transfer.destination_stock - quantity, transfer.destination_stock, product.reorder_threshold,
+            StockMovement.Reason.TRANSFER, user_id=user_id, location_id=destination_id,
+        ),
+    ])
+    return transfer
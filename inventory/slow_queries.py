@@ -0,0 +1,120 @@
+"""
+Opt-in slow-query log.
+
+``SlowQueryMiddleware`` wraps every connection while a request runs and logs
+each query slower than ``SLOW_QUERY_THRESHOLD_MS`` as one JSON line on the
+``inventory.slow_queries`` logger (a rotating file, see settings). The first
+time a process sees a query shape it also captures the database's plan with
+EXPLAIN / EXPLAIN QUERY PLAN. ``manage.py slow_queries`` summarizes the log.
+"""
+from contextlib import ExitStack
+import hashlib
+import json
+import logging
+import re
+import threading
+import traceback
+from time import perf_counter
+
+from django.conf import settings
+from django.db import connections, transaction
+
+logger = logging.getLogger('inventory.slow_queries')
+
+_IN_LIST = re.compile(r'\((?:%s,\s*)+%s\)')
+_WHITESPACE = re.compile(r'\s+')
+_EXPLAINABLE = ('SELECT', 'WITH', 'UPDATE', 'DELETE')
+# Middleware frames that sit under every query and say nothing about its origin
+_INSTRUMENTATION_FILES = ('metrics.py', 'slow_queries.py', 'routers.py')
+
+_explained = set()
+_explained_lock = threading.Lock()
+_local = threading.local()
+
+
+def query_shape(sql):
+    """SQL with IN lists of any length collapsed, and a short hash of it"""
+    shape = _WHITESPACE.sub(' ', _IN_LIST.sub('(%s, ...)', sql)).strip()
+    return shape, hashlib.sha1(shape.encode('utf-8')).hexdigest()[:12]
+
+
+def _stack_summary(limit=8):
+    """The innermost project frames that led to the query"""
+    base_dir = str(settings.BASE_DIR)
+    frames = [
+        f'{frame.filename[len(base_dir) + 1:]}:{frame.lineno} in {frame.name}'
+        for frame in traceback.extract_stack()
+        if frame.filename.startswith(base_dir) and 'site-packages' not in frame.filename
+        and not frame.filename.endswith(_INSTRUMENTATION_FILES)
+    ]
+    return frames[-limit:]
+
+
+def _explain(connection, sql, params):
+    prefix = connection.ops.explain_query_prefix()
+    with ExitStack() as stack:
+        if connection.in_atomic_block:
+            # A failed EXPLAIN must not poison the caller's transaction
+            stack.enter_context(transaction.atomic(using=connection.alias))
+        with connection.cursor() as cursor:
+            cursor.execute(f'{prefix} {sql}', params)
+            return '\n'.join(str(row[-1]) for row in cursor.fetchall())
+
+
+class SlowQueryRecorder:
+    """connection.execute_wrapper that logs queries over ``threshold_ms``"""
+
+    def __init__(self, threshold_ms, request=None):
+        self.threshold_ms = threshold_ms
+        self.request = request
+
+    def __call__(self, execute, sql, params, many, context):
+        if getattr(_local, 'active', False):
+            return execute(sql, params, many, context)
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration_ms = (perf_counter() - start) * 1000
+            if duration_ms >= self.threshold_ms:
+                _local.active = True
+                try:
+                    self.record(sql, params, many, duration_ms, context['connection'])
+                finally:
+                    _local.active = False
+
+    def record(self, sql, params, many, duration_ms, connection):
+        shape, shape_hash = query_shape(sql)
+        match = getattr(self.request, 'resolver_match', None)
+        entry = {
+            'shape': shape_hash,
+            'sql': sql,
+            'params': repr(params)[:500],
+            'duration_ms': round(duration_ms, 3),
+            'many': many,
+            'database': connection.alias,
+            'view': match.view_name if match else None,
+            'stack': _stack_summary(),
+        }
+        if not many and sql.lstrip().upper().startswith(_EXPLAINABLE):
+            with _explained_lock:
+                first_seen = shape_hash not in _explained
+                _explained.add(shape_hash)
+            if first_seen:
+                try:
+                    entry['plan'] = _explain(connection, sql, params)
+                except Exception as e:
+                    entry['plan_error'] = str(e)
+        logger.info(json.dumps(entry, default=str))
+
+
+class SlowQueryMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = SlowQueryRecorder(settings.SLOW_QUERY_THRESHOLD_MS, request=request)
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            return self.get_response(request)
@@ -0,0 +1,190 @@
+"""
+Stock takes: reconcile a physical count against stock in set-based steps.
+
+``read_counts()`` parses a file of SKU and counted quantity, summing SKUs
+counted in more than one place. ``load_count()`` bulk inserts the counts into
+the ``StockCountLine`` staging table and matches each line to its product
+with one ``UPDATE`` on the unique SKU index. A single join against
+``Product.stock`` then finds every line whose count differs, and a
+``StockAdjustment`` is written for each one with the product's current price
+and cost. ``apply_stock_take()`` moves stock by every variance in one
+``UPDATE``, after copying the changes into the stock ledger with one
+``INSERT ... SELECT``, and queues the stock webhooks for them.
+
+Stock moves by the variance instead of being set to the counted figure, so
+sales recorded between loading and applying a count are not undone.
+
+A count covers every location and is compared with each product's total.
+The variance is booked at the default location, which can fall to zero but
+not below: stock recorded at the shops is changed only by their own sales
+and by transfers.
+
+``report_rows()`` yields the variance report one row at a time from
+chunked queries, so a 100k-line count can be streamed as CSV.
+"""
+from collections import Counter
+import csv
+from itertools import islice
+import re
+
+from django.db import transaction
+from django.db.models import Count, DateTimeField, F, IntegerField, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from . import ledger, webhooks
+from .models import Product, StockAdjustment, StockCountLine, StockMovement, StockTake
+
+# The largest count StockCountLine.counted (a PositiveIntegerField) holds
+MAX_QUANTITY = 2147483647
+REPORT_HEADER = [
+    'sku', 'name', 'expected', 'counted', 'variance', 'unit_price', 'unit_cost', 'value_at_price', 'value_at_cost',
+]
+
+
+class CountFileError(ValueError):
+    pass
+
+
+def read_counts(rows):
+    """``{sku: quantity}`` from CSV lines of SKU and counted quantity.
+
+    A first line whose quantity is not a number is taken as a header. Raises
+    ``CountFileError`` naming the first bad line.
+    """
+    counts = Counter()
+    for number, row in enumerate(csv.reader(rows), start=1):
+        if not any(cell.strip() for cell in row):
+            continue
+        if len(row) < 2:
+            raise CountFileError(f'Line {number}: expected a SKU and a quantity.')
+        sku, quantity = row[0].strip(), row[1].strip()
+        # ASCII digits only: str.isdigit() also passes '²', which int() refuses
+        if not re.fullmatch(r'[0-9]+', quantity):
+            if number == 1:
+                continue
+            raise CountFileError(f'Line {number}: quantity {quantity!r} is not a whole number.')
+        if not sku or len(sku) > 50:
+            raise CountFileError(f'Line {number}: SKU must be 1 to 50 characters.')
+        counts[sku] += int(quantity)
+        if counts[sku] > MAX_QUANTITY:
+            raise CountFileError(f'Line {number}: the count for {sku} is over {MAX_QUANTITY}.')
+    return counts
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+@transaction.atomic
+def load_count(counts, user=None, note='', batch_size=5000):
+    """Stage ``{sku: quantity}`` as a draft stock take and record its variances"""
+    stock_take = StockTake.objects.create(created_by=user, note=note, line_count=len(counts))
+    for batch in _batches(counts.items(), batch_size):
+        StockCountLine.objects.bulk_create(
+            [StockCountLine(stock_take=stock_take, sku=sku, counted=quantity) for sku, quantity in batch]
+        )
+
+    lines = StockCountLine.objects.filter(stock_take=stock_take)
+    lines.update(product=Subquery(Product.objects.filter(sku=OuterRef('sku')).order_by().values('pk')[:1]))
+
+    variances = (
+        lines.filter(product__isnull=False)
+        .exclude(counted=F('product__stock'))
+        .values_list('product_id', 'product__stock', 'counted', 'product__price', 'product__cost')
+        .iterator(chunk_size=batch_size)
+    )
+    for batch in _batches(variances, batch_size):
+        StockAdjustment.objects.bulk_create([
+            StockAdjustment(
+                stock_take=stock_take, product_id=product_id, expected=stock, counted=counted,
+                variance=counted - stock, unit_price=price, unit_cost=cost,
+            )
+            for product_id, stock, counted, price, cost in batch
+        ])
+
+    stock_take.unknown_count = lines.filter(product__isnull=True).count()
+    stock_take.save(update_fields=['unknown_count'])
+    return stock_take
+
+
+@transaction.atomic
+def apply_stock_take(stock_take):
+    """Move stock by every variance of a draft stock take; returns the products changed"""
+    stock_take = StockTake.objects.select_for_update().get(pk=stock_take.pk)
+    if stock_take.status != 'draft':
+        raise ValueError(f'Stock take {stock_take.pk} has already been applied.')
+
+    adjustments = StockAdjustment.objects.filter(stock_take=stock_take)
+    moves = []
+    if webhooks.wants('stock.changed') or webhooks.wants('stock.low'):
+        moves = list(adjustments.values_list(
+            'product_id', 'product__stock', 'variance', 'product__located_stock', 'product__reorder_threshold',
+        ))
+    # Ledger rows first, while product stock is still as it was
+    ledger.insert_select(
+        adjustments.annotate(
+            quantity=Greatest(
+                F('product__stock') + F('variance'), F('product__located_stock'), output_field=IntegerField(),
+            ) - F('product__stock'),
+            reason=Value(StockMovement.Reason.STOCK_TAKE.value),
+            no_order=Value(None, output_field=IntegerField()),
+            no_sale=Value(None, output_field=IntegerField()),
+            user=Value(stock_take.created_by_id, output_field=IntegerField()),
+            no_location=Value(None, output_field=IntegerField()),
+            at=Value(timezone.now(), output_field=DateTimeField()),
+        )
+        .exclude(quantity=0).order_by()
+        .values_list('product_id', 'quantity', 'reason', 'no_order', 'no_sale', 'user', 'no_location', 'at')
+    )
+    variance = adjustments.filter(product=OuterRef('pk')).values('variance')[:1]
+    updated = Product.objects.filter(pk__in=adjustments.values('product_id')).update(
+        stock=Greatest(F('stock') + Subquery(variance), F('located_stock'), output_field=IntegerField()),
+        updated_at=timezone.now(),
+    )
+    # Matched lines live on as adjustments; unknown SKUs stay for the report
+    StockCountLine.objects.filter(stock_take=stock_take, product__isnull=False).delete()
+
+    stock_take.status = 'applied'
+    stock_take.applied_at = timezone.now()
+    stock_take.save(update_fields=['status', 'applied_at'])
+    webhooks.emit(webhooks.stock_events(
+        (pk, stock, max(stock + variance, located), threshold) for pk, stock, variance, located, threshold in moves
+    ))
+    return updated
+
+
+def summary(stock_take):
+    """Variance count, units over and short, and value impact at price and cost"""
+    over = Q(variance__gt=0)
+    short = Q(variance__lt=0)
+    totals = StockAdjustment.objects.filter(stock_take=stock_take).aggregate(
+        variances=Count('pk'),
+        units_over=Sum('variance', filter=over),
+        units_short=Sum('variance', filter=short),
+        value_at_price=Sum(F('variance') * F('unit_price')),
+        value_at_cost=Sum(F('variance') * F('unit_cost')),
+    )
+    return {key: value or 0 for key, value in totals.items()}
+
+
+def report_rows(stock_take, chunk_size=2000):
+    """The variance report as lists of cells, header first, then unknown SKUs"""
+    yield REPORT_HEADER
+    adjustments = (
+        StockAdjustment.objects.filter(stock_take=stock_take)
+        .order_by('product__sku')
+        .values_list('product__sku', 'product__name', 'expected', 'counted', 'variance', 'unit_price', 'unit_cost')
+    )
+    for sku, name, expected, counted, variance, price, cost in adjustments.iterator(chunk_size=chunk_size):
+        yield [sku, name, expected, counted, variance, price, cost, price * variance, cost * variance]
+
+    unknown = (
+        StockCountLine.objects.filter(stock_take=stock_take, product__isnull=True)
+        .order_by('sku')
+        .values_list('sku', 'counted')
+    )
+    for sku, counted in unknown.iterator(chunk_size=chunk_size):
+        yield [sku, '(unknown SKU)', '', counted, '', '', '', '', '']
@@ -1,3 +1,1925 @@
-from django.test import TestCase
+from datetime import datetime, timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from importlib import import_module
+from io import StringIO
+import base64
+import json
+import math
+import os
+from pathlib import Path
+import runpy
+import sqlite3
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management import call_command
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+from django.db.models import F
+from django.db.models.signals import post_save
+from django.test import (
+    AsyncClient, Client, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import catalog, figures, ledger, metrics
+from .admin import estimated_count
+from .analytics import margin_report, rollup_margins
+from .archive import archive_orders, archive_sales
+from .backends.sqlite3.base import DatabaseWrapper as SQLiteWrapper
+from .families import family_summaries
+from .forecasting import forecast_reorders, load_history
+from .forms import SellForm
+from .idempotency import expire_keys
+from .notifications import recount_unread, unread_count
+from .models import (
+    Category, Customer, Location, Product, ProductFamily, ProductLocationStock, Order, OrderItem, Notification,
+    ReorderSuggestion, Sale, IdempotencyKey, ArchivedOrder, ArchivedOrderItem, ArchivedSale, PriceChange,
+    StockAdjustment, StockCountLine, StockMovement, StockSnapshot, StockTake, WebhookEndpoint, WebhookEvent,
+)
+from .concurrency import save_changes
+from .repricing import RepricingRule, apply_repricing, preview
+from .routers import PIN_COOKIE_NAME, REPLICA_DB_ALIAS
+from .services import InsufficientStock, apply_stock_deltas, create_notifications, transfer_stock, transition_orders
+from .stocktake import CountFileError, apply_stock_take, load_count, read_counts, summary
+from .slow_queries import SlowQueryRecorder, query_shape
+from .throttling import INFLIGHT_TIMEOUT, _acquire_slot, _release_slot, take_token
+from .views import OrderListView
+from .webhooks import SUBSCRIPTIONS_KEY, emit, requeue, sign, subscriptions
+
+
+def basic_auth(username, password):
+    return 'Basic ' + base64.b64encode(f'{username}:{password}'.encode()).decode()
+
+
+def setUpModule():
+    # Every test's metrics go to a directory of this run, not the real METRICS_DIR
+    global _run_metrics_dir, _run_metrics_settings
+    _run_metrics_dir = tempfile.TemporaryDirectory()
+    _run_metrics_settings = override_settings(METRICS_DIR=_run_metrics_dir.name)
+    _run_metrics_settings.enable()
+
+
+def tearDownModule():
+    metrics.close()
+    _run_metrics_settings.disable()
+    _run_metrics_dir.cleanup()
+
+
+def fresh_metrics(test):
+    """Point METRICS_DIR at an empty directory for ``test``, so metrics of earlier tests are not counted"""
+    directory = tempfile.TemporaryDirectory()
+    test.addCleanup(directory.cleanup)
+    metrics_dir = override_settings(METRICS_DIR=directory.name)
+    metrics_dir.enable()
+    test.addCleanup(metrics_dir.disable)
+    test.addCleanup(metrics.close)
+
+
+class OrderEditTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('staff', password='pw')
+        self.client.force_login(self.user)
+        self.category = Category.objects.create(name='Shirts')
+
+    def make_order(self, lines):
+        products = Product.objects.bulk_create([
+            Product(name=f'Shirt {i:03}', sku=f'SHT-{lines}-{i:03}', category=self.category,
+                    price=Decimal('100.00'), stock=50)
+            for i in range(lines)
+        ])
+        order = Order.objects.create(customer_name='Ali', customer_phone='0300', customer_address='Lahore')
+        items = OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=p, quantity=2, unit_price=p.price) for p in products
+        ])
+        return order, products, items
+
+    def edit_payload(self, order, items, changes=None, delete=()):
+        changes = changes or {}
+        data = {
+            'customer_name': order.customer_name,
+            'customer_email': '',
+            'customer_phone': order.customer_phone,
+            'customer_address': order.customer_address,
+            'status': order.status,
+            'notes': '',
+            'version': str(order.version),
+            'items-TOTAL_FORMS': str(len(items)),
+            'items-INITIAL_FORMS': str(len(items)),
+            'items-MIN_NUM_FORMS': '1',
+            'items-MAX_NUM_FORMS': '1000',
+        }
+        for i, item in enumerate(items):
+            data.update({
+                f'items-{i}-id': str(item.pk),
+                f'items-{i}-order': str(order.pk),
+                f'items-{i}-product': str(item.product_id),
+                f'items-{i}-quantity': str(changes.get(item.pk, item.quantity)),
+                f'items-{i}-unit_price': str(item.unit_price),
+            })
+            if item.pk in delete:
+                data[f'items-{i}-DELETE'] = 'on'
+        return data
+
+    def test_edit_applies_stock_diff_and_total(self):
+        order, products, items = self.make_order(3)
+        data = self.edit_payload(order, items, changes={items[0].pk: 5, items[1].pk: 1}, delete={items[2].pk})
+
+        response = self.client.post(reverse('order-update', args=[order.pk]), data)
+
+        self.assertRedirects(response, reverse('order-list'), fetch_redirect_response=False)
+        stock = dict(Product.objects.values_list('pk', 'stock'))
+        self.assertEqual(stock[products[0].pk], 47)
+        self.assertEqual(stock[products[1].pk], 51)
+        self.assertEqual(stock[products[2].pk], 52)
+        order.refresh_from_db()
+        self.assertEqual(order.total_amount, Decimal('600.00'))
+        self.assertEqual(order.items.count(), 2)
+
+    def test_edit_rejects_increase_beyond_stock(self):
+        order, products, items = self.make_order(2)
+        data = self.edit_payload(order, items, changes={items[0].pk: 60})
+
+        response = self.client.post(reverse('order-update', args=[order.pk]), data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Insufficient stock')
+        self.assertEqual(Product.objects.get(pk=products[0].pk).stock, 50)
+        self.assertEqual(OrderItem.objects.get(pk=items[0].pk).quantity, 2)
+
+    def count_edit_queries(self, lines):
+        order, products, items = self.make_order(lines)
+        data = self.edit_payload(order, items, changes={item.pk: 3 for item in items[::2]}, delete={items[1].pk})
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.post(reverse('order-update', args=[order.pk]), data)
+        return len(ctx.captured_queries)
+
+    def test_edit_query_count_does_not_grow_with_lines(self):
+        self.assertEqual(self.count_edit_queries(10), self.count_edit_queries(100))
+
+
+class OrderTransitionTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Shirts')
+        self.product = Product.objects.create(name='Shirt', sku='SHT-1', category=category, price=100, stock=10)
+        self.orders = [
+            Order.objects.create(customer_name=f'C{i}', customer_phone='0300', customer_address='Lahore', status=status)
+            for i, status in enumerate(['pending', 'confirmed', 'delivered'])
+        ]
+        for order in self.orders:
+            OrderItem.objects.create(order=order, product=self.product, quantity=2, unit_price=100)
+
+    def test_cancel_skips_final_orders_and_restocks_in_bulk(self):
+        ids = [order.pk for order in self.orders]
+        with self.assertNumQueries(10):
+            result = transition_orders(ids, 'cancelled')
+
+        self.assertEqual(result.updated, sorted(ids[:2]))
+        self.assertEqual(result.skipped, [ids[2]])
+        self.assertEqual(
+            dict(Order.objects.values_list('pk', 'status')),
+            {ids[0]: 'cancelled', ids[1]: 'cancelled', ids[2]: 'delivered'},
+        )
+        self.assertEqual(Product.objects.get(pk=self.product.pk).stock, 8)
+        self.assertEqual(Notification.objects.filter(type='order_status').count(), 2)
+
+    def test_cancel_gives_back_only_the_stock_a_line_took(self):
+        # The line is saved, but there were not enough units to take
+        order = self.orders[0]
+        short = Product.objects.create(name='Cap', sku='CAP-1', category=self.product.category, price=50, stock=3)
+        OrderItem.objects.create(order=order, product=short, quantity=5, unit_price=50)
+        self.assertEqual(Product.objects.get(pk=short.pk).stock, 3)
+
+        transition_orders([order.pk], 'cancelled')
+
+        self.assertEqual(Product.objects.get(pk=short.pk).stock, 3)
+        self.assertEqual(Product.objects.get(pk=self.product.pk).stock, 6)
+        self.assertEqual(
+            list(StockMovement.objects.filter(reason=StockMovement.Reason.ORDER_CANCELLED).values_list('product_id', 'quantity')),
+            [(self.product.pk, 2)],
+        )
+
+    def test_api_endpoint(self):
+        self.client.force_login(User.objects.create_user('staff', password='pw'))
+        response = self.client.post(
+            reverse('api-order-transition'),
+            {'order_ids': [self.orders[0].pk], 'status': 'shipped'},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['updated'], [])
+
+        response = self.client.post(
+            reverse('api-order-transition'),
+            {'order_ids': [self.orders[1].pk], 'status': 'shipped'},
+            content_type='application/json',
+        )
+        self.assertEqual(response.json()['updated'], [self.orders[1].pk])
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        fresh_metrics(self)
+
+    def test_request_and_business_metrics_are_exported(self):
+        self.client.force_login(User.objects.create_user('staff', password='pw', is_staff=True))
+        self.client.get(reverse('dashboard'))
+        Order.objects.create(customer_name='Ali', customer_phone='0300', customer_address='Lahore')
+
+        response = self.client.get(reverse('metrics'))
+
+        body = response.content.decode()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('http_request_duration_seconds_bucket{view="dashboard",le="+Inf"} 1\n', body)
+        self.assertIn('http_request_db_queries_count{view="dashboard"} 1\n', body)
+        self.assertIn('\norders_created_total 1\n', body)
+        self.assertIn('\nnotifications_emitted_total{type="new_order"} 1\n', body)
+
+    @override_settings(METRICS_TOKEN='scrape-token')
+    def test_only_staff_and_the_token_can_scrape(self):
+        url = reverse('metrics')
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.client.force_login(User.objects.create_user('clerk', password='pw'))
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+
+        self.assertEqual(Client().get(url, HTTP_AUTHORIZATION='Bearer scrape-token').status_code, 200)
+        self.client.force_login(User.objects.create_user('staff', password='pw', is_staff=True))
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+
+class ReplicaRoutingTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        catalog.clear_local()
+        self.user = User.objects.create_user('staff', password='pw')
+        self.product = Product.objects.create(
+            name='Cap', sku='CAP-1', category=Category.objects.create(name='Caps'), price=100, stock=5,
+        )
+        # A second SQLite database holding the primary as it is now, so rows
+        # written from here on show where each read went
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        primary = connections[DEFAULT_DB_ALIAS]
+        replica = {**primary.settings_dict, 'NAME': os.path.join(directory.name, 'replica.sqlite3')}
+        primary.ensure_connection()
+        target = sqlite3.connect(replica['NAME'])
+        primary.connection.backup(target)
+        target.close()
+        connections.settings[REPLICA_DB_ALIAS] = replica
+        self.addCleanup(self.drop_replica)
+        routing = override_settings(
+            DATABASE_ROUTERS=['inventory.routers.PrimaryReplicaRouter'],
+            MIDDLEWARE=[*settings.MIDDLEWARE, 'inventory.routers.ReplicaRoutingMiddleware'],
+        )
+        routing.enable()
+        self.addCleanup(routing.disable)
+        self.client.force_login(self.user)
+        Product.objects.filter(pk=self.product.pk).update(name='Cap (primary)')
+
+    def drop_replica(self):
+        connections[REPLICA_DB_ALIAS].close()
+        del connections[REPLICA_DB_ALIAS]
+        del connections.settings[REPLICA_DB_ALIAS]
+
+    def test_safe_requests_to_marked_views_read_the_replica(self):
+        for method in (self.client.get, self.client.head):
+            with CaptureQueriesContext(connections[REPLICA_DB_ALIAS]) as replica:
+                self.assertEqual(method(reverse('product-list')).status_code, 200)
+            self.assertTrue(replica.captured_queries, method)
+            self.assertFalse(any('auth_user' in query['sql'] for query in replica.captured_queries))
+        self.assertNotContains(self.client.get(reverse('product-list')), 'Cap (primary)')
+
+        # Unmarked views read the primary
+        self.assertContains(self.client.get(reverse('product-update', args=[self.product.pk])), 'Cap (primary)')
+
+    def test_writes_go_to_the_primary_and_pin_the_client(self):
+        response = self.client.post(reverse('create-category-ajax'), {'name': 'Hats'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(PIN_COOKIE_NAME, response.cookies)
+        self.assertTrue(Category.objects.using(DEFAULT_DB_ALIAS).filter(name='Hats').exists())
+        self.assertFalse(Category.objects.using(REPLICA_DB_ALIAS).filter(name='Hats').exists())
+        with CaptureQueriesContext(connections[REPLICA_DB_ALIAS]) as replica:
+            self.assertContains(self.client.get(reverse('product-list')), 'Cap (primary)')
+        self.assertEqual(replica.captured_queries, [])
+
+
+class SQLiteBackendTests(SimpleTestCase):
+    def settings_options(self, **env):
+        """``SQLITE_OPTIONS`` as the settings module builds it under ``env``"""
+        with mock.patch.dict(os.environ):
+            for name in list(os.environ):
+                if name.startswith('SQLITE_'):
+                    del os.environ[name]
+            os.environ.update(env)
+            return runpy.run_path(import_module(os.environ['DJANGO_SETTINGS_MODULE']).__file__)['SQLITE_OPTIONS']
+
+    def connect(self, options):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        wrapper = SQLiteWrapper(
+            {**connections[DEFAULT_DB_ALIAS].settings_dict, 'NAME': os.path.join(directory.name, 'db.sqlite3'), 'OPTIONS': options},
+            alias='sqlite-options',
+        )
+        self.addCleanup(wrapper.close)
+        return wrapper
+
+    def pragma(self, wrapper, name):
+        with wrapper.cursor() as cursor:
+            cursor.execute(f'PRAGMA {name}')
+            return cursor.fetchone()[0]
+
+    def begin(self, wrapper):
+        """Open a transaction the way ``transaction.atomic()`` does, returning the SQL it ran"""
+        with CaptureQueriesContext(wrapper) as ctx:
+            wrapper.set_autocommit(False, force_begin_transaction_with_broken_autocommit=True)
+        return [query['sql'] for query in ctx.captured_queries]
+
+    def test_pragmas_come_from_the_environment(self):
+        wrapper = self.connect(self.settings_options(SQLITE_CACHE_SIZE='-1234', SQLITE_BUSY_TIMEOUT='250'))
+        self.assertEqual(self.pragma(wrapper, 'cache_size'), -1234)
+        self.assertEqual(self.pragma(wrapper, 'busy_timeout'), 250)
+        self.assertEqual(self.pragma(wrapper, 'journal_mode'), 'wal')
+        self.assertEqual(self.pragma(wrapper, 'synchronous'), 1)  # NORMAL
+
+        # An empty value leaves SQLite's own default
+        wrapper = self.connect(self.settings_options(SQLITE_JOURNAL_MODE='', SQLITE_SYNCHRONOUS=''))
+        self.assertEqual(self.pragma(wrapper, 'journal_mode'), 'delete')
+        self.assertEqual(self.pragma(wrapper, 'synchronous'), 2)  # FULL
+
+    def test_transactions_stay_deferred_by_default(self):
+        options = self.settings_options()
+        self.assertIsNone(options['transaction_mode'])
+        wrapper = self.connect(options)
+        wrapper.ensure_connection()
+
+        self.assertEqual(self.begin(wrapper), ['BEGIN'])
+        # Nothing is locked until the transaction writes
+        other = sqlite3.connect(wrapper.settings_dict['NAME'], timeout=0)
+        self.addCleanup(other.close)
+        other.execute('CREATE TABLE t (id integer)')
+        wrapper.rollback()
+
+    def test_immediate_mode_takes_the_write_lock_on_begin(self):
+        wrapper = self.connect(self.settings_options(SQLITE_TRANSACTION_MODE='immediate'))
+        wrapper.ensure_connection()
+
+        self.assertEqual(self.begin(wrapper), ['BEGIN IMMEDIATE'])
+        other = sqlite3.connect(wrapper.settings_dict['NAME'], timeout=0)
+        self.addCleanup(other.close)
+        with self.assertRaisesMessage(sqlite3.OperationalError, 'database is locked'):
+            other.execute('CREATE TABLE t (id integer)')
+        wrapper.rollback()
+
+    def test_unknown_transaction_mode_is_refused(self):
+        with self.assertRaises(ImproperlyConfigured):
+            self.connect({'transaction_mode': 'LAZY'}).ensure_connection()
+
+
+class SlowQueryLogTests(TestCase):
+    def test_slow_query_is_logged_with_plan_once_per_shape(self):
+        recorder = SlowQueryRecorder(threshold_ms=0)
+        with self.assertLogs('inventory.slow_queries', level='INFO') as logs:
+            with connection.execute_wrapper(recorder):
+                list(Product.objects.filter(pk__in=[1, 2]))
+                list(Product.objects.filter(pk__in=[3, 4, 5]))
+
+        first, second = (json.loads(line.split(':', 2)[2]) for line in logs.output)
+        self.assertEqual(first['shape'], second['shape'])
+        self.assertIn('inventory_product', first['sql'])
+        self.assertIn('plan', first)
+        self.assertNotIn('plan', second)
+        self.assertTrue(any('tests.py' in frame for frame in first['stack']))
+
+    def test_query_shape_collapses_in_lists(self):
+        self.assertEqual(
+            query_shape('SELECT 1 WHERE id IN (%s, %s)')[1],
+            query_shape('SELECT 1 WHERE id IN (%s, %s, %s)')[1],
+        )
+
+
+class ForecastTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Shirts')
+        self.fast = Product.objects.create(name='Fast', sku='FST-1', category=category, price=100, stock=20)
+        self.idle = Product.objects.create(name='Idle', sku='IDL-1', category=category, price=100, stock=20)
+        now = timezone.now()
+        # Two units a day for four weeks, from the till and from orders
+        Sale.objects.bulk_create([
+            Sale(product=self.fast, quantity=1, unit_price=100, total_amount=100, created_at=now - timedelta(days=d))
+            for d in range(28)
+        ])
+        orders = Order.objects.bulk_create([
+            Order(order_number=f'ORD-{d}', customer_name='Ali', customer_phone='0300', customer_address='Lahore')
+            for d in range(28)
+        ])
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=self.fast, quantity=1, unit_price=100, created_at=now - timedelta(days=d))
+            for d, order in enumerate(orders)
+        ])
+
+    def test_suggestions_and_thresholds(self):
+        result = forecast_reorders(days=28, lead_time=7, review_days=7, apply_thresholds=True)
+
+        self.assertEqual((result.products, result.selling, result.suggestions), (2, 1, 1))
+        fast = ReorderSuggestion.objects.get(product=self.fast)
+        self.assertAlmostEqual(fast.daily_velocity, 2.0)
+        self.assertAlmostEqual(fast.demand_std, 0.0)
+        self.assertEqual(fast.weekday_factors, [1.0] * 7)
+        self.assertAlmostEqual(fast.days_of_cover, 10.0)
+        self.assertEqual((fast.reorder_point, fast.reorder_quantity), (14, 8))
+        idle = ReorderSuggestion.objects.get(product=self.idle)
+        self.assertIsNone(idle.days_of_cover)
+        self.assertEqual(idle.reorder_quantity, 0)
+        self.assertEqual(Product.objects.get(pk=self.fast.pk).reorder_threshold, 14)
+
+    def test_applied_thresholds_keep_those_of_products_without_sales(self):
+        Product.objects.filter(pk=self.idle.pk).update(reorder_threshold=5)
+
+        result = forecast_reorders(days=28, lead_time=7, review_days=7, apply_thresholds=True)
+
+        self.assertEqual(result.thresholds_updated, 1)
+        self.assertEqual(Product.objects.get(pk=self.idle.pk).reorder_threshold, 5)
+
+    def test_applied_thresholds_reach_scan_entries(self):
+        cache.clear()
+        catalog.clear_local()
+        self.assertEqual(catalog.scan_entry('FST-1').reorder_threshold, 0)
+
+        forecast_reorders(days=28, lead_time=7, review_days=7, apply_thresholds=True)
+
+        self.assertEqual(catalog.scan_entry('FST-1').reorder_threshold, 14)
+
+    def test_history_starts_at_local_midnight(self):
+        start = timezone.localdate() - timedelta(days=40)
+        midnight = timezone.make_aware(datetime.combine(start, datetime.min.time()))
+        Sale.objects.bulk_create([
+            Sale(product=self.idle, quantity=units, unit_price=100, total_amount=100 * units, created_at=at)
+            for units, at in ((5, midnight - timedelta(minutes=1)), (3, midnight))
+        ])
+
+        product_ids, days, units = load_history(start)
+
+        idle = product_ids == self.idle.pk
+        self.assertEqual((days[idle].tolist(), units[idle].tolist()), ([0], [3.0]))
+
+    def test_rerun_updates_in_place_and_ignores_cancelled_orders(self):
+        forecast_reorders(days=28)
+        Order.objects.update(status='cancelled')
+        forecast_reorders(days=28)
+
+        self.assertEqual(ReorderSuggestion.objects.count(), 2)
+        self.assertAlmostEqual(ReorderSuggestion.objects.get(product=self.fast).daily_velocity, 1.0)
+
+    def test_replenishment_view(self):
+        forecast_reorders(days=28)
+        self.client.force_login(User.objects.create_user('staff', password='pw'))
+
+        response = self.client.get(reverse('replenishment'))
+
+        self.assertContains(response, 'FST-1')
+        self.assertNotContains(response, 'IDL-1')
+
+
+class MarginReportTests(TestCase):
+    def setUp(self):
+        shirts = Category.objects.create(name='Shirts')
+        shoes = Category.objects.create(name='Shoes')
+        self.shirt = Product.objects.create(name='Shirt', sku='SHT-1', category=shirts, size='M', price=100, cost=60, stock=100)
+        self.shoe = Product.objects.create(name='Shoe', sku='SHO-1', category=shoes, size='EU42', price=300, cost=200, stock=100)
+        now = timezone.now()
+        for days_ago in (0, 3):
+            Sale.objects.create(product=self.shirt, quantity=2, unit_price=100, total_amount=200,
+                                created_at=now - timedelta(days=days_ago))
+        for status, days_ago in (('delivered', 0), ('delivered', 3), ('pending', 0)):
+            order = Order.objects.create(customer_name='Ali', customer_phone='0300', customer_address='Lahore', status=status)
+            OrderItem.objects.create(order=order, product=self.shoe, quantity=1, unit_price=300,
+                                     created_at=now - timedelta(days=days_ago))
+        # Later cost changes must not rewrite past margins
+        Product.objects.filter(pk=self.shirt.pk).update(cost=90)
+
+    def by_group(self, **kwargs):
+        return {row.group: row for row in margin_report(**kwargs)}
+
+    def test_margins_by_category_use_cost_snapshot(self):
+        rows = self.by_group(group_by='category')
+
+        self.assertEqual(rows['Shirts'].quantity, 4)
+        self.assertEqual((rows['Shirts'].revenue, rows['Shirts'].cost), (Decimal('400.00'), Decimal('240.00')))
+        self.assertEqual(rows['Shirts'].margin_percent, Decimal('40.0'))
+        self.assertEqual((rows['Shoes'].quantity, rows['Shoes'].margin), (2, Decimal('200.00')))
+
+    def test_rollup_gives_the_same_figures(self):
+        before = margin_report(group_by='size', period='day')
+
+        self.assertEqual(rollup_margins(days=7), 2)
+        with self.assertNumQueries(7):
+            after = margin_report(group_by='size', period='day')
+
+        self.assertEqual(before, after)
+
+    def test_api_and_page(self):
+        self.client.force_login(User.objects.create_user('staff', password='pw'))
+
+        response = self.client.get(reverse('api-margin-report'), {'group_by': 'color', 'source': 'sale'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'][0]['revenue'], '400.00')
+        self.assertEqual(self.client.get(reverse('api-margin-report'), {'period': 'hour'}).status_code, 400)
+
+        response = self.client.get(reverse('margin-report'), {'group_by': 'product', 'period': 'month'})
+        self.assertContains(response, 'Shoe')
+
+
+class IdempotencyTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('staff', password='pw'))
+        category = Category.objects.create(name='Shirts')
+        self.product = Product.objects.create(name='Shirt', sku='SHT-1', category=category, price=100, stock=10)
+
+    def create_order(self, key, quantity=2):
+        return self.client.post(
+            reverse('create-order-ajax'),
+            {'customer_name': 'Ali', 'customer_phone': '0300', 'customer_address': 'Lahore',
+             'items': [{'product_id': self.product.pk, 'quantity': quantity}]},
+            content_type='application/json',
+            HTTP_IDEMPOTENCY_KEY=key,
+        )
+
+    def test_retried_order_is_created_once(self):
+        first = self.create_order('retry-1')
+        with self.assertNumQueries(3):  # session, user, key lookup
+            second = self.create_order('retry-1')
+
+        self.assertEqual(first.json(), second.json())
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(Product.objects.get(pk=self.product.pk).stock, 8)
+
+    def test_key_reused_with_another_body_is_rejected(self):
+        self.create_order('retry-2')
+        self.assertEqual(self.create_order('retry-2', quantity=3).status_code, 422)
+
+    def test_failed_request_releases_the_key(self):
+        response = self.create_order('retry-3', quantity=50)
+
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+    def test_retry_takes_over_a_claim_whose_lease_ran_out(self):
+        # The same request under another key, for its fingerprint
+        done = self.create_order('done-1')
+        self.assertEqual(done.status_code, 200)
+        # What a worker killed mid-request leaves behind
+        claim = IdempotencyKey.objects.create(
+            user=User.objects.get(username='staff'), scope='create-order', key='killed-1',
+            fingerprint=IdempotencyKey.objects.get(key='done-1').fingerprint,
+            expires_at=timezone.now() + timedelta(seconds=settings.IDEMPOTENCY_LOCK_TIMEOUT),
+        )
+        self.assertEqual(self.create_order('killed-1').status_code, 409)
+
+        IdempotencyKey.objects.filter(pk=claim.pk).update(expires_at=timezone.now() - timedelta(seconds=1))
+        response = self.create_order('killed-1')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Order.objects.count(), 2)
+        record = IdempotencyKey.objects.get(key='killed-1')
+        self.assertEqual(record.status_code, 200)
+        self.assertGreater(record.expires_at, timezone.now() + timedelta(hours=23))
+
+    def test_sell_form_token_prevents_double_sale(self):
+        data = {'product': self.product.pk, 'quantity': 3, 'idempotency_key': 'form-token'}
+        self.client.post(reverse('sell'), data)
+        response = self.client.post(reverse('sell'), data)
+
+        self.assertContains(response, 'Sold 3 x Shirt')
+        self.assertEqual(Sale.objects.count(), 1)
+        self.assertEqual(Product.objects.get(pk=self.product.pk).stock, 7)
+
+    def test_api_key_holds_for_basic_auth(self):
+        cache.clear()
+        catalog.clear_local()
+        client = Client(HTTP_AUTHORIZATION=basic_auth('staff', 'pw'))
+
+        def sell():
+            return client.post(
+                reverse('api-scan-sell'), {'sku': 'SHT-1', 'quantity': 2},
+                content_type='application/json', HTTP_IDEMPOTENCY_KEY='basic-1',
+            )
+
+        first = sell()
+        second = sell()
+        self.assertEqual((first.status_code, second.status_code), (201, 201))
+        self.assertEqual(first.json(), second.json())
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(Sale.objects.count(), 1)
+
+    def test_expired_keys_are_deleted_in_batches(self):
+        for i in range(5):
+            self.create_order(f'old-{i}', quantity=1)
+
+        self.assertEqual(expire_keys(batch_size=2, now=timezone.now() + timedelta(days=2)), 5)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+
+class ThrottlingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        fresh_metrics(self)
+        self.user = User.objects.create_user('staff', password='pw', is_staff=True)
+        self.client.force_login(self.user)
+
+    def create_category(self, name):
+        return self.client.post(reverse('create-category-ajax'), {'name': name})
+
+    @override_settings(RATE_LIMITS={'create-category': (3, 60)})
+    def test_burst_then_429_with_retry_after(self):
+        statuses = [self.create_category(f'Cat {i}').status_code for i in range(4)]
+
+        self.assertEqual(statuses, [200, 200, 200, 429])
+        response = self.create_category('Cat 5')
+        self.assertEqual(int(response['Retry-After']), 20)
+        self.assertIn(
+            'requests_throttled_total{reason="rate",scope="create-category"} 2\n',
+            self.client.get(reverse('metrics')).content.decode(),
+        )
+
+    @override_settings(RATE_LIMITS={'create-category': (1, 60)})
+    def test_buckets_are_per_user(self):
+        self.assertEqual(self.create_category('Mine').status_code, 200)
+        self.client.force_login(User.objects.create_user('other', password='pw'))
+        self.assertEqual(self.create_category('Theirs').status_code, 200)
+
+    @override_settings(RATE_LIMITS={'order-transition': (1, 60)})
+    def test_api_buckets_are_per_basic_auth_user(self):
+        User.objects.create_user('other', password='pw')
+
+        def transition(username):
+            return Client(HTTP_AUTHORIZATION=basic_auth(username, 'pw')).post(
+                reverse('api-order-transition'), {'order_ids': [], 'status': 'confirmed'},
+                content_type='application/json',
+            )
+
+        self.assertNotEqual(transition('staff').status_code, 429)
+        self.assertEqual(transition('staff').status_code, 429)
+        # Same address, another user: a bucket of its own
+        self.assertNotEqual(transition('other').status_code, 429)
+
+    @override_settings(WRITE_CONCURRENCY_LIMIT=1)
+    def test_concurrency_cap_returns_503(self):
+        self.assertTrue(_acquire_slot())
+        try:
+            response = self.create_category('Busy')
+        finally:
+            _release_slot()
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(self.create_category('Free').status_code, 200)
+
+    @override_settings(RATE_LIMITS={'create-category': (2, 60)})
+    def test_idle_bucket_refills_without_overwriting_the_count(self):
+        start = time.time()
+        # A reset written with cache.set would drop the increments of requests racing it
+        with mock.patch.object(cache, 'set', side_effect=AssertionError('bucket reset with cache.set')):
+            with mock.patch('time.time', return_value=start):
+                self.assertEqual([take_token('create-category', 'user:1') for _ in range(3)], [0, 0, 30])
+            with mock.patch('time.time', return_value=start + 60.5):
+                self.assertEqual([take_token('create-category', 'user:1') for _ in range(3)], [0, 0, 30])
+
+    @override_settings(WRITE_CONCURRENCY_LIMIT=2)
+    def test_in_flight_count_outlives_its_timeout_under_load(self):
+        start = time.time()
+        with mock.patch('time.time', return_value=start):
+            self.assertTrue(_acquire_slot())
+        with mock.patch('time.time', return_value=start + INFLIGHT_TIMEOUT - 1):
+            self.assertTrue(_acquire_slot())
+        with mock.patch('time.time', return_value=start + INFLIGHT_TIMEOUT + 1):
+            self.assertFalse(_acquire_slot())
+
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Shirts')
+        self.product = Product.objects.create(name='Shirt', sku='SHT-1', category=category, price=100, cost=60, stock=100)
+        old = timezone.now() - timedelta(days=400)
+        self.cutoff = timezone.now() - timedelta(days=365)
+        Sale.objects.bulk_create([
+            Sale(product=self.product, quantity=1, unit_price=100, total_amount=100, unit_cost=60, created_at=old)
+            for _ in range(5)
+        ] + [Sale(product=self.product, quantity=1, unit_price=100, total_amount=100, unit_cost=60)])
+        for status in ('delivered', 'delivered', 'pending'):
+            order = Order.objects.create(customer_name='Ali', customer_phone='0300', customer_address='Lahore',
+                                         status=status, created_at=old)
+            OrderItem.objects.create(order=order, product=self.product, quantity=2, unit_price=100, created_at=old)
+
+    def test_batches_are_resumable_and_keep_open_orders(self):
+        self.assertEqual(archive_sales(self.cutoff, batch_size=2, max_batches=2), 4)
+        self.assertEqual(archive_sales(self.cutoff, batch_size=2), 1)
+        self.assertEqual(archive_orders(self.cutoff, batch_size=1), 2)
+
+        self.assertEqual((Sale.objects.count(), ArchivedSale.objects.count()), (1, 5))
+        self.assertEqual(list(Order.objects.values_list('status', flat=True)), ['pending'])
+        self.assertEqual(ArchivedOrder.objects.count(), 2)
+        self.assertEqual(ArchivedOrderItem.objects.count(), 2)
+        self.assertEqual(Notification.objects.filter(type='new_order').count(), 1)
+
+    def test_reports_and_rollups_span_the_archive(self):
+        before = margin_report(group_by='category')
+        rollup_margins(days=1)
+
+        archive_sales(self.cutoff)
+        archive_orders(self.cutoff)
+        rollup_margins(days=1)
+
+        self.assertEqual(margin_report(group_by='category'), before)
+        self.assertEqual(before[0].quantity, 10)
+        live = margin_report(group_by='category', include_archive=False)
+        self.assertEqual((live[0].quantity, live[0].revenue), (1, Decimal('100.00')))
+
+
+class ProductFamilyTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('staff', password='pw'))
+        category = Category.objects.create(name='Jeans')
+        for size in ('L', 'M'):
+            for color, stock in (('Blue', 10), ('Black', 2)):
+                Product.objects.create(
+                    name='Slim Jeans', sku=f'JNS-{color[:3].upper()}-{size}', category=category,
+                    size=size, color=color, price=2500 if size == 'M' else 2700, stock=stock, reorder_threshold=3,
+                )
+        Product.objects.create(name='Belt', sku='BLT-001', category=category, price=900, stock=5)
+
+    def test_variants_are_grouped_by_name_and_sku_prefix(self):
+        self.assertEqual(
+            sorted(ProductFamily.objects.values_list('name', 'sku_prefix')),
+            [('Belt', 'BLT-001'), ('Slim Jeans', 'JNS')],
+        )
+        self.assertEqual(ProductFamily.prefix_for('Sht-L', 'L', 'White'), 'Sht')
+
+    def test_family_list_is_one_grouped_query(self):
+        with self.assertNumQueries(1):
+            jeans = {family.name: family for family in family_summaries()}['Slim Jeans']
+
+        self.assertEqual((jeans.variant_count, jeans.total_stock), (4, 24))
+        self.assertEqual((jeans.min_price, jeans.max_price), (Decimal('2500.00'), Decimal('2700.00')))
+        self.assertEqual(jeans.low_stock_count, 2)
+
+    def test_matrix_endpoint(self):
+        family = ProductFamily.objects.get(sku_prefix='JNS')
+
+        response = self.client.get(reverse('api-families-detail', args=[family.pk]))
+
+        body = response.json()
+        self.assertEqual((body['sizes'], body['colors']), (['M', 'L'], ['Black', 'Blue']))
+        self.assertEqual(body['matrix'][0]['cells'][0]['sku'], 'JNS-BLA-M')
+        self.assertTrue(body['matrix'][0]['cells'][0]['low_stock'])
+        listing = self.client.get(reverse('api-families-list')).json()
+        self.assertEqual([row['low_stock'] for row in listing], [False, True])
+
+    def test_pages(self):
+        family = ProductFamily.objects.get(sku_prefix='JNS')
+        self.assertContains(self.client.get(reverse('product-family-list')), 'Slim Jeans')
+        self.assertContains(self.client.get(reverse('product-family-detail', args=[family.pk])), 'Black')
+
+
+class CatalogCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        catalog.clear_local()
+        self.category = Category.objects.create(name='Caps')
+        self.product = Product.objects.create(name='Cap', sku='CAP-RED', category=self.category, price=500, stock=2)
+
+    def counted(self, lookup):
+        before = catalog.stats()
+        value = lookup()
+        after = catalog.stats()
+        return value, {name: after[name] - before[name] for name in ('local_hits', 'shared_hits', 'misses')}
+
+    def test_lookups_go_local_then_shared_then_database(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.counted(catalog.categories)[1], {'local_hits': 0, 'shared_hits': 0, 'misses': 1})
+        with self.assertNumQueries(0):
+            self.assertEqual(self.counted(catalog.categories)[1], {'local_hits': 1, 'shared_hits': 0, 'misses': 0})
+            catalog.clear_local()
+            categories, counts = self.counted(catalog.categories)
+        self.assertEqual(counts, {'local_hits': 0, 'shared_hits': 1, 'misses': 0})
+        self.assertEqual(categories, [(self.category.pk, 'Caps')])
+
+    def test_catalog_writes_invalidate_and_stock_moves_do_not(self):
+        catalog.product_map()
+        self.product.reduce_stock(1)
+        apply_stock_deltas({self.product.pk: 1}, StockMovement.Reason.SALE)
+        with self.assertNumQueries(0):
+            self.assertIn(self.product.pk, catalog.product_map())
+
+        self.product.price = 550
+        self.product.save()
+        Category.objects.create(name='Hats')
+        self.assertEqual(catalog.product_map()[self.product.pk].price, Decimal('550.00'))
+        self.assertEqual([category.name for category in catalog.categories()], ['Caps', 'Hats'])
+
+    def test_local_entries_expire_with_the_shared_ones(self):
+        # What bounds staleness in other workers when the cache is not shared
+        with override_settings(CATALOG_CACHE_TIMEOUT=0):
+            catalog.categories()
+            with self.assertNumQueries(1):
+                catalog.categories()
+
+    def test_sold_out_products_are_hidden_and_refused(self):
+        form = SellForm()
+        self.assertIn((self.product.pk, 'Cap (CAP-RED)'), list(form.fields['product'].choices))
+
+        self.product.reduce_stock(2)
+        form = SellForm({'product': self.product.pk, 'quantity': 1})
+
+        with self.assertNumQueries(1):
+            choices = list(form.fields['product'].choices)
+        self.assertNotIn((self.product.pk, 'Cap (CAP-RED)'), choices)
+        self.assertFalse(form.is_valid())
+        self.assertIn('product', form.errors)
+
+
+class ScanTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        catalog.clear_local()
+        self.client.force_login(User.objects.create_user('cashier', password='pw'))
+        category = Category.objects.create(name='Caps')
+        self.product = Product.objects.create(
+            name='Cap', sku='CAP-RED', category=category, price=500, cost=300, stock=5, reorder_threshold=2,
+        )
+
+    def test_warm_lookup_skips_the_database(self):
+        catalog.scan_entry('CAP-RED')
+        catalog.scan_entry('NOPE')
+        with self.assertNumQueries(0):
+            self.assertEqual(catalog.scan_entry('CAP-RED').price, Decimal('500.00'))
+            self.assertIsNone(catalog.scan_entry('NOPE'))
+
+    def test_price_change_invalidates_and_stock_change_does_not(self):
+        catalog.scan_entry('CAP-RED')
+        self.product.reduce_stock(1)
+        with self.assertNumQueries(0):
+            catalog.scan_entry('CAP-RED')
+
+        self.product.price = 550
+        self.product.save()
+        self.assertEqual(catalog.scan_entry('CAP-RED').price, Decimal('550.00'))
+
+    def test_entries_are_reread_after_the_timeout(self):
+        # A price written without a generation bump, as another worker's
+        # edit looks without a shared cache
+        catalog.scan_entry('CAP-RED')
+        Product.objects.filter(pk=self.product.pk).update(price=600)
+        self.assertEqual(catalog.scan_entry('CAP-RED').price, Decimal('500.00'))
+
+        with override_settings(SCAN_CACHE_TIMEOUT=0):
+            catalog.clear_local()
+            catalog.scan_entry('CAP-RED')
+            Product.objects.filter(pk=self.product.pk).update(price=650)
+            self.assertEqual(catalog.scan_entry('CAP-RED').price, Decimal('650.00'))
+
+    def test_lookup_endpoint(self):
+        response = self.client.get(reverse('api-scan-lookup', args=['CAP-RED']))
+
+        self.assertEqual(response.json(), {'id': self.product.pk, 'sku': 'CAP-RED', 'name': 'Cap', 'price': '500.00'})
+        self.assertEqual(self.client.get(reverse('api-scan-lookup', args=['cap-red'])).status_code, 404)
+
+    def test_scan_sell_records_sale_and_refuses_oversell(self):
+        response = self.client.post(
+            reverse('api-scan-sell'), {'sku': 'CAP-RED', 'quantity': 3}, content_type='application/json',
+        )
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['stock'], 2)
+        sale = Sale.objects.get()
+        self.assertEqual((sale.quantity, sale.total_amount, sale.unit_cost), (3, Decimal('1500.00'), Decimal('300.00')))
+        self.assertTrue(Notification.objects.filter(type='low_stock', product=self.product).exists())
+
+        response = self.client.post(
+            reverse('api-scan-sell'), {'sku': 'CAP-RED', 'quantity': 3}, content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Product.objects.get(pk=self.product.pk).stock, 2)
+        self.assertEqual(Sale.objects.count(), 1)
+
+
+class AdminChangelistTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(User.objects.create_superuser('admin', password='pw'))
+        self.product = Product.objects.create(
+            name='Shirt', sku='SHT-1', category=Category.objects.create(name='Shirts'), price=100, stock=1000,
+        )
+
+    def add_orders(self, count, age_days=0):
+        for i in range(count):
+            order = Order.objects.create(
+                customer_name='Ali', customer_phone='0300', customer_address='Lahore',
+                created_at=timezone.now() - timedelta(days=age_days),
+            )
+            OrderItem.objects.create(order=order, product=self.product, quantity=2)
+        return order
+
+    def changelist_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        return len(queries)
+
+    def test_changelist_queries_do_not_grow_with_rows(self):
+        url = reverse('admin:inventory_order_changelist')
+        self.add_orders(2)
+        before = self.changelist_queries(url)
+        self.add_orders(10)
+        self.assertEqual(self.changelist_queries(url), before)
+        for model in ('orderitem', 'sale', 'notification', 'product'):
+            self.assertEqual(self.client.get(reverse(f'admin:inventory_{model}_changelist')).status_code, 200)
+
+    def test_old_rows_are_outside_the_default_window(self):
+        old = self.add_orders(1, age_days=90)
+        recent = self.add_orders(1)
+        url = reverse('admin:inventory_order_changelist')
+
+        page = self.client.get(url)
+        self.assertContains(page, recent.order_number)
+        self.assertNotContains(page, old.order_number)
+        everything = self.client.get(url, {'period': 'all'})
+        self.assertContains(everything, old.order_number)
+        self.assertContains(everything, f'created_at__year={timezone.localtime(old.created_at).year}')
+        self.assertContains(self.client.get(url, {'created_at__year': old.created_at.year}), old.order_number)
+
+    def test_search_looks_past_the_default_window(self):
+        old = self.add_orders(1, age_days=90)
+        url = reverse('admin:inventory_order_changelist')
+
+        change_url = reverse('admin:inventory_order_change', args=[old.pk])
+
+        self.assertContains(self.client.get(url, {'q': old.order_number}), change_url)
+        self.assertNotContains(self.client.get(url, {'q': ''}), change_url)
+
+    @override_settings(ADMIN_EXACT_COUNT_LIMIT=3)
+    def test_large_counts_are_cached(self):
+        self.add_orders(2)
+        self.assertEqual(estimated_count(Order.objects.all()), 2)
+        self.add_orders(2)
+        self.assertEqual(estimated_count(Order.objects.all()), 4)
+        self.add_orders(1)
+        with self.assertNumQueries(0):
+            self.assertEqual(estimated_count(Order.objects.all()), 4)
+
+
+class StockTakeTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('staff', password='pw'))
+        category = Category.objects.create(name='Socks')
+        Product.objects.bulk_create([
+            Product(name=f'Sock {i}', sku=f'SCK-{i:03}', category=category, price=200, cost=120, stock=10)
+            for i in range(50)
+        ])
+
+    def test_counts_are_summed_and_header_skipped(self):
+        counts = read_counts(['sku,quantity', 'SCK-001,4', '', 'SCK-001,3'])
+        self.assertEqual(counts, {'SCK-001': 7})
+
+    def test_bad_quantities_name_their_line(self):
+        for lines, error in (
+            (['SCK-001,4', 'SCK-002,²'], "Line 2: quantity '²' is not a whole number."),
+            (['SCK-001,4', 'SCK-002,٣'], "Line 2: quantity '٣' is not a whole number."),
+            (['SCK-001,2147483647', 'SCK-001,1'], 'Line 2: the count for SCK-001 is over 2147483647.'),
+        ):
+            with self.assertRaisesMessage(CountFileError, error):
+                read_counts(lines)
+
+    def test_variances_are_found_and_applied_in_fixed_queries(self):
+        counts = {f'SCK-{i:03}': 10 for i in range(50)}
+        counts.update({'SCK-000': 7, 'SCK-001': 12, 'NOPE-1': 3})
+
+        # stock take, one line batch, match, variance join, one adjustment batch, unknown count, save
+        with self.assertNumQueries(9):
+            stock_take = load_count(counts)
+
+        self.assertEqual(stock_take.unknown_count, 1)
+        totals = summary(stock_take)
+        self.assertEqual((totals['variances'], totals['units_over'], totals['units_short']), (2, 2, -3))
+        self.assertEqual(totals['value_at_cost'], Decimal('-120.00'))
+
+        # A sale between loading and applying the count is kept
+        Product.objects.filter(sku='SCK-000').update(stock=9)
+        self.assertEqual(apply_stock_take(stock_take), 2)
+
+        stock = dict(Product.objects.filter(sku__in=['SCK-000', 'SCK-001', 'SCK-002']).values_list('sku', 'stock'))
+        self.assertEqual(stock, {'SCK-000': 6, 'SCK-001': 12, 'SCK-002': 10})
+        self.assertEqual(list(StockCountLine.objects.values_list('sku', flat=True)), ['NOPE-1'])
+        with self.assertRaises(ValueError):
+            apply_stock_take(stock_take)
+
+    def test_upload_and_streamed_report(self):
+        upload = SimpleUploadedFile('count.csv', b'SKU,Qty\r\nSCK-005,8\r\nGHOST,1\r\n', content_type='text/csv')
+        response = self.client.post(reverse('stock-take-list'), {'count_file': upload})
+        stock_take = StockTake.objects.get()
+        self.assertRedirects(response, reverse('stock-take-detail', args=[stock_take.pk]))
+        self.assertContains(self.client.get(response['Location']), 'SCK-005')
+
+        report = self.client.get(reverse('stock-take-report', args=[stock_take.pk]))
+        rows = b''.join(report.streaming_content).decode().splitlines()
+        self.assertEqual(rows[1], 'SCK-005,Sock 5,10,8,-2,200.00,120.00,-400.00,-240.00')
+        self.assertEqual(rows[2], 'GHOST,(unknown SKU),,1,,,,,')
+
+        self.client.post(reverse('stock-take-detail', args=[stock_take.pk]))
+        self.assertEqual(Product.objects.get(sku='SCK-005').stock, 8)
+        self.assertEqual(StockAdjustment.objects.get().variance, -2)
+
+
+
+class ConcurrencyTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('staff', password='pw'))
+        self.category = Category.objects.create(name='Kurtas')
+        self.product = Product.objects.create(
+            name='Kurta', sku='KRT-001', category=self.category, price=1000, cost=600, stock=10,
+        )
+
+    def product_payload(self, **changes):
+        """The product form as loaded now, with ``changes`` typed in"""
+        product = self.product
+        data = {
+            'name': product.name, 'sku': product.sku, 'category': product.category_id, 'size': '', 'color': '',
+            'price': product.price, 'cost': product.cost, 'stock': product.stock, 'initial-stock': product.stock,
+            'reorder_threshold': product.reorder_threshold, 'is_active': 'on', 'version': product.version,
+        }
+        data.update(changes)
+        return data
+
+    def test_stale_product_form_is_refused(self):
+        data = self.product_payload(price='1200.00')
+        other = Product.objects.get(pk=self.product.pk)
+        other.name = 'Kurta (cotton)'
+        save_changes(other, ['name'])
+
+        response = self.client.post(reverse('product-update', args=[self.product.pk]), data)
+
+        self.assertContains(response, 'changed by someone else')
+        product = Product.objects.get(pk=self.product.pk)
+        self.assertEqual((product.name, product.price, product.version), ('Kurta (cotton)', Decimal('1000.00'), 2))
+
+    def test_price_edit_keeps_a_concurrent_sale(self):
+        data = self.product_payload(price='1200.00')
+        Product.objects.get(pk=self.product.pk).reduce_stock(3)
+
+        response = self.client.post(reverse('product-update', args=[self.product.pk]), data)
+
+        self.assertRedirects(response, reverse('product-list'), fetch_redirect_response=False)
+        product = Product.objects.get(pk=self.product.pk)
+        self.assertEqual((product.price, product.stock, product.version), (Decimal('1200.00'), 7, 2))
+
+    def test_api_price_edit_keeps_a_concurrent_sale(self):
+        url = reverse('api-products-detail', args=[self.product.pk])
+        data = {**self.client.get(url).json(), 'price': '1200.00'}
+        Product.objects.get(pk=self.product.pk).reduce_stock(3)
+
+        response = self.client.put(url, data, content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        product = Product.objects.get(pk=self.product.pk)
+        self.assertEqual((product.price, product.stock, product.version), (Decimal('1200.00'), 7, 2))
+
+        # A stock edit names the stock it was loaded at and is refused once a sale moved it
+        response = self.client.patch(url, {'stock': 20, 'expected_stock': 10}, content_type='application/json')
+        self.assertEqual(response.status_code, 409)
+        response = self.client.patch(url, {'stock': 20, 'expected_stock': 7}, content_type='application/json')
+        self.assertEqual((response.status_code, response.json()['stock']), (200, 20))
+
+    def test_reduce_stock_from_stale_instances_loses_no_sale(self):
+        first, second, third = (Product.objects.get(pk=self.product.pk) for _ in range(3))
+
+        self.assertTrue(first.reduce_stock(4))
+        self.assertTrue(second.reduce_stock(4))
+        self.assertFalse(third.reduce_stock(4))
+
+        self.assertEqual((second.stock, third.stock, Product.objects.get(pk=self.product.pk).stock), (2, 2, 2))
+        self.assertEqual(
+            list(StockMovement.objects.filter(product=self.product).values_list('quantity', flat=True)),
+            [10, -4, -4],
+        )
+
+    def test_stock_edit_over_a_concurrent_sale_is_refused(self):
+        data = self.product_payload(stock=20)
+        Product.objects.get(pk=self.product.pk).reduce_stock(3)
+
+        response = self.client.post(reverse('product-update', args=[self.product.pk]), data)
+
+        self.assertContains(response, 'changed by someone else')
+        self.assertEqual(Product.objects.get(pk=self.product.pk).stock, 7)
+
+    def test_api_update_with_stale_version_conflicts(self):
+        url = reverse('api-products-detail', args=[self.product.pk])
+        response = self.client.patch(url, {'price': '1100.00', 'version': 1}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['version'], 2)
+
+        response = self.client.patch(url, {'price': '900.00', 'version': 1}, content_type='application/json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Product.objects.get(pk=self.product.pk).price, Decimal('1100.00'))
+
+    def test_stale_order_edit_is_refused(self):
+        order = Order.objects.create(customer_name='Sara', customer_phone='0321', customer_address='Karachi')
+        item = OrderItem.objects.create(order=order, product=self.product, quantity=2, unit_price=1000)
+        stock, total = Product.objects.get(pk=self.product.pk).stock, Order.objects.get(pk=order.pk).total_amount
+        data = OrderEditTests.edit_payload(self, order, [item], changes={item.pk: 5})
+        other = Order.objects.get(pk=order.pk)
+        other.customer_phone = '0333'
+        save_changes(other, ['customer_phone'])
+
+        response = self.client.post(reverse('order-update', args=[order.pk]), data)
+
+        self.assertContains(response, 'changed by someone else')
+        # The line, its stock and the total roll back with the header
+        self.assertEqual(OrderItem.objects.get(pk=item.pk).quantity, 2)
+        self.assertEqual(Product.objects.get(pk=self.product.pk).stock, stock)
+        order.refresh_from_db()
+        self.assertEqual((order.customer_phone, order.total_amount, order.version), ('0333', total, 2))
+
+        transition_orders([order.pk], 'confirmed')
+        order.refresh_from_db()
+        self.assertEqual(order.version, 3)
+
+
+
+class RepricingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(User.objects.create_user('manager', password='pw'))
+        self.shirts = Category.objects.create(name='Shirts')
+        shoes = Category.objects.create(name='Shoes')
+        Product.objects.bulk_create([
+            Product(name='Polo', sku='POLO-M', category=self.shirts, size='M', price=1500, cost=600, stock=4),
+            Product(name='Tee', sku='TEE-M', category=self.shirts, size='M', price=1000, cost=900, stock=10),
+            Product(name='Oxford', sku='OXF-L', category=self.shirts, size='L', price=3000, cost=1000, stock=1),
+            Product(name='Loafer', sku='LOAF-42', category=shoes, size='EU42', price=5000, cost=2000, stock=2),
+        ])
+
+    def prices(self):
+        return dict(Product.objects.values_list('sku', 'price'))
+
+    def test_preview_totals_and_apply(self):
+        rule = RepricingRule(
+            mode='percent', value=Decimal('-20'), rounding='x99', min_margin=Decimal('20'),
+            category=self.shirts.pk, sizes=('M',),
+        )
+        # 1500 -> 1200 -> 1199; 1000 -> 800 -> 799, held at 900 / 0.8 = 1125 by the margin floor
+        result = preview(rule)
+        self.assertEqual(
+            (result.matched, result.changed, result.raised, result.lowered, result.floored), (2, 2, 1, 1, 1)
+        )
+        self.assertEqual((result.value_before, result.value_after), (Decimal('16000.00'), Decimal('16046.00')))
+        self.assertEqual([(row.sku, row.new_price) for row in result.samples], [
+            ('POLO-M', Decimal('1199.00')), ('TEE-M', Decimal('1125.00')),
+        ])
+
+        # savepoint, run, INSERT ... SELECT of the history, one UPDATE, run total, release
+        with self.assertNumQueries(6):
+            repricing = apply_repricing([rule], note='Summer sale')
+
+        self.assertEqual(self.prices(), {
+            'POLO-M': Decimal('1199.00'), 'TEE-M': Decimal('1125.00'),
+            'OXF-L': Decimal('3000.00'), 'LOAF-42': Decimal('5000.00'),
+        })
+        self.assertEqual(repricing.change_count, 2)
+        self.assertEqual(
+            set(PriceChange.objects.values_list('product__sku', 'old_price', 'new_price')),
+            {('POLO-M', Decimal('1500.00'), Decimal('1199.00')), ('TEE-M', Decimal('1000.00'), Decimal('1125.00'))},
+        )
+        self.assertEqual(Product.objects.get(sku='POLO-M').version, 2)
+
+    def test_rules_apply_in_order(self):
+        apply_repricing([
+            RepricingRule(mode='percent', value=Decimal('10'), rounding='rupee'),
+            RepricingRule(mode='amount', value=Decimal('-5'), category=self.shirts.pk),
+        ])
+        self.assertEqual(self.prices()['OXF-L'], Decimal('3295.00'))
+        self.assertEqual(self.prices()['LOAF-42'], Decimal('5500.00'))
+        self.assertEqual(
+            list(PriceChange.objects.filter(product__sku='OXF-L').order_by('rule').values_list('old_price', 'new_price')),
+            [(Decimal('3000.00'), Decimal('3300.00')), (Decimal('3300.00'), Decimal('3295.00'))],
+        )
+
+    def test_api_preview_and_apply(self):
+        body = {'rules': [{'mode': 'amount', 'value': '-100', 'category': self.shirts.pk, 'sizes': ['L']}]}
+        response = self.client.post(reverse('api-repricing-preview'), body, content_type='application/json')
+        self.assertEqual(response.json()['rules'][0]['changed'], 1)
+        self.assertEqual(self.prices()['OXF-L'], Decimal('3000.00'))
+
+        response = self.client.post(reverse('api-repricing'), body, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['change_count'], 1)
+        self.assertEqual(self.prices()['OXF-L'], Decimal('2900.00'))
+
+        bad = {'rules': [{'mode': 'percent', 'value': '-100'}]}
+        response = self.client.post(reverse('api-repricing'), bad, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+
+class CustomerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(User.objects.create_user('staff', password='pw'))
+        category = Category.objects.create(name='Shawls')
+        self.product = Product.objects.create(name='Shawl', sku='SHW-1', category=category, price=2500, stock=20)
+
+    def place(self, phone, quantity=1, name='Ayesha'):
+        order = Order.objects.create(customer_name=name, customer_phone=phone, customer_address='Multan')
+        OrderItem.objects.create(order=order, product=self.product, quantity=quantity, unit_price=2500)
+        order.calculate_total()
+        return order
+
+    def test_phone_numbers_normalize(self):
+        for phone in ('0300-1234567', '+92 300 1234567', '923001234567', '00923001234567', '300 1234567'):
+            self.assertEqual(Customer.normalize_phone(phone), '03001234567', phone)
+        self.assertEqual(Customer.normalize_phone('0300'), '')
+
+    def test_orders_link_to_one_customer_and_keep_lifetime_totals(self):
+        first = self.place('0300-1234567')
+        second = self.place('+92 300 1234567', quantity=2, name='Ayesha Khan')
+
+        customer = Customer.objects.get()
+        self.assertEqual({first.customer_id, second.customer_id}, {customer.pk})
+        self.assertEqual((customer.name, customer.order_count, customer.total_spent), ('Ayesha Khan', 2, Decimal('7500.00')))
+        self.assertEqual(customer.last_order_at, second.created_at)
+
+        transition_orders([second.pk], 'cancelled')
+        customer.refresh_from_db()
+        self.assertEqual((customer.order_count, customer.total_spent), (2, Decimal('2500.00')))
+
+        # Archiving keeps the lifetime totals and the link
+        archive_orders(timezone.now() + timedelta(days=1))
+        customer.refresh_from_db()
+        self.assertEqual((customer.order_count, customer.total_spent), (2, Decimal('2500.00')))
+        self.assertEqual(ArchivedOrder.objects.get(pk=second.pk).customer_id, customer.pk)
+
+    def test_order_edit_moves_spend_by_the_difference(self):
+        order = self.place('03001234567')
+        item = order.items.get()
+        data = OrderEditTests.edit_payload(self, order, [item], changes={item.pk: 3})
+
+        self.client.post(reverse('order-update', args=[order.pk]), data)
+
+        self.assertEqual(Customer.objects.get().total_spent, Decimal('7500.00'))
+
+    def test_changing_the_phone_moves_the_order_to_the_new_customer(self):
+        order = self.place('0300-1234567')
+        item = order.items.get()
+        data = OrderEditTests.edit_payload(self, order, [item], changes={item.pk: 2})
+        data['customer_phone'] = '0321-7654321'
+
+        self.client.post(reverse('order-update', args=[order.pk]), data)
+
+        totals = dict(Customer.objects.values_list('phone', 'order_count'))
+        self.assertEqual(totals, {'03001234567': 0, '03217654321': 1})
+        order.refresh_from_db()
+        self.assertEqual(order.customer.phone, '03217654321')
+        self.assertEqual(order.customer.total_spent, Decimal('5000.00'))
+        self.assertEqual(Customer.objects.get(phone='03001234567').total_spent, Decimal('0.00'))
+
+        # The same through a plain save, as the admin does
+        order.customer_phone = '+92 300 1234567'
+        order.save()
+        totals = dict(Customer.objects.values_list('phone', 'order_count'))
+        self.assertEqual(totals, {'03001234567': 1, '03217654321': 0})
+        self.assertEqual(Customer.objects.get(phone='03001234567').total_spent, Decimal('5000.00'))
+
+    def test_search_matches_order_numbers_partial_phones_and_names(self):
+        first = self.place('0300-1234567')
+        self.place('0321-7654321', name='Bilal')
+        self.place('1234', name='Walk-in')
+        Order.objects.filter(pk=first.pk).update(order_number='ORD-55512345')
+
+        def search(text):
+            view = OrderListView()
+            view.request = RequestFactory().get('/', {'search': text})
+            return sorted(order.customer_name for order in view.get_queryset())
+
+        self.assertEqual(search('55512345'), ['Ayesha'])
+        self.assertEqual(search('7654'), ['Bilal'])
+        self.assertEqual(search('1234'), ['Ayesha', 'Walk-in'])
+        self.assertEqual(search('+92 321 7654321'), ['Bilal'])
+        self.assertEqual(search('walk'), ['Walk-in'])
+
+    def test_lookup_is_one_query_and_search_uses_the_phone_index(self):
+        self.place('0300-1234567')
+        self.place('0321-7654321', name='Bilal')
+
+        with self.assertNumQueries(3):  # session, user, customer
+            response = self.client.get(reverse('api-customer-lookup', args=['+923001234567']))
+        self.assertEqual(response.json()['name'], 'Ayesha')
+        self.assertEqual(response.json()['order_count'], 1)
+        self.assertEqual(self.client.get(reverse('api-customer-lookup', args=['0333-0000000'])).status_code, 404)
+
+        view = OrderListView()
+        view.request = RequestFactory().get('/', {'search': '0321 7654321'})
+        orders = view.get_queryset()
+        self.assertEqual([order.customer_name for order in orders], ['Bilal'])
+        self.assertNotIn('LIKE', str(orders.query))
+
+    def test_backfill_dedupes_existing_orders(self):
+        Order.objects.bulk_create([
+            Order(order_number=f'ORD-OLD{i}', customer_name=name, customer_phone=phone, customer_address='Quetta',
+                  total_amount=amount, status=status)
+            for i, (name, phone, amount, status) in enumerate([
+                ('Zara', '0312 5550000', 1000, 'delivered'),
+                ('Zara B', '+92-312-5550000', 500, 'cancelled'),
+                ('Omar', '0345 1112222', 800, 'pending'),
+                ('Nobody', '123', 50, 'pending'),
+            ])
+        ])
+        backfill = import_module('inventory.migrations.0014_backfill_customers')
+
+        backfill.backfill_customers(django_apps, connection.schema_editor())
+
+        customers = {c.phone: c for c in Customer.objects.all()}
+        self.assertEqual(set(customers), {'03125550000', '03451112222'})
+        zara = customers['03125550000']
+        self.assertEqual((zara.name, zara.order_count, zara.total_spent), ('Zara B', 2, Decimal('1000.00')))
+        self.assertEqual(Order.objects.filter(customer__isnull=True).count(), 1)
+
+
+QUERY_BUDGETS_PATH = Path(__file__).with_name('query_budgets.json')
+# Set by `manage.py refresh_query_budgets` to rewrite the file instead of checking it
+RECORD_QUERY_BUDGETS = os.environ.get('QUERY_BUDGETS_RECORD') == '1'
+# Recorded latency ceilings are this many times the measured time, and at least FLOOR_MS
+LATENCY_HEADROOM = 5
+LATENCY_FLOOR_MS = 50
+
+
+class StandInReceiver(BaseHTTPRequestHandler):
+    """Webhook receiver for tests: records each request and answers with the next queued status"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.received.append((self.client_address, self.headers, body))
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class WebhookTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.receiver = ThreadingHTTPServer(('127.0.0.1', 0), StandInReceiver)
+        self.receiver.received = []
+        self.receiver.statuses = []
+        threading.Thread(target=self.receiver.serve_forever, daemon=True).start()
+        self.endpoint = WebhookEndpoint.objects.create(
+            url=f'http://127.0.0.1:{self.receiver.server_port}/hooks', secret='s3cret',
+        )
+        category = Category.objects.create(name='Kurtas')
+        self.product = Product.objects.create(
+            name='Kurta', sku='KRT-001', category=category, price=1000, cost=600, stock=5, reorder_threshold=3,
+        )
+
+    def tearDown(self):
+        self.receiver.shutdown()
+        self.receiver.server_close()
+        cache.clear()
+
+    def deliver(self, *args):
+        out = StringIO()
+        call_command('deliver_webhooks', '--once', *args, stdout=out)
+        return out.getvalue()
+
+    def test_endpoint_deleted_in_another_worker_is_skipped(self):
+        # This worker's cache still lists the endpoint another one deleted
+        stale = subscriptions()
+        self.endpoint.delete()
+        cache.set(SUBSCRIPTIONS_KEY, stale)
+
+        Order.objects.create(customer_name='Zara', customer_phone='03001234567', customer_address='Lahore')
+
+        self.assertFalse(WebhookEvent.objects.exists())
+        connection.check_constraints()
+        self.assertIsNone(cache.get(SUBSCRIPTIONS_KEY))
+
+    def test_events_are_queued_in_the_transaction_of_the_change(self):
+        low_only = WebhookEndpoint.objects.create(url='http://127.0.0.1:9/low', secret='x', events=['stock.low'])
+        order = Order.objects.create(customer_name='Zara', customer_phone='03001234567', customer_address='Lahore')
+        OrderItem.objects.create(order=order, product=self.product, quantity=3)
+        transition_orders([order.pk], 'cancelled')
+
+        queued = list(WebhookEvent.objects.filter(endpoint=self.endpoint).values_list('type', 'data'))
+        self.assertEqual(queued, [
+            ('order.created', {'order_number': order.order_number}),
+            ('stock.changed', {'before': 5, 'after': 2}),
+            ('stock.low', {'stock': 2, 'threshold': 3}),
+            ('order.status_changed', {'order_number': order.order_number, 'from': 'pending', 'to': 'cancelled'}),
+            ('stock.changed', {'before': 2, 'after': 5}),
+        ])
+        self.assertEqual(list(low_only.queued_events.values_list('type', flat=True)), ['stock.low'])
+
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            Order.objects.create(customer_name='Ali', customer_phone='03007654321', customer_address='Multan')
+            raise RuntimeError
+        self.assertEqual(WebhookEvent.objects.count(), 6)
+
+        WebhookEndpoint.objects.all().delete()
+        with self.assertNumQueries(1):
+            emit([('stock.changed', self.product.pk, {})])
+        with self.assertNumQueries(0):
+            emit([('stock.changed', self.product.pk, {})])
+
+    def test_batches_are_signed_and_share_connections(self):
+        emit(('stock.changed', self.product.pk, {'before': i, 'after': i + 1}) for i in range(500))
+
+        output = self.deliver('--batch-size', '50', '--concurrency', '4')
+        self.assertIn('Delivered 500 events in 10 requests', output)
+        self.assertFalse(WebhookEvent.objects.exclude(status='delivered').exists())
+
+        received = self.receiver.received
+        self.assertEqual(len(received), 10)
+        # Keep-alive connections from the pool, not one per request
+        self.assertLessEqual(len({address for address, _, _ in received}), 4)
+        _, headers, body = received[0]
+        self.assertEqual(headers['X-Webhook-Signature'], sign('s3cret', headers['X-Webhook-Timestamp'], body))
+        events = json.loads(body)['events']
+        self.assertEqual(len(events), 50)
+        self.assertEqual(events[0]['object']['sku'], 'KRT-001')
+        ids = sorted(event['id'] for _, _, body in received for event in json.loads(body)['events'])
+        self.assertEqual(ids, sorted(WebhookEvent.objects.values_list('pk', flat=True)))
+
+    @override_settings(WEBHOOK_MAX_ATTEMPTS=2)
+    def test_failures_back_off_then_dead_letter(self):
+        emit([('stock.changed', self.product.pk, {'before': 5, 'after': 4})])
+        self.receiver.statuses = [500, 503]
+
+        self.assertIn('1 to retry, 0 dead', self.deliver())
+        event = WebhookEvent.objects.get()
+        self.assertEqual((event.status, event.attempts, event.last_error), ('pending', 1, 'HTTP 500'))
+        self.assertGreater(event.next_attempt_at, timezone.now() + timedelta(seconds=10))
+        self.assertEqual(self.deliver(), '')
+
+        WebhookEvent.objects.update(next_attempt_at=timezone.now())
+        self.assertIn('0 to retry, 1 dead', self.deliver())
+        event.refresh_from_db()
+        self.assertEqual((event.status, event.attempts, event.last_error), ('dead', 2, 'HTTP 503'))
+
+        self.assertEqual(requeue(WebhookEvent.objects.all()), 1)
+        self.assertIn('Delivered 1 events', self.deliver())
+        self.assertEqual(len(self.receiver.received), 3)
+
+
+class UnreadCounterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(User.objects.create_superuser('admin', password='pw'))
+
+    def tearDown(self):
+        cache.clear()
+
+    def notify(self, title, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Notification.objects.create(type='new_order', title=title, message='', **kwargs)
+
+    def test_counter_follows_creates_and_reads_without_counting(self):
+        first = self.notify('First')
+        self.assertEqual(unread_count(), 1)
+
+        self.notify('Already read', is_read=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            create_notifications([Notification(type='low_stock', title=f'Low {i}', message='') for i in range(3)])
+        with self.assertRaises(RuntimeError), self.captureOnCommitCallbacks(execute=True), transaction.atomic():
+            Notification.objects.create(type='new_order', title='Rolled back', message='')
+            raise RuntimeError
+        with self.assertNumQueries(0):
+            self.assertEqual(unread_count(), 4)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('mark-notification-read', args=[first.pk]))
+            self.client.post(reverse('mark-notification-read', args=[first.pk]))
+        self.assertEqual(unread_count(), 3)
+
+        url = reverse('admin:inventory_notification_changelist')
+        selected = [str(pk) for pk in Notification.objects.values_list('pk', flat=True)]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(url, {'action': 'mark_as_read', '_selected_action': selected})
+        self.assertEqual(unread_count(), 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(url, {'action': 'mark_as_unread', '_selected_action': selected})
+        self.assertEqual(unread_count(), 5)
+        self.assertEqual(unread_count(), Notification.objects.filter(is_read=False).count())
+
+    def test_navigation_badge_costs_no_query_once_cached(self):
+        self.notify('New Order #ORD-1')
+        self.assertContains(self.client.get(reverse('sales-list')), 'New Order #ORD-1')
+        with CaptureQueriesContext(connection) as queries:
+            page = self.client.get(reverse('sales-list'))
+        self.assertContains(page, 'id="nav-unread"')
+        self.assertFalse([q['sql'] for q in queries if 'inventory_notification' in q['sql']])
+
+        # A new alert replaces the cached list
+        self.notify('New Order #ORD-2')
+        self.assertContains(self.client.get(reverse('sales-list')), 'New Order #ORD-2')
+
+    def test_writes_that_skip_the_counter_are_recounted(self):
+        self.notify('Kept')
+        self.notify('Deleted')
+        self.assertEqual(unread_count(), 2)
+        Notification.objects.filter(title='Deleted').delete()
+        self.assertEqual(unread_count(), 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            recount_unread()
+        self.assertEqual(unread_count(), 1)
+
+
+class StockLedgerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('staff', password='pw')
+        self.client.force_login(self.user)
+        category = Category.objects.create(name='Belts')
+        self.product = Product.objects.create(name='Belt', sku='BLT-1', category=category, price=900, stock=20)
+
+    def tearDown(self):
+        cache.clear()
+
+    def movements(self):
+        return list(
+            StockMovement.objects.filter(product=self.product).order_by('pk')
+            .values_list('quantity', 'reason', 'order_id', 'sale_id', 'user_id')
+        )
+
+    def test_sell_page_refuses_stock_taken_after_the_form_was_checked(self):
+        def sell_elsewhere(sender, instance, created, **kwargs):
+            # Another till sells between the form's stock check and this sale's update
+            Product.objects.filter(pk=self.product.pk).update(stock=F('stock') - 19)
+        post_save.connect(sell_elsewhere, sender=Sale)
+        self.addCleanup(post_save.disconnect, sell_elsewhere, sender=Sale)
+
+        response = self.client.post(reverse('sell'), {'product': self.product.pk, 'quantity': 2})
+
+        self.assertContains(response, 'Insufficient stock. Available: 1.', status_code=400)
+        self.assertFalse(Sale.objects.exists())
+        self.assertEqual(Product.objects.get(pk=self.product.pk).stock, 20)
+        self.assertEqual(len(self.movements()), 1)
+
+    def test_every_stock_path_is_recorded_with_its_reason(self):
+        Reason = StockMovement.Reason
+        order = Order.objects.create(customer_name='Ali', customer_phone='0300', customer_address='Lahore')
+        OrderItem.objects.create(order=order, product=self.product, quantity=3, unit_price=900)
+        self.client.post(reverse('sell'), {'product': self.product.pk, 'quantity': 2, 'idempotency_key': 'belt'})
+        sale = Sale.objects.get()
+        transition_orders([order.pk], 'cancelled', user=self.user)
+        stock_take = load_count({'BLT-1': 15})
+        apply_stock_take(stock_take)
+        self.product.refresh_from_db()
+        self.product.stock = 18
+        self.product.save()
+
+        self.assertEqual(self.movements(), [
+            (20, Reason.CREATED, None, None, None),
+            (-3, Reason.ORDER, order.pk, None, None),
+            (-2, Reason.SALE, None, sale.pk, self.user.pk),
+            (3, Reason.ORDER_CANCELLED, order.pk, None, self.user.pk),
+            (-3, Reason.STOCK_TAKE, None, None, None),
+            (3, Reason.EDIT, None, None, None),
+        ])
+        self.assertEqual(sum(quantity for quantity, *_ in self.movements()), 18)
+
+    def test_stock_at_reads_from_the_latest_snapshot(self):
+        created = StockMovement.objects.get(product=self.product).created_at
+        self.assertIsNone(ledger.stock_at(self.product.pk, created - timedelta(seconds=1)))
+        self.product.reduce_stock(5)
+        first = timezone.now()
+        self.assertEqual(ledger.take_snapshots(first), 1)
+        self.assertEqual(ledger.take_snapshots(first), 0)
+        self.product.reduce_stock(4)
+        between = timezone.now()
+        self.product.reduce_stock(1)
+        ledger.take_snapshots(timezone.now())
+
+        self.assertEqual(
+            list(StockSnapshot.objects.order_by('taken_at').values_list('stock', flat=True)), [15, 10],
+        )
+        self.assertEqual(ledger.stock_at(self.product.pk, created), 20)
+        self.assertEqual(ledger.stock_at(self.product.pk, first), 15)
+        with self.assertNumQueries(2):
+            self.assertEqual(ledger.stock_at(self.product.pk, between), 11)
+        self.assertEqual(ledger.stock_at(self.product.pk, timezone.now()), 10)
+        with self.assertRaises(ValueError):
+            ledger.take_snapshots(timezone.now() + timedelta(days=1))
+
+        response = self.client.get(
+            reverse('api-products-stock-at', args=[self.product.pk]), {'at': between.isoformat()},
+        )
+        self.assertEqual(response.json()['stock'], 11)
+        response = self.client.get(reverse('api-products-stock-at', args=[self.product.pk]), {'at': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_reconcile_corrects_writes_that_skip_the_ledger(self):
+        ledger.take_snapshots(timezone.now())
+        Product.objects.filter(pk=self.product.pk).update(stock=12)
+
+        self.assertEqual(ledger.reconcile(user=self.user), 1)
+        self.assertEqual(self.movements()[-1], (-8, StockMovement.Reason.CORRECTION, None, None, self.user.pk))
+        self.assertEqual(ledger.stock_at(self.product.pk, timezone.now()), 12)
+        self.assertEqual(ledger.reconcile(), 0)
+
+
+class LocationStockTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        catalog.clear_local()
+        self.user = User.objects.create_user('staff', password='pw')
+        self.client.force_login(self.user)
+        category = Category.objects.create(name='Scarves')
+        self.product = Product.objects.create(
+            name='Scarf', sku='SCF-1', category=category, price=700, cost=400, stock=20, reorder_threshold=4,
+        )
+        Product.objects.create(name='Shawl', sku='SHW-1', category=category, price=1500, stock=9)
+        self.shop = Location.objects.create(name='Mall Road', code='mall')
+
+    def tearDown(self):
+        cache.clear()
+
+    def totals(self):
+        self.product.refresh_from_db()
+        return self.product.stock, self.product.located_stock
+
+    def scan_sell(self, quantity, **location):
+        return self.client.post(
+            reverse('api-scan-sell'), {'sku': 'SCF-1', 'quantity': quantity, **location},
+            content_type='application/json',
+        )
+
+    def test_shops_sell_their_own_stock_and_totals_follow(self):
+        self.assertEqual(transfer_stock(self.product, 'warehouse', 'mall', 8, user=self.user), (12, 8))
+        self.assertEqual(self.totals(), (20, 8))
+
+        response = self.scan_sell(3, location='mall')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['stock'], 5)
+        self.assertEqual(self.totals(), (17, 5))
+        self.assertEqual(Sale.objects.get().location, self.shop)
+
+        response = self.scan_sell(6, location='mall')
+        self.assertEqual((response.status_code, response.json()['available']), (409, 5))
+        # The warehouse cannot sell what is at the shop
+        response = self.scan_sell(13)
+        self.assertEqual((response.status_code, response.json()['available']), (409, 12))
+        self.assertFalse(self.product.reduce_stock(13))
+        self.assertEqual(self.scan_sell(1, location='nowhere').status_code, 400)
+        with self.assertRaises(InsufficientStock):
+            transfer_stock(self.product, 'mall', 'warehouse', 6)
+
+        # A count short of the warehouse's share leaves the shop's units alone
+        apply_stock_take(load_count({'SCF-1': 2}))
+        self.assertEqual(self.totals(), (5, 5))
+        transfer_stock(self.product, 'mall', 'warehouse', 5)
+        self.assertEqual(self.totals(), (5, 0))
+        self.assertEqual(ProductLocationStock.objects.get().stock, 0)
+
+        movements = StockMovement.objects.filter(product=self.product, reason=StockMovement.Reason.TRANSFER)
+        self.assertEqual(
+            list(movements.order_by('pk').values_list('quantity', 'location_id')),
+            [(-8, None), (8, self.shop.pk), (-5, self.shop.pk), (5, None)],
+        )
+        self.assertEqual(ledger.stock_at(self.product.pk, timezone.now()), 5)
+
+    def test_failed_transfer_written_out_of_order_is_undone(self):
+        # The destination's row is written first here, as its id is lower
+        kiosk = Location.objects.create(name='Kiosk', code='kiosk')
+        transfer_stock(self.product, 'warehouse', 'mall', 4)
+        transfer_stock(self.product, 'warehouse', 'kiosk', 2)
+
+        with self.assertRaises(InsufficientStock):
+            transfer_stock(self.product, 'kiosk', 'mall', 3)
+        stocks = dict(ProductLocationStock.objects.values_list('location__code', 'stock'))
+        self.assertEqual(stocks, {'mall': 4, 'kiosk': 2})
+        self.assertEqual(transfer_stock(self.product, kiosk, 'mall', 2), (0, 6))
+        with self.assertRaises(InsufficientStock):
+            transfer_stock(self.product, 'mall', 'warehouse', 7)
+        with self.assertRaises(InsufficientStock):
+            transfer_stock(self.product, 'warehouse', 'mall', 15)
+        self.assertEqual(self.totals(), (20, 6))
+
+    def test_lists_filter_by_location(self):
+        transfer_stock(self.product, 'warehouse', 'mall', 3)
+
+        page = self.client.get(reverse('product-list'), {'location': 'mall'})
+        self.assertEqual([(p.sku, p.location_stock) for p in page.context['products']], [('SCF-1', 3)])
+        page = self.client.get(reverse('product-list'), {'location': 'warehouse', 'stock_status': 'in_stock'})
+        self.assertEqual([(p.sku, p.location_stock) for p in page.context['products']], [('SCF-1', 17), ('SHW-1', 9)])
+
+        response = self.client.get(reverse('api-products-list'), {'location': 'mall'})
+        self.assertEqual([(p['sku'], p['location_stock']) for p in response.json()], [('SCF-1', 3)])
+        self.assertEqual(self.client.get(reverse('api-products-list'), {'location': 'nowhere'}).status_code, 404)
+
+        self.scan_sell(1, location='mall')
+        page = self.client.get(reverse('dashboard'), {'location': 'mall'})
+        self.assertEqual((page.context['total_stock'], page.context['total_sales_count']), (2, 1))
+        page = self.client.get(reverse('dashboard'), {'location': 'warehouse'})
+        self.assertEqual((page.context['total_stock'], page.context['total_sales_count']), (26, 0))
+
+
+class LiveDashboardTests(TransactionTestCase):
+    """The streamed dashboard's queries run on worker threads, which only see committed rows"""
+    # Keep the default location the migrations create for the tests after this one
+    serialized_rollback = True
+
+    def setUp(self):
+        cache.clear()
+        catalog.clear_local()
+        self.user = User.objects.create_user('staff', password='pw')
+        category = Category.objects.create(name='Scarves')
+        product = Product.objects.create(
+            name='Scarf', sku='SCF-1', category=category, price=700, stock=3, reorder_threshold=4,
+        )
+        Product.objects.create(name='Shawl', sku='SHW-1', category=category, price=1500, stock=9)
+        Sale.objects.create(product=product, quantity=2, unit_price=700, total_amount=1400, created_by=self.user)
+
+    def tearDown(self):
+        cache.clear()
+
+    def stream(self, client, **params):
+        async def read():
+            response = await client.get(reverse('dashboard-live'), params)
+            if not response.streaming:
+                return response, []
+            return response, [chunk async for chunk in response.streaming_content]
+        return async_to_sync(read)()
+
+    def test_shell_comes_first_then_every_section(self):
+        client = AsyncClient()
+        response, _ = self.stream(client)
+        self.assertEqual(response.status_code, 302)
+
+        client.force_login(self.user)
+        response, chunks = self.stream(client)
+        self.assertEqual(response.status_code, 200)
+        shell, *sections, tail = [chunk.decode() for chunk in chunks]
+        self.assertIn('id="section-sales"', shell)
+        self.assertNotIn('₨1400.00', shell)
+        self.assertEqual(
+            sorted(section.split('"')[1] for section in sections),
+            sorted(f'section-{section.name}-content' for section in figures.SECTIONS),
+        )
+        page = ''.join(sections)
+        self.assertIn('₨1400.00', page)
+        self.assertIn('Threshold: 4', page)
+        self.assertIn('</html>', tail)
+
+    def test_served_by_wsgi(self):
+        client = Client()
+        client.force_login(self.user)
+        environ = RequestFactory()._base_environ(
+            PATH_INFO=reverse('dashboard-live'),
+            HTTP_COOKIE=f'{settings.SESSION_COOKIE_NAME}={client.cookies[settings.SESSION_COOKIE_NAME].value}',
+        )
+        started = []
+        handler = WSGIHandler()
+        with self.assertWarnsMessage(Warning, 'must consume asynchronous iterators'):
+            body = b''.join(handler(environ, lambda status, headers: started.append(status))).decode()
+        self.assertEqual(started, ['200 OK'])
+        self.assertIn('₨1400.00', body)
+        self.assertIn('</html>', body)
+
+    @override_settings(DASHBOARD_QUERY_THREADS=1)
+    def test_one_thread_brings_the_same_figures(self):
+        client = AsyncClient()
+        client.force_login(self.user)
+        response, chunks = self.stream(client)
+        self.assertEqual(len(chunks), len(figures.SECTIONS) + 2)
+        self.assertIn('₨1400.00', b''.join(chunks).decode())
+
+
+class QueryBudgetTests(TestCase):
+    """Every page and API endpoint, at two data sizes, against query_budgets.json.
+
+    An endpoint fails if its query count grows with the data (a per-row query,
+    e.g. a template reading ``product.category`` without ``select_related``),
+    if it runs more queries than its budget, or if it is slower than its
+    latency ceiling. Refresh the budgets with ``manage.py refresh_query_budgets``
+    after a deliberate change.
+    """
+    SIZES = (3, 12)
+
+    # name -> (url name, function of the fixture returning reverse() args).
+    # order-list, product-detail and notification-list are left out until
+    # their templates render. dashboard-live runs its queries on other
+    # threads' connections, out of reach of the count.
+    ENDPOINTS = {
+        'dashboard': ('dashboard', None),
+        'product-list': ('product-list', None),
+        'product-update': ('product-update', lambda f: [f.product.pk]),
+        'product-family-list': ('product-family-list', None),
+        'product-family-detail': ('product-family-detail', lambda f: [f.family.pk]),
+        'sell': ('sell', None),
+        'sales-list': ('sales-list', None),
+        'replenishment': ('replenishment', None),
+        'margin-report': ('margin-report', None),
+        'order-detail': ('order-detail', lambda f: [f.order.pk]),
+        'order-update': ('order-update', lambda f: [f.order.pk]),
+        'stock-take-list': ('stock-take-list', None),
+        'stock-take-detail': ('stock-take-detail', lambda f: [f.stock_take.pk]),
+        'catalog-cache-stats': ('catalog-cache-stats', None),
+        'metrics': ('metrics', None),
+        'api-categories-list': ('api-categories-list', None),
+        'api-categories-detail': ('api-categories-detail', lambda f: [f.product.category_id]),
+        'api-products-list': ('api-products-list', None),
+        'api-products-detail': ('api-products-detail', lambda f: [f.product.pk]),
+        'api-families-list': ('api-families-list', None),
+        'api-families-detail': ('api-families-detail', lambda f: [f.family.pk]),
+        'api-margin-report': ('api-margin-report', None),
+        'api-scan-lookup': ('api-scan-lookup', lambda f: [f.product.sku]),
+        'api-customer-lookup': ('api-customer-lookup', lambda f: [f.order.customer.phone]),
+    }
+
+    def setUp(self):
+        # Staff, so /metrics is measured too
+        self.user = User.objects.create_user('staff', password='pw', is_staff=True)
+        self.client.force_login(self.user)
+        self.size = 0
+        self.order = Order.objects.create(customer_name='Big', customer_phone='0300 1234567', customer_address='Lahore')
+
+    def grow(self, size):
+        """Add rows until every list, family and the big order holds ``size`` of them"""
+        for i in range(self.size, size):
+            category = Category.objects.create(name=f'Category {i}')
+            product = Product.objects.create(
+                name='Polo', sku=f'POLO-C{i}', color=f'C{i}', size='M', category=category,
+                price=1000 + i, cost=600, stock=100, reorder_threshold=150,
+            )
+            Product.objects.create(name=f'Tee {i}', sku=f'TEE{i}', category=category, price=500, stock=100)
+            OrderItem.objects.create(order=self.order, product=product, quantity=1)
+            order = Order.objects.create(customer_name=f'C{i}', customer_phone='0300', customer_address='Lahore')
+            OrderItem.objects.create(order=order, product=product, quantity=1)
+            Sale.objects.create(product=product, quantity=1, unit_price=product.price, total_amount=product.price, created_by=self.user)
+            ReorderSuggestion.objects.create(
+                product=product, daily_velocity=1, demand_std=0.5, weekday_factors=[1] * 7,
+                days_of_cover=100, reorder_point=10, reorder_quantity=20,
+            )
+        self.size = size
+        self.stock_take = load_count(
+            {sku: stock + 1 for sku, stock in Product.objects.values_list('sku', 'stock')}, user=self.user,
+        )
+        self.product = Product.objects.get(sku='POLO-C0')
+        self.family = self.product.family
+
+    def measure(self, url):
+        """Query count and best-of-three wall time in ms for a cold-cache GET"""
+        timings = []
+        for _ in range(3):
+            cache.clear()
+            catalog.clear_local()
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                response = self.client.get(url)
+                timings.append((time.perf_counter() - started) * 1000)
+            self.assertEqual(response.status_code, 200, url)
+        return len(queries), min(timings)
+
+    def test_endpoints_stay_within_budget(self):
+        budgets = {} if RECORD_QUERY_BUDGETS else json.loads(QUERY_BUDGETS_PATH.read_text())
+        measured = {}
+        recorded = {}
+        for size in self.SIZES:
+            self.grow(size)
+            for name, (url_name, args) in self.ENDPOINTS.items():
+                url = reverse(url_name, args=args(self) if args else None)
+                measured.setdefault(name, []).append(self.measure(url))
+
+        for name, runs in measured.items():
+            with self.subTest(endpoint=name):
+                counts = [queries for queries, _ in runs]
+                self.assertEqual(len(set(counts)), 1, f'{name} query count grows with data: {counts}')
+                queries, elapsed = runs[-1]
+                if RECORD_QUERY_BUDGETS:
+                    recorded[name] = {
+                        'queries': queries,
+                        'max_ms': max(math.ceil(elapsed * LATENCY_HEADROOM), LATENCY_FLOOR_MS),
+                    }
+                    continue
+                self.assertIn(name, budgets, 'No budget recorded; run manage.py refresh_query_budgets')
+                self.assertLessEqual(queries, budgets[name]['queries'], f'{name} runs more queries than budgeted')
+                self.assertLessEqual(elapsed, budgets[name]['max_ms'], f'{name} is slower than its ceiling')
+
+        # A baseline is only written when no endpoint's query count grew
+        if len(recorded) == len(self.ENDPOINTS):
+            QUERY_BUDGETS_PATH.write_text(json.dumps(recorded, indent=2, sort_keys=True) + '\n')
@@ -0,0 +1,131 @@
+"""
+Rate limiting and admission control for write endpoints.
+
+``throttled(scope)`` applies two checks before the view runs, both kept in
+the Django cache so they hold across gunicorn workers when REDIS_URL is set:
+
+* A token bucket per user and scope, sized by ``settings.RATE_LIMITS[scope]``
+  as ``(burst, per_seconds)``: up to ``burst`` requests at once, refilled at
+  ``burst / per_seconds`` a second. It is stored as a GCRA "theoretical
+  arrival time" that every request moves forward with one ``cache.incr``, so
+  concurrent requests never read-modify-write the same value. The key
+  expires once that time has passed, and the next request restarts the full
+  bucket with ``cache.add``, which only one of several racing requests wins.
+  Over the limit the view answers ``429`` with ``Retry-After``.
+* A global cap of ``settings.WRITE_CONCURRENCY_LIMIT`` write requests in
+  flight, counted with ``cache.incr``/``cache.decr``. Past it the view
+  answers ``503`` with ``Retry-After`` at once instead of queueing for a
+  database connection until the client times out.
+
+Every rejection is counted in ``requests_throttled_total{scope,reason}``.
+
+On DRF views the decorator goes inside ``@api_view`` so that buckets are
+keyed by the user DRF authenticated, not by the client's address.
+"""
+from functools import wraps
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import JsonResponse
+
+from . import metrics
+
+INFLIGHT_KEY = 'throttle:inflight'
+# A worker killed mid-request never releases its slot; the counter expires
+# after this many seconds without a new request, so a leak cannot close the
+# gate for good, while every request pushes the expiry back under load
+INFLIGHT_TIMEOUT = 60
+
+
+def _client(request):
+    if request.user.is_authenticated:
+        return f'user:{request.user.pk}'
+    return f'ip:{request.META.get("REMOTE_ADDR", "")}'
+
+
+def take_token(scope, client):
+    """Spend one token; returns 0 when allowed, else seconds until one is free"""
+    burst, per_seconds = settings.RATE_LIMITS[scope]
+    interval = per_seconds * 1000 // burst or 1
+    tolerance = interval * (burst - 1)
+    key = f'throttle:{scope}:{client}'
+    now = int(time.time() * 1000)
+    timeout = per_seconds + 1
+
+    # A missing key is a full bucket
+    cache.add(key, now, timeout)
+    try:
+        arrival = cache.incr(key, interval) - interval
+    except ValueError:
+        # Expired between add and incr; add, not set, so that of several
+        # requests doing this only one restarts the bucket and the rest count
+        if not cache.add(key, now + interval, timeout):
+            cache.incr(key, interval)
+        return 0
+    if arrival - now > tolerance:
+        cache.decr(key, interval)
+        return math.ceil((arrival - tolerance - now) / 1000)
+    # Expire once the arrival time has passed, so refilling is the add above
+    # rather than a reset written over concurrent increments
+    cache.touch(key, max(math.ceil((arrival + interval - now) / 1000), 1))
+    return 0
+
+
+def _acquire_slot():
+    limit = settings.WRITE_CONCURRENCY_LIMIT
+    if not limit:
+        return True
+    cache.add(INFLIGHT_KEY, 0, INFLIGHT_TIMEOUT)
+    try:
+        in_flight = cache.incr(INFLIGHT_KEY)
+    except ValueError:
+        # Expired between add and incr
+        if not cache.add(INFLIGHT_KEY, 1, INFLIGHT_TIMEOUT):
+            cache.incr(INFLIGHT_KEY)
+        return True
+    cache.touch(INFLIGHT_KEY, INFLIGHT_TIMEOUT)
+    if in_flight <= limit:
+        return True
+    _release_slot()
+    return False
+
+
+def _release_slot():
+    if not settings.WRITE_CONCURRENCY_LIMIT:
+        return
+    try:
+        if cache.decr(INFLIGHT_KEY) < 0:
+            # The counter expired and restarted while requests were in flight
+            cache.set(INFLIGHT_KEY, 0, INFLIGHT_TIMEOUT)
+    except ValueError:
+        pass
+
+
+def _rejected(scope, reason, status, retry_after, error):
+    metrics.inc('requests_throttled_total', scope=scope, reason=reason)
+    response = JsonResponse({'success': False, 'error': error}, status=status)
+    response['Retry-After'] = str(max(retry_after, 1))
+    return response
+
+
+def throttled(scope):
+    """Rate-limit a write view per user and admit it only under the concurrency cap"""
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            if request.method in ('GET', 'HEAD', 'OPTIONS'):
+                return view_func(request, *args, **kwargs)
+            if scope in settings.RATE_LIMITS:
+                wait = take_token(scope, _client(request))
+                if wait:
+                    return _rejected(scope, 'rate', 429, wait, 'Too many requests; slow down and retry.')
+            if not _acquire_slot():
+                return _rejected(scope, 'concurrency', 503, 1, 'Server busy; retry shortly.')
+            try:
+                return view_func(request, *args, **kwargs)
+            finally:
+                _release_slot()
+        return wrapper
+    return decorator
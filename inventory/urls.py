@@ -7,7 +7,14 @@ urlpatterns = [
     path('sell/', views.sell, name='sell'),
     path('sales/', views.SalesListView.as_view(), name='sales-list'),
     path('sales/<int:pk>/delete/', views.SaleDeleteView.as_view(), name='sale-delete'),
+    path('replenishment/', views.ReplenishmentListView.as_view(), name='replenishment'),
+    path('reports/margins/', views.margin_report, name='margin-report'),
+    path('stock-takes/', views.stock_take_list, name='stock-take-list'),
+    path('stock-takes/<int:pk>/', views.stock_take_detail, name='stock-take-detail'),
+    path('stock-takes/<int:pk>/report.csv', views.stock_take_report, name='stock-take-report'),
     path('create/', views.ProductCreateView.as_view(), name='product-create'),
+    path('families/', views.ProductFamilyListView.as_view(), name='product-family-list'),
+    path('families/<int:pk>/', views.product_family_detail, name='product-family-detail'),
     path('<int:pk>/', views.ProductDetailView.as_view(), name='product-detail'),
     path('<int:pk>/edit/', views.ProductUpdateView.as_view(), name='product-update'),
     path('<int:pk>/delete/', views.ProductDeleteView.as_view(), name='product-delete'),
@@ -25,4 +32,5 @@ urlpatterns = [
     # AJAX URLs
     path('ajax/create-category/', views.create_category_ajax, name='create-category-ajax'),
     path('ajax/create-order/', views.create_order_ajax, name='create-order-ajax'),
+    path('ajax/catalog-cache-stats/', views.catalog_cache_stats, name='catalog-cache-stats'),
 ]
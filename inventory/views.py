@@ -1,62 +1,73 @@
 from decimal import Decimal
+from asgiref.sync import sync_to_async
 from django.contrib.auth.decorators import login_required
+from django.contrib.auth.views import redirect_to_login
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.db.models import Q, Sum, F
+from django.db import transaction
+from django.db.models import Q, F
+from django.db.models.functions import Abs
 from django.shortcuts import render, get_object_or_404
-from django.urls import reverse_lazy
+from django.template.loader import render_to_string
+from django.urls import reverse, reverse_lazy
 from django.views.generic import ListView, CreateView, UpdateView, DeleteView, DetailView
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponseRedirect, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
+import csv
+import io
 import json
+import re
 import uuid
 
-from .models import Product, Category, Order, OrderItem, Notification, Sale
-from .forms import ProductForm, CategoryForm, OrderForm, OrderItemFormSet, SellForm
+from .models import Product, ProductFamily, Category, Customer, Order, OrderItem, Notification, Sale, ReorderSuggestion, StockMovement, StockTake
+from .forms import ProductForm, CategoryForm, OrderForm, OrderItemFormSet, SellForm, MarginReportForm, StockTakeUploadForm
+from .routers import replica_reads
+from .families import VariantMatrix, family_summaries, variant_matrix
+from .idempotency import idempotent
+from .throttling import throttled
+from .concurrency import VersionConflict
+from .services import InsufficientStock, save_order_edit
+from .notifications import mark_read
+from . import analytics, catalog, figures, ledger, locations, metrics, stocktake
+
+# Order searches made only of these characters are read as a phone number
+PHONE_SEARCH = re.compile(r'[\d\s()+-]+')
 
 @login_required
+@replica_reads
 def dashboard(request):
-    total_products = Product.objects.filter(is_active=True).count()
-    total_stock = Product.objects.aggregate(s=Sum('stock'))['s'] or 0
-    inventory_value = Product.objects.aggregate(v=Sum(F('price') * F('stock')))['v'] or Decimal('0.00')
-    low_stock_count = Product.objects.filter(reorder_threshold__gt=0, stock__lte=F('reorder_threshold')).count()
-
-    low_stock_items = Product.objects.filter(reorder_threshold__gt=0, stock__lte=F('reorder_threshold')).order_by('stock')[:10]
-    recent_items = Product.objects.order_by('-created_at')[:10]
-    
-    # Order statistics
-    pending_orders = Order.objects.filter(status='pending').count()
-    recent_orders = Order.objects.order_by('-created_at')[:5]
-    
-    # Unread notifications
-    unread_notifications = Notification.objects.filter(is_read=False).order_by('-created_at')[:5]
-
-    # Sales summary for dashboard (guard if table not migrated yet)
-    try:
-        total_sales_count = Sale.objects.count()
-        total_sales_amount = Sale.objects.aggregate(v=Sum('total_amount'))['v'] or Decimal('0.00')
-        recent_sales = Sale.objects.select_related('product').order_by('-created_at')[:5]
-    except Exception:
-        total_sales_count = 0
-        total_sales_amount = Decimal('0.00')
-        recent_sales = []
-
+    location = catalog.location(request.GET.get('location', ''))
     return render(request, 'dashboard.html', {
-        'total_products': total_products,
-        'total_stock': total_stock,
-        'inventory_value': inventory_value,
-        'low_stock_count': low_stock_count,
-        'low_stock_items': low_stock_items,
-        'recent_items': recent_items,
-        'pending_orders': pending_orders,
-        'recent_orders': recent_orders,
-        'unread_notifications': unread_notifications,
-        'total_sales_count': total_sales_count,
-        'total_sales_amount': total_sales_amount,
-        'recent_sales': recent_sales,
+        **figures.evaluate(location),
+        'location': location,
+        'locations': catalog.locations(),
     })
 
+@replica_reads
+async def dashboard_live(request):
+    """The dashboard for ASGI servers: the shell at once, then each section as its queries finish
+
+    ``login_required`` cannot wrap a coroutine in this Django version, so the
+    login check is done here.
+    """
+    if not await sync_to_async(lambda: request.user.is_authenticated)():
+        return redirect_to_login(request.get_full_path())
+
+    def shell():
+        location = catalog.location(request.GET.get('location', ''))
+        html = render_to_string('dashboard.html', {
+            'live': True,
+            'location': location,
+            'locations': catalog.locations(),
+        }, request=request)
+        return location, html
+
+    location, html = await sync_to_async(shell)()
+    head, _, tail = html.partition(figures.STREAM_MARKER)
+    return StreamingHttpResponse(figures.stream(head, tail, location), content_type='text/html; charset=utf-8')
+
 @login_required
+@throttled('create-category')
 def create_category_ajax(request):
     if request.method == 'POST':
         try:
@@ -88,48 +99,53 @@ def create_category_ajax(request):
     return JsonResponse({'success': False, 'error': 'Invalid request method'})
 
 @login_required
+@throttled('create-order')
+@idempotent('create-order')
 def create_order_ajax(request):
-    """AJAX endpoint for creating orders (for external systems or customer interface)"""
+    """AJAX endpoint for creating orders (for external systems or customer interface)
+
+    Send an ``Idempotency-Key`` header to make retries safe: a repeated key
+    returns the first response instead of creating another order.
+    """
     if request.method == 'POST':
         try:
             data = json.loads(request.body)
             
-            # Generate unique order number
-            order_number = f"ORD-{uuid.uuid4().hex[:8].upper()}"
-            
-            # Create order
-            order = Order.objects.create(
-                order_number=order_number,
-                customer_name=data.get('customer_name'),
-                customer_email=data.get('customer_email', ''),
-                customer_phone=data.get('customer_phone'),
-                customer_address=data.get('customer_address'),
-            )
-            
-            # Add order items
-            total_amount = Decimal('0.00')
-            for item_data in data.get('items', []):
-                product = get_object_or_404(Product, id=item_data['product_id'])
-                quantity = int(item_data['quantity'])
-                
-                # Check stock availability
-                if product.stock < quantity:
-                    return JsonResponse({
-                        'success': False, 
-                        'error': f'Insufficient stock for {product.name}. Available: {product.stock}, Requested: {quantity}'
-                    })
+            with transaction.atomic():
+                # Generate unique order number
+                order_number = f"ORD-{uuid.uuid4().hex[:8].upper()}"
                 
-                order_item = OrderItem.objects.create(
-                    order=order,
-                    product=product,
-                    quantity=quantity,
-                    unit_price=product.price
+                # Create order
+                order = Order.objects.create(
+                    order_number=order_number,
+                    customer_name=data.get('customer_name'),
+                    customer_email=data.get('customer_email', ''),
+                    customer_phone=data.get('customer_phone'),
+                    customer_address=data.get('customer_address'),
                 )
-                total_amount += order_item.subtotal
-            
-            # Update order total
-            order.total_amount = total_amount
-            order.save()
+                
+                # Add order items
+                total_amount = Decimal('0.00')
+                for item_data in data.get('items', []):
+                    product = get_object_or_404(Product, id=item_data['product_id'])
+                    quantity = int(item_data['quantity'])
+                    
+                    # Check stock availability; raising rolls back the order and earlier lines
+                    if product.default_location_stock < quantity:
+                        metrics.inc('stock_decrement_failures_total')
+                        raise InsufficientStock(product, product.default_location_stock, quantity)
+                    
+                    order_item = OrderItem.objects.create(
+                        order=order,
+                        product=product,
+                        quantity=quantity,
+                        unit_price=product.price
+                    )
+                    total_amount += order_item.subtotal
+                
+                # Update order total
+                order.total_amount = total_amount
+                order.save()
             
             return JsonResponse({
                 'success': True,
@@ -140,8 +156,10 @@ def create_order_ajax(request):
                 }
             })
             
+        except InsufficientStock as e:
+            return JsonResponse({'success': False, 'error': str(e)}, status=409)
         except Exception as e:
-            return JsonResponse({'success': False, 'error': str(e)})
+            return JsonResponse({'success': False, 'error': str(e)}, status=400)
     
     return JsonResponse({'success': False, 'error': 'Invalid request method'})
 
@@ -150,23 +168,45 @@ def mark_notification_read(request, notification_id):
     """Mark a notification as read"""
     try:
         notification = get_object_or_404(Notification, id=notification_id)
-        notification.is_read = True
-        notification.save()
+        mark_read(Notification.objects.filter(pk=notification.pk))
         return JsonResponse({'success': True})
     except Exception as e:
         return JsonResponse({'success': False, 'error': str(e)})
 
 @login_required
+def catalog_cache_stats(request):
+    """Catalog cache hit/miss counters for the worker serving this request"""
+    return JsonResponse(catalog.stats())
+
+@login_required
+@throttled('sell')
+@idempotent('sell')
 def sell(request):
-    """Simple sell page to reduce stock for a selected product"""
+    """Simple sell page to reduce stock for a selected product
+
+    The form carries a one-time idempotency token, so a double click or a
+    resubmitted page replays the first result instead of selling twice.
+    """
     if request.method == 'POST':
         form = SellForm(request.POST)
         if form.is_valid():
             product = form.cleaned_data['product']
             quantity = form.cleaned_data['quantity']
 
-            # Reduce stock safely
-            if product.reduce_stock(quantity):
+            with transaction.atomic():
+                # Record the sale first so the stock ledger row can point at it
+                sale = Sale.objects.create(
+                    product=product,
+                    quantity=quantity,
+                    unit_price=product.price,
+                    total_amount=product.price * quantity,
+                    created_by=request.user if request.user.is_authenticated else None
+                )
+                # Checked and taken on the row, so a concurrent sale is never lost
+                sold = product.reduce_stock(quantity, reason=StockMovement.Reason.SALE, sale=sale, user=sale.created_by)
+                if not sold:
+                    transaction.set_rollback(True)
+            if sold:
                 # Optional: create a notification for stock update/low stock
                 if product.low_stock:
                     Notification.objects.create(
@@ -175,20 +215,13 @@ def sell(request):
                         message=f'{product.name} is now at {product.stock} units (threshold: {product.reorder_threshold})',
                         product=product
                     )
-                # Record the sale
-                Sale.objects.create(
-                    product=product,
-                    quantity=quantity,
-                    unit_price=product.price,
-                    total_amount=product.price * quantity,
-                    created_by=request.user if request.user.is_authenticated else None
-                )
                 return render(request, 'sell.html', {
                     'form': SellForm(),
                     'success_message': f'Sold {quantity} x {product.name}. Remaining stock: {product.stock}.',
                 })
-            else:
-                form.add_error('quantity', f'Insufficient stock. Available: {product.stock}.')
+            form.add_error('quantity', f'Insufficient stock. Available: {product.default_location_stock}.')
+        # Invalid submissions are not stored against the token, so it can be resubmitted
+        return render(request, 'sell.html', {'form': form}, status=400)
     else:
         form = SellForm()
 
@@ -198,10 +231,11 @@ class SalesListView(LoginRequiredMixin, ListView):
     model = Sale
     template_name = 'sales_list.html'
     context_object_name = 'sales'
+    replica_reads = True
     paginate_by = 20
 
     def get_queryset(self):
-        qs = Sale.objects.select_related('product').order_by('-created_at')
+        qs = Sale.objects.select_related('product', 'created_by').order_by('-created_at')
         return qs
 
     def get_context_data(self, **kwargs):
@@ -218,10 +252,118 @@ class SaleDeleteView(LoginRequiredMixin, DeleteView):
     template_name = 'sale_confirm_delete.html'
     success_url = reverse_lazy('sales-list')
 
+class ReplenishmentListView(LoginRequiredMixin, ListView):
+    """Reorder suggestions written by the forecast_reorders command, most urgent first"""
+    model = ReorderSuggestion
+    template_name = 'replenishment.html'
+    context_object_name = 'suggestions'
+    replica_reads = True
+    paginate_by = 50
+
+    def get_queryset(self):
+        qs = ReorderSuggestion.objects.select_related('product').filter(product__is_active=True)
+        if self.request.GET.get('all') != '1':
+            qs = qs.filter(reorder_quantity__gt=0)
+        return qs.order_by(F('days_of_cover').asc(nulls_last=True), '-reorder_quantity')
+
+@login_required
+@replica_reads
+def margin_report(request):
+    """Revenue, cost of goods and gross margin grouped by category, size, color or product"""
+    form = MarginReportForm(request.GET or None)
+    rows = []
+    if not form.is_bound or form.is_valid():
+        params = form.cleaned_data if form.is_bound else {}
+        source = params.get('source')
+        rows = analytics.margin_report(
+            group_by=params.get('group_by') or 'category',
+            period=params.get('period') or None,
+            start=params.get('start'),
+            end=params.get('end'),
+            sources=(source,) if source else ('sale', 'order'),
+            include_archive=not params.get('live_only'),
+        )
+    revenue = sum((row.revenue for row in rows), Decimal('0.00'))
+    cost = sum((row.cost for row in rows), Decimal('0.00'))
+    return render(request, 'margin_report.html', {
+        'form': form,
+        'rows': rows,
+        'total_revenue': revenue,
+        'total_cost': cost,
+        'total_margin': revenue - cost,
+        'total_margin_percent': ((revenue - cost) / revenue * 100) if revenue else None,
+        'rolled_through': analytics.rolled_through(),
+    })
+
+@login_required
+def stock_take_list(request):
+    """Upload a counted file as a draft stock take; lists recent stock takes"""
+    form = StockTakeUploadForm(request.POST or None, request.FILES or None)
+    if request.method == 'POST' and form.is_valid():
+        upload = io.TextIOWrapper(form.cleaned_data['count_file'], encoding='utf-8-sig', newline='')
+        try:
+            counts = stocktake.read_counts(upload)
+        except (stocktake.CountFileError, UnicodeDecodeError) as e:
+            form.add_error('count_file', str(e))
+        else:
+            if not counts:
+                form.add_error('count_file', 'The file has no counted lines.')
+            else:
+                stock_take = stocktake.load_count(counts, user=request.user, note=form.cleaned_data['note'])
+                return HttpResponseRedirect(reverse('stock-take-detail', args=[stock_take.pk]))
+    return render(request, 'stock_take_list.html', {
+        'form': form,
+        'stock_takes': StockTake.objects.select_related('created_by')[:20],
+    }, status=400 if form.errors else 200)
+
+@login_required
+def stock_take_detail(request, pk):
+    """Variance summary and largest variances for a stock take; POST applies a draft"""
+    stock_take = get_object_or_404(StockTake, pk=pk)
+    error = None
+    if request.method == 'POST':
+        try:
+            stocktake.apply_stock_take(stock_take)
+        except ValueError as e:
+            error = str(e)
+        else:
+            return HttpResponseRedirect(reverse('stock-take-detail', args=[pk]))
+    largest = (
+        stock_take.adjustments.select_related('product')
+        .annotate(value_at_cost=F('variance') * F('unit_cost'))
+        .annotate(impact=Abs('value_at_cost'))
+        .order_by('-impact', 'product__sku')[:50]
+    )
+    return render(request, 'stock_take_detail.html', {
+        'stock_take': stock_take,
+        'summary': stocktake.summary(stock_take),
+        'largest': largest,
+        'error': error,
+    })
+
+class _Echo:
+    """File-like object csv.writer can write to that hands back each line"""
+
+    def write(self, value):
+        return value
+
+@login_required
+def stock_take_report(request, pk):
+    """The full variance report as a streamed CSV download"""
+    stock_take = get_object_or_404(StockTake, pk=pk)
+    writer = csv.writer(_Echo())
+    response = StreamingHttpResponse(
+        (writer.writerow(row) for row in stocktake.report_rows(stock_take)),
+        content_type='text/csv',
+    )
+    response['Content-Disposition'] = f'attachment; filename="stock-take-{stock_take.pk}.csv"'
+    return response
+
 class ProductListView(LoginRequiredMixin, ListView):
     model = Product
     template_name = 'product_list.html'
     context_object_name = 'products'
+    replica_reads = True
     paginate_by = 20
 
     def get_queryset(self):
@@ -241,26 +383,74 @@ class ProductListView(LoginRequiredMixin, ListView):
         if category:
             qs = qs.filter(category_id=category)
         
+        # Location filter; stock status then reads the units at that location
+        stock = 'stock'
+        self.location = catalog.location(self.request.GET.get('location', ''))
+        if self.location:
+            qs = locations.at_location(qs, self.location)
+            stock = 'location_stock'
+
         # Stock status filter
         stock_status = self.request.GET.get('stock_status')
         if stock_status == 'low_stock':
-            qs = qs.filter(reorder_threshold__gt=0, stock__lte=F('reorder_threshold'))
+            qs = qs.filter(reorder_threshold__gt=0, **{f'{stock}__lte': F('reorder_threshold')})
         elif stock_status == 'out_of_stock':
-            qs = qs.filter(stock=0)
+            qs = qs.filter(**{stock: 0})
         elif stock_status == 'in_stock':
-            qs = qs.filter(stock__gt=0)
+            qs = qs.filter(**{f'{stock}__gt': 0})
         
         return qs
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['categories'] = Category.objects.all().order_by('name')
+        context['categories'] = catalog.categories()
+        context['locations'] = catalog.locations()
+        context['location'] = self.location
         return context
 
+class ProductFamilyListView(LoginRequiredMixin, ListView):
+    """One row per family with aggregated stock and price range, from one grouped query"""
+    model = ProductFamily
+    template_name = 'product_family_list.html'
+    context_object_name = 'families'
+    replica_reads = True
+    paginate_by = 20
+
+    def get_queryset(self):
+        qs = family_summaries().order_by('name')
+
+        search = self.request.GET.get('search')
+        if search:
+            qs = qs.filter(Q(name__icontains=search) | Q(sku_prefix__icontains=search))
+
+        category = self.request.GET.get('category')
+        if category:
+            qs = qs.filter(category_id=category)
+
+        if self.request.GET.get('stock_status') == 'low_stock':
+            qs = qs.filter(low_stock_count__gt=0)
+        return qs
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['categories'] = catalog.categories()
+        return context
+
+@login_required
+@replica_reads
+def product_family_detail(request, pk):
+    """Size x color stock matrix for one family"""
+    matrix = variant_matrix(pk)
+    if matrix is None:
+        family = get_object_or_404(ProductFamily.objects.select_related('category'), pk=pk)
+        matrix = VariantMatrix(family=family, sizes=[], colors=[], rows=[])
+    return render(request, 'product_family_detail.html', {'matrix': matrix, 'family': matrix.family})
+
 class OrderListView(LoginRequiredMixin, ListView):
     model = Order
     template_name = 'order_list.html'
     context_object_name = 'orders'
+    replica_reads = True
     paginate_by = 20
 
     def get_queryset(self):
@@ -271,14 +461,25 @@ class OrderListView(LoginRequiredMixin, ListView):
         if status:
             qs = qs.filter(status=status)
         
-        # Search functionality
-        search = self.request.GET.get('search')
+        customer = self.request.GET.get('customer')
+        if customer and customer.isdigit():
+            qs = qs.filter(customer_id=customer)
+
+        # Search functionality. A full phone number is looked up through the
+        # customer's phone index, whatever format each order stored it in, or
+        # as an exact order number; only other text is matched by substring
+        search = self.request.GET.get('search', '').strip()
         if search:
-            qs = qs.filter(
-                Q(order_number__icontains=search) |
-                Q(customer_name__icontains=search) |
-                Q(customer_phone__icontains=search)
-            )
+            phone = Customer.normalize_phone(search) if PHONE_SEARCH.fullmatch(search) else ''
+            if phone:
+                number = search.upper()
+                qs = qs.filter(Q(customer__phone=phone) | Q(order_number__in=[number, f'ORD-{number}']))
+            else:
+                qs = qs.filter(
+                    Q(order_number__icontains=search) |
+                    Q(customer_name__icontains=search) |
+                    Q(customer_phone__icontains=search)
+                )
         
         return qs
 
@@ -286,6 +487,7 @@ class NotificationListView(LoginRequiredMixin, ListView):
     model = Notification
     template_name = 'notification_list.html'
     context_object_name = 'notifications'
+    replica_reads = True
     paginate_by = 20
 
     def get_queryset(self):
@@ -309,6 +511,7 @@ class ProductDetailView(LoginRequiredMixin, DetailView):
     model = Product
     template_name = 'product_detail.html'
     context_object_name = 'product'
+    replica_reads = True
 
 class ProductCreateView(LoginRequiredMixin, CreateView):
     model = Product
@@ -316,12 +519,24 @@ class ProductCreateView(LoginRequiredMixin, CreateView):
     template_name = 'product_form.html'
     success_url = reverse_lazy('product-list')
 
+    def form_valid(self, form):
+        ledger.tag(form.instance, user=self.request.user)
+        return super().form_valid(form)
+
 class ProductUpdateView(LoginRequiredMixin, UpdateView):
     model = Product
     form_class = ProductForm
     template_name = 'product_form.html'
     success_url = reverse_lazy('product-list')
 
+    def form_valid(self, form):
+        ledger.tag(form.instance, user=self.request.user)
+        try:
+            return super().form_valid(form)
+        except VersionConflict as e:
+            form.add_error(None, str(e))
+            return self.form_invalid(form)
+
 class ProductDeleteView(LoginRequiredMixin, DeleteView):
     model = Product
     template_name = 'product_confirm_delete.html'
@@ -331,6 +546,7 @@ class CategoryListView(LoginRequiredMixin, ListView):
     model = Category
     template_name = 'category_list.html'
     context_object_name = 'categories'
+    replica_reads = True
     paginate_by = 20
 
 class CategoryCreateView(LoginRequiredMixin, CreateView):
@@ -402,18 +618,29 @@ class OrderUpdateView(LoginRequiredMixin, UpdateView):
         formset = context['formset']
         
         if formset.is_valid():
-            self.object = form.save()
-            formset.instance = self.object
-            formset.save()
-            
-            # Recalculate total amount
-            self.object.calculate_total()
-            
-            return super().form_valid(form)
+            # Header, lines, stock and total are saved together from the diff
+            try:
+                self.object = save_order_edit(form, formset, user=self.request.user)
+            except InsufficientStock as e:
+                for item_form in formset.forms:
+                    if item_form.instance.product_id == e.product.pk:
+                        item_form.add_error('quantity', str(e))
+                        break
+                context.update(form=form)
+                return self.render_to_response(context)
+            except VersionConflict as e:
+                form.add_error(None, str(e))
+                context.update(form=form)
+                return self.render_to_response(context)
+            return HttpResponseRedirect(self.get_success_url())
         else:
             return self.render_to_response(self.get_context_data(form=form))
 
 class OrderDetailView(LoginRequiredMixin, DetailView):
     model = Order
     template_name = 'order_detail.html'
-    context_object_name = 'order'
\ No newline at end of file
+    context_object_name = 'order'
+    replica_reads = True
+
+    def get_queryset(self):
+        return Order.objects.prefetch_related('items__product')
@@ -0,0 +1,330 @@
+"""
+Outbound webhooks for order and stock events.
+
+An event is queued as a ``WebhookEvent`` row per subscribed endpoint, in the
+transaction that caused it: a rolled-back order sends nothing, and a
+committed one is sent even if the process dies right after. Nothing is sent
+from the request; ``manage.py deliver_webhooks`` drains the queue:
+
+* Due events are claimed by pushing ``next_attempt_at`` out by ``LEASE``
+  (with ``SKIP LOCKED`` where the database has it), so several workers can
+  run side by side and a worker that dies mid-send only delays its events.
+* Each endpoint's events go out up to ``batch_size`` per POST, from a few
+  threads over keep-alive connections kept in a per-host ``ConnectionPool``.
+  Only the main thread touches the database.
+* Every body is signed: ``X-Webhook-Signature`` is ``sha256=`` and the
+  HMAC-SHA256, keyed with the endpoint's secret, of
+  ``"<X-Webhook-Timestamp>.<body>"``.
+* A failed batch is retried after an exponential backoff with jitter. After
+  ``WEBHOOK_MAX_ATTEMPTS`` its events are left ``dead`` for the admin to
+  inspect and requeue.
+
+Delivery is at least once; receivers should skip event ids they have seen.
+Each event carries what changed (``data``) and the order or product as it
+is when sent (``object``), read once per batch.
+
+Event types are ``order.created``, ``order.status_changed``,
+``stock.changed`` and ``stock.low``, sent when stock falls from above the
+reorder threshold to it or below. The stock events are queued by
+``ledger.record()`` with the ledger row for the change. Queueing costs no
+query while nothing is subscribed: the subscriptions are cached until an
+endpoint changes. That cache may be another worker's stale copy, so the
+endpoints it names are checked against the table before anything is
+inserted: an endpoint deleted elsewhere is skipped rather than failing the
+order or stock write with a foreign key error. Code that moves order status with ``QuerySet.update()``
+skips the model signal and must call ``emit()`` itself.
+"""
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import hashlib
+import hmac
+import http.client
+import json
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Order, Product, WebhookEndpoint, WebhookEvent
+
+EVENT_TYPES = ('order.created', 'order.status_changed', 'stock.changed', 'stock.low')
+SUBSCRIPTIONS_KEY = 'webhooks:subscriptions'
+SUBSCRIPTIONS_TIMEOUT = 300
+# How long a claimed event is left to its worker before another may send it
+LEASE = timedelta(minutes=5)
+
+DeliveryRun = namedtuple('DeliveryRun', 'delivered failed dead requests')
+
+# Fields sent as an event's "object", by the model its type is about
+_OBJECT_FIELDS = {
+    Order: ('order_number', 'status', 'total_amount', 'customer_name', 'customer_phone', 'created_at', 'updated_at'),
+    Product: ('sku', 'name', 'price', 'stock', 'reorder_threshold', 'is_active'),
+}
+
+
+def subscriptions():
+    """``[(endpoint_id, event_types)]`` of active endpoints; no types means every event"""
+    endpoints = cache.get(SUBSCRIPTIONS_KEY)
+    if endpoints is None:
+        endpoints = [
+            (pk, tuple(events))
+            for pk, events in WebhookEndpoint.objects.filter(is_active=True).values_list('pk', 'events')
+        ]
+        cache.set(SUBSCRIPTIONS_KEY, endpoints, timeout=SUBSCRIPTIONS_TIMEOUT)
+    return endpoints
+
+
+def wants(event_type):
+    """Whether any endpoint takes ``event_type``, to skip building events nobody gets"""
+    return any(not types or event_type in types for _, types in subscriptions())
+
+
+def emit(events):
+    """Queue ``(type, object_id, data)`` events for their subscribers in one insert; returns the rows queued"""
+    endpoints = subscriptions()
+    if not endpoints:
+        return 0
+    live = set(
+        WebhookEndpoint.objects.filter(pk__in=[pk for pk, _ in endpoints], is_active=True)
+        .values_list('pk', flat=True)
+    )
+    if len(live) < len(endpoints):
+        # Changed in another worker; this one's cache is out of date
+        cache.delete(SUBSCRIPTIONS_KEY)
+        endpoints = [(pk, types) for pk, types in endpoints if pk in live]
+    rows = [
+        WebhookEvent(endpoint_id=pk, type=event_type, object_id=object_id, data=data)
+        for event_type, object_id, data in events
+        for pk, types in endpoints
+        if not types or event_type in types
+    ]
+    WebhookEvent.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+
+def stock_events(changes):
+    """Events for ``(product_id, before, after, reorder_threshold)`` stock moves"""
+    for pk, before, after, threshold in changes:
+        if before == after:
+            continue
+        yield 'stock.changed', pk, {'before': before, 'after': after}
+        if threshold and after <= threshold < before:
+            yield 'stock.low', pk, {'stock': after, 'threshold': threshold}
+
+
+def status_event(pk, order_number, before, after):
+    return 'order.status_changed', pk, {'order_number': order_number, 'from': before, 'to': after}
+
+
+@receiver(post_save, sender=Order)
+def order_saved(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    if raw:
+        return
+    if created:
+        emit([('order.created', instance.pk, {'order_number': instance.order_number})])
+    elif (
+        instance._saved_status is not None and instance.status != instance._saved_status
+        and (update_fields is None or 'status' in update_fields)
+    ):
+        emit([status_event(instance.pk, instance.order_number, instance._saved_status, instance.status)])
+    instance._saved_status = instance.status
+
+
+@receiver(post_save, sender=WebhookEndpoint)
+@receiver(post_delete, sender=WebhookEndpoint)
+def invalidate_subscriptions(sender, **kwargs):
+    cache.delete(SUBSCRIPTIONS_KEY)
+    if transaction.get_connection().in_atomic_block:
+        # A request may cache the endpoints before this one commits
+        transaction.on_commit(lambda: cache.delete(SUBSCRIPTIONS_KEY))
+
+
+class ConnectionPool:
+    """Keep-alive HTTP(S) connections per host, shared by the sending threads"""
+
+    def __init__(self, timeout=10, size=4):
+        self.timeout = timeout
+        self.size = size
+        self.opened = 0
+        self._idle = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def _acquire(self, scheme, host, port):
+        with self._lock:
+            idle = self._idle[scheme, host, port]
+            if idle:
+                return idle.pop(), True
+            self.opened += 1
+        connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        return connection_class(host, port, timeout=self.timeout), False
+
+    def _release(self, key, connection):
+        with self._lock:
+            if len(self._idle[key]) < self.size:
+                self._idle[key].append(connection)
+                return
+        connection.close()
+
+    def post(self, url, body, headers):
+        """POST ``body`` to ``url`` and return the response status"""
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        while True:
+            connection, reused = self._acquire(*key)
+            try:
+                connection.request('POST', path, body, headers)
+                response = connection.getresponse()
+                response.read()
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                if reused:
+                    # The receiver closed an idle connection; try a fresh one
+                    continue
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(key, connection)
+            return response.status
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for connection in idle:
+                    connection.close()
+            self._idle.clear()
+
+
+def sign(secret, timestamp, body):
+    """Signature of ``body`` sent at ``timestamp``, as in ``X-Webhook-Signature``"""
+    message = f'{timestamp}.'.encode('utf-8') + body
+    return 'sha256=' + hmac.new(secret.encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+
+def backoff(attempts):
+    """Seconds to wait before retry ``attempts`` + 1: doubling from the base, capped, jittered"""
+    delay = min(settings.WEBHOOK_RETRY_BASE * 2 ** (attempts - 1), settings.WEBHOOK_RETRY_MAX)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def claim(limit):
+    """Lease up to ``limit`` due events on active endpoints to this worker"""
+    now = timezone.now()
+    with transaction.atomic():
+        events = list(
+            WebhookEvent.objects.select_for_update(skip_locked=True, of=('self',))
+            .filter(status='pending', next_attempt_at__lte=now, endpoint__is_active=True)
+            .select_related('endpoint')
+            .order_by('pk')[:limit]
+        )
+        WebhookEvent.objects.filter(pk__in=[event.pk for event in events]).update(next_attempt_at=now + LEASE)
+    return events
+
+
+def _objects(events):
+    """``{(model, pk): fields}`` for the orders and products ``events`` are about, one query per model"""
+    ids = defaultdict(set)
+    for event in events:
+        ids[Order if event.type.startswith('order.') else Product].add(event.object_id)
+    objects = {}
+    for model, pks in ids.items():
+        for row in model.objects.filter(pk__in=pks).order_by().values('pk', *_OBJECT_FIELDS[model]):
+            objects[model, row['pk']] = row
+    return objects
+
+
+def _body(events, objects):
+    return json.dumps({'events': [
+        {
+            'id': event.pk,
+            'type': event.type,
+            'created_at': event.created_at,
+            'data': event.data,
+            'object': objects.get((Order if event.type.startswith('order.') else Product, event.object_id)),
+        }
+        for event in events
+    ]}, cls=DjangoJSONEncoder).encode('utf-8')
+
+
+def _send(pool, endpoint, body):
+    """Deliver one batch; returns None, or why it failed"""
+    timestamp = str(int(time.time()))
+    headers = {
+        'Content-Type': 'application/json',
+        'X-Webhook-Timestamp': timestamp,
+        'X-Webhook-Signature': sign(endpoint.secret, timestamp, body),
+    }
+    try:
+        status = pool.post(endpoint.url, body, headers)
+    except (http.client.HTTPException, OSError, ValueError) as e:
+        return f'{type(e).__name__}: {e}'[:500]
+    return None if 200 <= status < 300 else f'HTTP {status}'
+
+
+def _record(batches, errors):
+    """Mark delivered batches, and reschedule or dead-letter failed ones, a few ``UPDATE``s in all"""
+    now = timezone.now()
+    delivered = [event.pk for batch, error in zip(batches, errors) if error is None for event in batch]
+    WebhookEvent.objects.filter(pk__in=delivered).update(
+        status='delivered', delivered_at=now, attempts=F('attempts') + 1, last_error='',
+    )
+    failed = defaultdict(list)
+    for batch, error in zip(batches, errors):
+        if error is not None:
+            for event in batch:
+                failed[event.attempts + 1, error].append(event.pk)
+    dead = 0
+    for (attempts, error), pks in failed.items():
+        if attempts >= settings.WEBHOOK_MAX_ATTEMPTS:
+            WebhookEvent.objects.filter(pk__in=pks).update(status='dead', attempts=attempts, last_error=error)
+            dead += len(pks)
+        else:
+            WebhookEvent.objects.filter(pk__in=pks).update(
+                attempts=attempts, last_error=error, next_attempt_at=now + timedelta(seconds=backoff(attempts)),
+            )
+    return DeliveryRun(
+        delivered=len(delivered),
+        failed=sum(len(pks) for pks in failed.values()) - dead,
+        dead=dead,
+        requests=len(batches),
+    )
+
+
+def deliver_due(pool, batch_size=50, limit=1000, concurrency=4):
+    """Claim up to ``limit`` due events, send them and record how it went"""
+    events = claim(limit)
+    if not events:
+        return DeliveryRun(delivered=0, failed=0, dead=0, requests=0)
+    objects = _objects(events)
+    by_endpoint = defaultdict(list)
+    for event in events:
+        by_endpoint[event.endpoint_id].append(event)
+    batches = [
+        queued[start:start + batch_size]
+        for queued in by_endpoint.values()
+        for start in range(0, len(queued), batch_size)
+    ]
+    bodies = [_body(batch, objects) for batch in batches]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        errors = list(executor.map(
+            lambda batch, body: _send(pool, batch[0].endpoint, body), batches, bodies,
+        ))
+    return _record(batches, errors)
+
+
+def requeue(queryset):
+    """Send dead events again from their first attempt; returns how many"""
+    return queryset.filter(status='dead').update(
+        status='pending', attempts=0, next_attempt_at=timezone.now(), last_error='',
+    )